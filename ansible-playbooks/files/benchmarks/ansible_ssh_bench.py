@@ -0,0 +1,115 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Compares playbook runs that open fresh SSH sessions every time against
+# runs on the sshpool.py control sockets (plus pipelining). Run on the
+# skyscraper host as the user that runs playbooks, with key based ssh
+# to the targets:
+#
+#   /bin/python ansible_ssh_bench.py --hosts 1,10,100 --runs 5
+#
+# Every run is one trivial task on every host. Without --targets the
+# hosts are loopback addresses (127.0.0.2, 127.0.0.3, ...) of this box,
+# which needs its own key in authorized_keys; --targets cycles through
+# real addresses instead. Prints p50 and mean seconds per run.
+
+from __future__ import print_function
+from os import path, environ
+from time import time
+from argparse import ArgumentParser
+from subprocess import Popen, STDOUT
+from tempfile import mkdtemp
+from shutil import rmtree
+import sys
+
+sys.path.insert(0, "/srv/pyjojo")
+from sshpool import SshPool
+
+PLAYBOOK = """---
+- hosts: all
+  gather_facts: no
+  tasks:
+    - command: /bin/true
+"""
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = int(round((pct / 100.0) * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def write_inventory(directory, count, targets):
+    filename = path.join(directory, "hosts-{n}".format(n=count))
+    with open(filename, "w") as out:
+        out.write("[all]\n")
+        for index in range(count):
+            if targets:
+                address = targets[index % len(targets)]
+            else:
+                address = "127.0.{a}.{b}".format(a=(index + 2) // 256, b=(index + 2) % 256)
+            out.write("bench{i} ansible_host={a}\n".format(i=index, a=address))
+    return filename
+
+
+def run_once(playbook, inventory, env, forks):
+    """
+    :return <FLOAT>: seconds the run took
+    """
+    start = time()
+    with open("/dev/null", "w") as devnull:
+        proc = Popen(["/usr/bin/ansible-playbook", "-i", inventory, "--forks", str(forks), playbook],
+                     stdout=devnull, stderr=STDOUT, env=env)
+        if proc.wait() != 0:
+            raise SystemExit("ansible-playbook exited {rc}, rerun it by hand with -i {i}".format(
+                rc=proc.returncode, i=inventory))
+    return time() - start
+
+
+def bench(mode, playbook, inventory, workdir, runs, forks):
+    """
+    fresh turns multiplexing and pipelining off, so every run pays a
+    handshake per host. pooled warms the pool up once, then measures.
+
+    :return <tuple>: (p50 seconds, mean seconds)
+    """
+    env = dict(environ, ANSIBLE_HOST_KEY_CHECKING="False")
+    if mode == "fresh":
+        env.update(ANSIBLE_SSH_ARGS="-o ControlMaster=no", ANSIBLE_PIPELINING="False")
+    else:
+        SshPool(directory=path.join(workdir, "cp")).export(env)
+        run_once(playbook, inventory, env, forks)
+    samples = [run_once(playbook, inventory, env, forks) for _ in range(runs)]
+    return percentile(samples, 50), sum(samples) / len(samples)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="fresh SSH sessions vs the sshpool control sockets")
+    parser.add_argument("--hosts", default="1,10,100")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--forks", type=int, default=10)
+    parser.add_argument("--targets", help="comma separated addresses, default loopback")
+    args = parser.parse_args()
+
+    workdir = mkdtemp(prefix="ansible_ssh_bench")
+    try:
+        playbook = path.join(workdir, "bench.yml")
+        with open(playbook, "w") as out:
+            out.write(PLAYBOOK)
+        targets = args.targets.split(",") if args.targets else []
+
+        print("{h:>6} {m:>8} {p50:>10} {mean:>10}".format(h="hosts", m="", p50="p50 s", mean="mean s"))
+        for count in [int(n) for n in args.hosts.split(",")]:
+            inventory = write_inventory(workdir, count, targets)
+            for mode in ("fresh", "pooled"):
+                p50, mean = bench(mode, playbook, inventory, workdir, args.runs, args.forks)
+                print("{h:>6} {m:>8} {p50:>10.2f} {mean:>10.2f}".format(
+                    h=count, m=mode, p50=p50, mean=mean))
+    finally:
+        # Close the masters the pooled runs left behind before the
+        #  sockets go.
+        SshPool(directory=path.join(workdir, "cp"), max_masters=0).sweep()
+        rmtree(workdir)
@@ -0,0 +1,71 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Compares CmdRun.sql() fork-per-request (psql) against the pgpool.py
+# backend. Run as root on the postgres-api box with pgpool running:
+#
+#   /bin/python pgpool_bench.py --requests 500 --concurrency 8
+#
+# Prints requests/sec and p50/p99 latency for each backend.
+
+from __future__ import print_function
+from time import time
+from argparse import ArgumentParser
+import threading
+import sys
+
+sys.path.insert(0, "/srv/pyjojo")
+from common import CmdRun
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = int(round((pct / 100.0) * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def bench(backend, sql, requests, concurrency):
+    """
+    Fire `requests` calls of sql through backend from `concurrency`
+    threads.
+
+    :return <tuple>: (requests/sec, p50 seconds, p99 seconds)
+    """
+    latencies = []
+    lock = threading.Lock()
+    per_thread = requests // concurrency
+
+    def worker():
+        run = CmdRun(backend=backend)
+        for _ in range(per_thread):
+            start = time()
+            run.sql(sql)
+            elapsed = time() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time() - start
+    return (len(latencies) / wall, percentile(latencies, 50), percentile(latencies, 99))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="psql fork vs pgpool backend")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--sql", default="SELECT now() - pg_last_xact_replay_timestamp() AS time_lag;")
+    args = parser.parse_args()
+
+    print("{b:>6} {rps:>10} {p50:>10} {p99:>10}".format(b="", rps="req/s", p50="p50 ms", p99="p99 ms"))
+    for backend in ("psql", "pool"):
+        rps, p50, p99 = bench(backend, args.sql, args.requests, args.concurrency)
+        print("{b:>6} {rps:>10.1f} {p50:>10.2f} {p99:>10.2f}".format(
+            b=backend, rps=rps, p50=p50 * 1000, p99=p99 * 1000))
@@ -0,0 +1,115 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Compares the old multi-scan Sanitize checks against the compiled rule
+# programs over fuzzed inputs of up to LINUX_MAX_FILE_PATH_LENGTH
+# bytes. Runs anywhere common.py imports:
+#
+#   /bin/python sanitize_bench.py --inputs 2000 --rounds 5
+#
+# Prints microseconds per input and MB/s for each rule set, and checks
+# that both implementations agree on which inputs are rejected.
+
+from __future__ import print_function
+from argparse import ArgumentParser
+from time import time
+import random
+import re
+import sys
+
+sys.path.insert(0, "/srv/pyjojo")
+from common import Constants, Sanitize
+
+ESCAPES = ("''\"'\"'", "'\"'\"''")
+ALPHABET = ("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+            "_-./:,*!&' \"%\t")
+
+
+def fuzz(count, max_length, seed):
+    """
+    :return <list>: random strings, about a third of them carrying an
+                    escape sequence or a % somewhere along the way
+    """
+    rng = random.Random(seed)
+    inputs = []
+    for _ in range(count):
+        length = rng.randint(1, max_length)
+        text = "".join(rng.choice(ALPHABET) for _ in range(length))
+        roll = rng.random()
+        if roll < 0.2:
+            at = rng.randint(0, len(text))
+            text = text[:at] + rng.choice(ESCAPES) + text[at:]
+        elif roll < 0.33:
+            text = text.replace("%", "")
+            at = rng.randint(0, len(text))
+            text = text[:at] + "%" + text[at:]
+        else:
+            text = text.replace("%", "")
+        inputs.append(text)
+    return inputs
+
+
+def legacy_sql(text):
+    """
+    The checks Sanitize.sql() used to run: both escape scans counted in
+    full, then a third scan for %.
+
+    :return <BOOL>: True when rejected
+    """
+    begin = len(tuple(re.finditer(r"''\"'\"'", text)))
+    end = len(tuple(re.finditer(r"'\"'\"''", text)))
+    if begin + end > 0:
+        return True
+    return len(tuple(re.finditer(r"%", text))) > 0
+
+
+def legacy_identifier(text):
+    begin = len(tuple(re.finditer(r"''\"'\"'", text)))
+    end = len(tuple(re.finditer(r"'\"'\"''", text)))
+    if begin + end > 0:
+        return True
+    return not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", text)
+
+
+def bench(check, inputs, rounds):
+    """
+    :return <tuple>: (microseconds per input, MB/s, rejected count)
+    """
+    total_bytes = sum(len(i) for i in inputs) * rounds
+    rejected = 0
+    start = time()
+    for _ in range(rounds):
+        rejected = sum(1 for text in inputs if check(text))
+    elapsed = time() - start
+    return (elapsed / (len(inputs) * rounds) * 1e6,
+            total_bytes / elapsed / 1e6, rejected)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Sanitize rule engine micro-benchmark")
+    parser.add_argument("--inputs", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--max-length", type=int, default=Constants.LINUX_MAX_FILE_PATH_LENGTH)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    inputs = fuzz(args.inputs, args.max_length, args.seed)
+    sanitize = Sanitize()
+    cases = [
+        ("sql", legacy_sql, lambda t: sanitize.violation(t, "sql") is not None),
+        ("identifier", legacy_identifier, lambda t: sanitize.violation(t, "identifier") is not None),
+    ]
+
+    print("{r:>12} {impl:>9} {us:>12} {mbs:>10} {rej:>9}".format(
+        r="ruleset", impl="impl", us="us/input", mbs="MB/s", rej="rejected"))
+    for ruleset, legacy, compiled in cases:
+        for impl, check in (("legacy", legacy), ("compiled", compiled)):
+            us, mbs, rejected = bench(check, inputs, args.rounds)
+            print("{r:>12} {impl:>9} {us:>12.2f} {mbs:>10.1f} {rej:>9}".format(
+                r=ruleset, impl=impl, us=us, mbs=mbs, rej=rejected))
+        disagree = sum(1 for t in inputs if legacy(t) != compiled(t))
+        if disagree:
+            print("{r}: {n} inputs judged differently!".format(r=ruleset, n=disagree))
@@ -0,0 +1,334 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Database refresh pipeline, run on the destination master by
+# tasks/postgres/database_refresh_pipeline.yml as the deploy user (ssh
+# keys for the source, sudo to postgres for everything else).
+#
+#  The dump is read from the source over ssh and restored while it is
+#  still arriving:
+#
+#   plain SQL dumps   stream straight into psql, nothing lands on disk
+#   pg_dump -Fc       pg_restore -j cannot read a pipe, so the archive
+#                     is streamed into --stage-dir (unless the source is
+#                     this host) and restored with one worker per core
+#                     (or --jobs)
+#
+#  The contingency pg_dump of the current database runs next to the
+#  restore instead of before it. REVOKE/GRANT/ALTER TABLE OWNER lines are
+#  picked out of the stream on the way through, no second pass over the
+#  dump. Scrub, swap, permissions and post-restore follow, each timed.
+#  The last line printed is a JSON report of every stage.
+
+from __future__ import print_function
+from os import path, unlink, makedirs
+from subprocess import Popen, PIPE
+from json import dumps
+from time import time, sleep
+from multiprocessing import cpu_count
+import argparse
+import socket
+import threading
+import errno
+import sys
+import re as regex
+
+CHUNK = 1024 * 1024
+CUSTOM_MAGIC = "PGDMP"
+PERMISSION_LINE = regex.compile(
+    r"^(?:REVOKE .* ON .* FROM |GRANT .* ON .* TO |ALTER TABLE .* OWNER TO )")
+POSTGRES_WORD = regex.compile(r"\bpostgres\b")
+
+
+class Pipeline():
+    """
+    CLASS: The refresh, stage by stage. Every stage lands in self.stages
+           with its timing, a failed stage stops the ones after it.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.stages = []
+        self.permissions = []
+
+    def postgres(self, args, **kwargs):
+        """
+        :param args: <list> a postgres client command line
+        :return <Popen>: the command, run as postgres
+        """
+        return Popen(["/usr/bin/sudo", "-n", "-u", "postgres"] + args, **kwargs)
+
+    def psql(self, database, sql=None, filename=None, stop_on_error=True):
+        """
+        :return <tuple>: (returncode, stderr)
+        """
+        args = ["/usr/bin/psql", "-X", "-q", "-d", database]
+        if stop_on_error:
+            args += ["-v", "ON_ERROR_STOP=1"]
+        if filename:
+            args += ["-f", filename]
+        proc = self.postgres(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        _, stderr = proc.communicate(sql or "")
+        return proc.returncode, stderr
+
+    def stage(self, name, step, *args):
+        """
+        Run one stage, time it and record it.
+
+        :param step: <FUNCTION> returns None when it went well, else
+                     an error message
+        :return <BOOL>: the stage went well
+        """
+        started = time()
+        try:
+            error = step(*args)
+        except (OSError, IOError) as e:
+            error = str(e)
+        record = {'stage': name, 'seconds': round(time() - started, 3),
+                  'status': "failed" if error else "ok", 'error': error}
+        self.stages.append(record)
+        print("{stage}: {status} in {seconds}s".format(**record))
+        sys.stdout.flush()
+        return not error
+
+    def source(self):
+        """
+        :return <Popen>: the dump on its STDOUT
+        """
+        dump = self.options.source_path
+        if self.local():
+            return Popen(["/bin/cat", dump], stdout=PIPE, stderr=PIPE)
+        return Popen(["/usr/bin/ssh", "-o", "BatchMode=yes", self.options.source_host, "cat", dump],
+                     stdout=PIPE, stderr=PIPE)
+
+    def local(self):
+        return self.options.source_host in ("localhost", "127.0.0.1", socket.gethostname(),
+                                            socket.getfqdn())
+
+    def scan(self, data, carry):
+        """
+        Keep the permission lines of a piece of plain SQL.
+
+        :return <STR>: the unfinished last line, for the next piece
+        """
+        lines = (carry + data).split("\n")
+        for line in lines[:-1]:
+            if line[:1] in ("G", "R", "A") and PERMISSION_LINE.match(line):
+                self.permissions.append(line)
+        return lines[-1]
+
+    def database_exists(self, database):
+        proc = self.postgres(["/usr/bin/psql", "-X", "-A", "-t", "-d", "postgres", "-c",
+                              "SELECT 1 FROM pg_database WHERE datname = '{d}'".format(
+                                  d=database.replace("'", "''"))],
+                             stdout=PIPE, stderr=PIPE)
+        stdout, _ = proc.communicate()
+        return stdout.strip() == "1"
+
+    def backup(self):
+        """
+        One time contingency dump of the database about to be replaced.
+        """
+        database = self.options.database
+        if not self.database_exists(database):
+            return None
+        target = path.join(self.options.backup_dir, "{d}.sql.back".format(d=database))
+        with open(target, "w") as out:
+            proc = self.postgres(["/usr/bin/pg_dump", database], stdout=out, stderr=PIPE)
+            _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            return stderr.strip() or "pg_dump exited {rc}".format(rc=proc.returncode)
+        return None
+
+    def prepare(self):
+        """
+        A fresh, empty template database.
+        """
+        template = self.options.template
+        error = self.drop(template)
+        if error:
+            return error
+        returncode, stderr = self.psql("postgres", "CREATE DATABASE {t};".format(t=template))
+        return stderr.strip() if returncode else None
+
+    def drop(self, database):
+        """
+        Throw out whoever is connected and drop the database, retrying
+        while clients keep racing back in.
+        """
+        sql = ("SELECT pg_terminate_backend(pid) FROM pg_stat_activity"
+               " WHERE datname = '{d}' AND pid <> pg_backend_pid();"
+               "DROP DATABASE IF EXISTS {d};").format(d=database)
+        for attempt in range(self.options.drop_attempts):
+            returncode, stderr = self.psql("postgres", sql)
+            if not returncode:
+                return None
+            sleep(1)
+        return stderr.strip()
+
+    def restore(self):
+        """
+        Transfer and restore, overlapped. Decides plain SQL or custom
+        archive from the first bytes of the stream.
+        """
+        source = self.source()
+        head = source.stdout.read(len(CUSTOM_MAGIC))
+        if head == CUSTOM_MAGIC:
+            return self.restore_archive(source, head)
+        sink = self.postgres(["/usr/bin/psql", "-X", "-q", "-d", self.options.template],
+                             stdin=PIPE, stdout=open("/dev/null", "w"), stderr=PIPE)
+        errors = []
+        drain = threading.Thread(target=lambda: errors.append(sink.stderr.read()))
+        drain.daemon = True
+        drain.start()
+        carry = ""
+        data = head
+        try:
+            while data:
+                sink.stdin.write(data)
+                carry = self.scan(data, carry)
+                data = source.stdout.read(CHUNK)
+            self.scan("\n", carry)
+        finally:
+            sink.stdin.close()
+        sink.wait()
+        drain.join()
+        if source.wait() != 0:
+            return source.stderr.read().strip() or "source exited {rc}".format(rc=source.returncode)
+        if sink.returncode != 0:
+            return "".join(errors).strip() or "psql exited {rc}".format(rc=sink.returncode)
+        return None
+
+    def restore_archive(self, source, head):
+        """
+        pg_restore -j needs to seek, the archive is staged first unless
+        it already is on this host.
+        """
+        if self.local():
+            source.stdout.close()
+            source.wait()
+            return self.pg_restore(self.options.source_path)
+        staged = path.join(self.options.stage_dir, path.basename(self.options.source_path))
+        self.staged = staged
+        started = time()
+        with open(staged, "wb") as out:
+            data = head
+            while data:
+                out.write(data)
+                data = source.stdout.read(CHUNK)
+        if source.wait() != 0:
+            return source.stderr.read().strip() or "source exited {rc}".format(rc=source.returncode)
+        self.stages.append({'stage': "transfer", 'seconds': round(time() - started, 3),
+                            'status': "ok", 'error': None})
+        return self.pg_restore(staged)
+
+    def pg_restore(self, archive):
+        proc = self.postgres(["/usr/bin/pg_restore", "-j", str(self.options.jobs),
+                              "-d", self.options.template, archive], stdout=PIPE, stderr=PIPE)
+        _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            return stderr.strip() or "pg_restore exited {rc}".format(rc=proc.returncode)
+        # The ACL statements, from the schema alone.
+        proc = self.postgres(["/usr/bin/pg_restore", "-s", "-f", "-", archive],
+                             stdout=PIPE, stderr=PIPE)
+        carry = ""
+        for data in iter(lambda: proc.stdout.read(CHUNK), ""):
+            carry = self.scan(data, carry)
+        self.scan("\n", carry)
+        return None if proc.wait() == 0 else proc.stderr.read().strip()
+
+    def scrub(self):
+        returncode, stderr = self.psql(self.options.template, filename=self.options.scrub)
+        return stderr.strip() if returncode else None
+
+    def swap(self):
+        """
+        Replace the database with a copy of the scrubbed template.
+        """
+        error = self.drop(self.options.database)
+        if error:
+            return error
+        returncode, stderr = self.psql("postgres", "CREATE DATABASE {d} TEMPLATE {t} OWNER {o};".format(
+            d=self.options.database, t=self.options.template, o=self.options.owner))
+        return stderr.strip() if returncode else None
+
+    def grant(self):
+        """
+        The dump's REVOKE/GRANT/OWNER statements, postgres' part handed
+        to the database owner.
+        """
+        sql = "\n".join(POSTGRES_WORD.sub(self.options.owner, line) for line in self.permissions)
+        returncode, stderr = self.psql(self.options.database, sql + "\n", stop_on_error=False)
+        return stderr.strip() if returncode else None
+
+    def post_restore(self):
+        returncode, stderr = self.psql(self.options.database, filename=self.options.post_restore)
+        return stderr.strip() if returncode else None
+
+    def run(self):
+        """
+        :return <BOOL>: every stage went well
+        """
+        self.staged = None
+        backup = {}
+        worker = threading.Thread(target=lambda: backup.update(ok=self.stage("backup", self.backup)))
+        worker.start()
+        ok = self.stage("prepare", self.prepare) and self.stage("restore", self.restore)
+        worker.join()
+        ok = ok and backup['ok']
+        if ok and self.options.scrub:
+            ok = self.stage("scrub", self.scrub)
+        ok = ok and self.stage("swap", self.swap) and self.stage("permissions", self.grant)
+        if ok and self.options.post_restore:
+            ok = self.stage("post_restore", self.post_restore)
+        if self.staged and not self.options.keep:
+            try:
+                unlink(self.staged)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream, restore and swap in a database copy.")
+    parser.add_argument("--source-host", required=True)
+    parser.add_argument("--source-path", required=True)
+    parser.add_argument("--template", required=True)
+    parser.add_argument("--database", required=True)
+    parser.add_argument("--owner", required=True)
+    parser.add_argument("--scrub")
+    parser.add_argument("--post-restore")
+    parser.add_argument("--jobs", type=int, default=0, help="pg_restore workers, 0 for one per core")
+    parser.add_argument("--stage-dir", default="/var/lib/pgsql/xferincoming")
+    parser.add_argument("--backup-dir", default="/var/lib/pgsql/db_ephemeral_backup")
+    parser.add_argument("--drop-attempts", type=int, default=5)
+    parser.add_argument("--keep", action="store_true", help="leave the staged archive behind")
+    options = parser.parse_args()
+    if options.jobs < 1:
+        options.jobs = cpu_count()
+    for database in (options.template, options.database):
+        if database == "postgres" or not regex.match(r"^[A-Za-z_][A-Za-z0-9_]*$", database):
+            parser.error("refusing database name {d}".format(d=database))
+    for directory in (options.stage_dir, options.backup_dir):
+        if not path.isdir(directory):
+            try:
+                makedirs(directory, 0770)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    pipeline = Pipeline(options)
+    started = time()
+    ok = pipeline.run()
+    print(dumps({'status': "ok" if ok else "failed", 'jobs': options.jobs,
+                 'seconds': round(time() - started, 3), 'stages': pipeline.stages,
+                 'permission_statements': len(pipeline.permissions)}))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    exit(main())
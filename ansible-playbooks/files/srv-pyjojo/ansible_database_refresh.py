@@ -0,0 +1,135 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Refresh a database from another tier with database_refresh_pipeline.yml (streamed dump, parallel restore, timed stages)
+# param: src_tier - Tier to copy the database from, EXAMPLE: staging
+# param: dest_tier - Tier to copy the database to, EXAMPLE: dev
+# param: origin_database - Newest dump of this database is used (or copy_exact_file)
+# param: copy_exact_file - Dump file name in src_postgres_dump_dir to use instead
+# param: dest_database - Database to replace on the dest_tier
+# param: dest_database_owner - Owner of dest_database
+# param: dest_database_template - Interim template database name
+# param: sql_scrub_file - OPTIONAL: files/database_refresh/ scrub SQL run on the template
+# param: sql_post_restore - OPTIONAL: files/database_refresh/ SQL run on dest_database last
+# param: src_postgres_dump_dir - Dump directory on the source, default is /var/lib/pgsql/backups
+# param: dest_postgres_dump_dir - Staging directory for custom format archives, default is /var/lib/pgsql/xferincoming/
+# param: dest_postgres_tmpsql_dir - Directory for the SQL files, default is /var/lib/pgsql/xfertmp/
+# param: restore_jobs - pg_restore workers, default is one per destination core
+# param: limit - Ansible host pattern, EXAMPLE: staging:dev:&dbinfra
+# param: async - When true (default), queue the run and return a job id right away
+# http_method: post
+# lock: False
+# admission: ansible
+# tags: Postgres, Ansible
+# -- jojo --
+
+from json import dumps
+from pipes import quote
+from common import CmdRun, ParamSchema
+from common import ToolKit, Constants
+from common import ParamHandle as Param
+
+
+# Spawn Instances
+toolkit = ToolKit()               # <class> Misc. functions
+run = CmdRun()                    # <class> Runs the playbook
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+def name(param, require=False):
+    return {'name': param, 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+            'sanitizer': "identifier", 'require': require}
+
+
+def directory(param, default):
+    return {'name': param, 'max_length': Constants.LINUX_MAX_FILE_PATH_LENGTH,
+            'sanitizer': "path", 'default': default}
+
+
+schema = ParamSchema.compile("ansible_database_refresh", [
+    name("src_tier", require=True),
+    name("dest_tier", require=True),
+    name("origin_database"),
+    {'name': "copy_exact_file", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH,
+     'sanitizer': "path", 'pattern': r"[^/]+", 'expected': "a file name"},
+    name("dest_database", require=True),
+    name("dest_database_owner", require=True),
+    name("dest_database_template", require=True),
+    {'name': "sql_scrub_file", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH,
+     'sanitizer': "path", 'pattern': r"[^/]+\.sql", 'expected': "a .sql file name"},
+    {'name': "sql_post_restore", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH,
+     'sanitizer': "path", 'pattern': r"[^/]+\.sql", 'expected': "a .sql file name"},
+    directory("src_postgres_dump_dir", "/var/lib/pgsql/backups"),
+    directory("dest_postgres_dump_dir", "/var/lib/pgsql/xferincoming/"),
+    directory("dest_postgres_tmpsql_dir", "/var/lib/pgsql/xfertmp/"),
+    {'name': "restore_jobs", 'type': "int", 'max_length': 3, 'min': 1, 'max': 128},
+    {'name': "limit", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH,
+     'unquote': True, 'sanitizer': "host_pattern"},
+    {'name': "async", 'type': "bool", 'max_length': 6, 'default': True},
+])
+sanitized_arguement = schema.validate() # The validated API params
+
+if (sanitized_arguement['origin_database'] is None) == (sanitized_arguement['copy_exact_file'] is None):
+    Param().raise_error(keyname='origin_database', value=sanitized_arguement['origin_database'],
+                        expected_msg="exactly one of origin_database and copy_exact_file")
+
+extra_vars = {}
+for param in ("src_tier", "dest_tier", "origin_database", "copy_exact_file", "dest_database",
+              "dest_database_owner", "dest_database_template", "sql_scrub_file",
+              "sql_post_restore", "src_postgres_dump_dir", "dest_postgres_dump_dir",
+              "dest_postgres_tmpsql_dir"):
+    if sanitized_arguement[param] is not None:
+        extra_vars[param] = sanitized_arguement[param]
+if sanitized_arguement['restore_jobs'] is not None:
+    extra_vars['dbrefresh_restore_jobs'] = sanitized_arguement['restore_jobs']
+
+
+# ****************************
+# *  DEFINE ANSIBLE OPTIONS  *
+# ****************************
+# This will be used to define the argv keyvalue pairs passed to ansible.
+# Special (non arguements) include:
+#  - ansible_opts['playbook'] which is the path to the playbook file
+#  - ansible_opts['append_args'] which value should include any appendable arg like -vvvv
+ansible_opts = {}
+
+ansible_opts['playbook'] = '/opt/playbooks/ansible-playbooks/database_refresh_pipeline.yml'
+ansible_opts['append_args'] = '-v'
+ansible_opts['--limit'] = quote(sanitized_arguement['limit'] or "vagrant")
+ansible_opts['--inventory-file'] = '/opt/playbooks/ansible-hosts'
+ansible_opts['--user'] = 'vagrant'
+ansible_opts['--extra-vars'] = dumps(extra_vars)
+
+
+# *****************
+# *  RUN ANSIBLE  *
+# *****************
+if sanitized_arguement['async']:
+    # Poll ansible_job_status / ansible_job_log / ansible_job_result
+    job = run.ansible_job(ansible_opts)
+    print("jojo_return_value ansible_options={opt}".format(opt=ansible_opts))
+    print("jojo_return_value job_id={id}".format(id=job['id']))
+    print("jojo_return_value job_state={state}".format(state=job['state']))
+    exit(0)
+result = run.ansible_run(ansible_opts, sink=run.echo)  # Streamed to STDOUT as it runs
+
+
+# *************
+# *  RESULTS  *
+# *************
+print("jojo_return_value ansible_options={opt}".format(opt=ansible_opts))
+print("jojo_return_value ansible_returncode={rc}".format(rc=result.returncode))
+if result.ok():
+    print("jojo_return_value execution_status=ok")
+    exit(0)
+print("jojo_return_value execution_status=rollback")
+if result.structured:
+    # Only the executor knows which hosts, ansible-playbook output is text.
+    print("jojo_return_value failed_hosts={hosts}".format(hosts=result.failed_hosts()))
+if result.error:
+    print("jojo_return_value error_reason_indicator={error}".format(error=[result.error]))
+exit(1)
@@ -5,32 +5,33 @@
 # -- jojo --
 # description: A proof of concept that can trigger an ansible playbook called package_version.yml to get info about a specific package version
 # param: package - The package to retrieve the information about
+# param: async - When true, queue the run and return a job id right away
 # http_method: post
 # lock: False
+# admission: ansible
 # -- jojo --
 
-from common import CmdRun, Constants
-from common import ParamHandle as Param
+from common import CmdRun, Constants, ParamSchema
 from json import dumps as decode
+from sys import stdout
 
 # Spawn Instances
-parameter2 = Param()    # <class> Parame ter manipulation
 run = CmdRun()          # <class> Runs the query
-params = parameter2.list()  # <dict>  A dict of params
 
 
 # ************************************
 # *  DEFINE PARAMETERS AND VALIDATE  *
 # ************************************
-arguement = {} # The actual API params we pass to psql
-
-param = "package"
-package = Param()
-package.value = params[param]
-package.name = param
-package.require = True
-package.max_length = Constants.LINUX_MAX_FILE_NAME_LENGTH
-arguement[param] = {'package': package.get()}
+# The package ends up inside --extra-vars JSON, only package name
+#  characters are let through.
+schema = ParamSchema.compile("ansible_get_package_version", [
+    {'name': "package", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH, 'require': True,
+     'unquote': True, 'pattern': r"[A-Za-z0-9_.+:-]+", 'expected': "a package name"},
+    {'name': "async", 'type': "bool", 'max_length': 6},  # Not an ansible option
+])
+sanitized_arguement = schema.validate() # The validated API params
+arguement = {'package': {'package': sanitized_arguement['package']}}
+run_async = sanitized_arguement['async']
 
 
 # ****************************
@@ -53,12 +54,28 @@ ansible_opts['--extra-vars'] = decode(arguement['package'])
 # *****************
 # *  RUN ANSIBLE  *
 # *****************
-output = run.ansible(ansible_opts)
+if run_async:
+    # Poll ansible_job_status / ansible_job_log / ansible_job_result
+    job = run.ansible_job(ansible_opts)
+    print("jojo_return_value ansible_options={opt}".format(opt=ansible_opts))
+    print("jojo_return_value job_id={id}".format(id=job['id']))
+    print("jojo_return_value job_state={state}".format(state=job['state']))
+    exit(0)
+result = run.ansible_run(ansible_opts, sink=run.echo)  # Streamed to STDOUT as it runs
 
 
 # *************
 # *  RESULTS  *
 # *************
+# Straight from the rpm -q task result of every host, when the resident
+#  executor ran the playbook (ansible-playbook output is only text).
+for task in result.task_results(task="Get package version"):
+    print(decode({'host': task['host'],
+                  'installed': task['result'].get('rc') == 0,
+                  'version': task['result'].get('stdout')}))
+stdout.flush()
 print("jojo_return_value ansible_options={opt}".format(opt=ansible_opts))
-print(output)
-exit(0)
+print("jojo_return_value ansible_returncode={rc}".format(rc=result.returncode))
+if result.structured:
+    print("jojo_return_value failed_hosts={hosts}".format(hosts=result.failed_hosts()))
+exit(0 if result.ok() else 1)
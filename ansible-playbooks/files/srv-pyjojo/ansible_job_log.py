@@ -0,0 +1,111 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Follow a background ansible job's output, by byte offset or as a tail
+# param: job_id - The job id returned when the job was submitted
+# param: lines - Without offset, how many trailing lines to return, default is 100
+# param: offset - Return output from this byte on, start at 0 then pass back next_offset
+# param: wait - With offset, long-poll up to this many seconds for new output. Max is 60.
+# http_method: get
+# lock: False
+# tags: Ansible, Jobs
+# -- jojo --
+
+from sys import stdout
+from common import ToolKit, Constants
+from common import ParamHandle as Param
+from jobs import JobStore
+
+# Spawn Instances
+p = Param()             # <class> Parameter manipulation
+toolkit = ToolKit()     # <class> Misc. functions
+params = p.list()       # <dict>   Input params list
+store = JobStore()      # <class> Background job store
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+sanitized_arguement = {} # The validated API params
+
+param = "job_id"
+job_id = Param()
+job_id.value = params[param]
+job_id.name = param
+job_id.max_length = Constants.POSTGRES_NAMEDATA_LEN
+job_id.require = True
+sanitized_arguement[param] = job_id.get()
+if not store.valid_id(sanitized_arguement[param]):
+    job_id.raise_error(keyname=param, value=sanitized_arguement[param],
+                       expected_msg="a job id")
+
+param = "lines"
+lines = Param()
+lines.value = params[param]
+lines.name = param
+lines.max_length = 6
+lines.default_value = str(Constants.JOBS_LOG_TAIL_LINES)
+sanitized_arguement[param] = lines.get()
+if not sanitized_arguement[param].isdigit():
+    lines.raise_error(keyname=param, value=sanitized_arguement[param],
+                      expected_msg="a number of lines")
+sanitized_arguement[param] = int(sanitized_arguement[param])
+
+param = "offset"
+offset = Param()
+offset.value = params[param]
+offset.name = param
+offset.max_length = 15
+offset.set_value_if_undefined(None, params[param])
+sanitized_arguement[param] = offset.get()
+if sanitized_arguement[param] is not None:
+    if not sanitized_arguement[param].isdigit():
+        offset.raise_error(keyname=param, value=sanitized_arguement[param],
+                           expected_msg="a byte offset")
+    sanitized_arguement[param] = int(sanitized_arguement[param])
+
+param = "wait"
+wait = Param()
+wait.value = params[param]
+wait.name = param
+wait.max_length = 3
+wait.default_value = "0"
+sanitized_arguement[param] = wait.get()
+if not sanitized_arguement[param].isdigit():
+    wait.raise_error(keyname=param, value=sanitized_arguement[param],
+                     expected_msg="a number of seconds")
+sanitized_arguement[param] = int(sanitized_arguement[param])
+
+
+# *************
+# *  RESULTS  *
+# *************
+if sanitized_arguement['offset'] is None:
+    job = store.load(sanitized_arguement['job_id'])
+else:
+    job = store.wait_output(sanitized_arguement['job_id'], sanitized_arguement['offset'],
+                            sanitized_arguement['wait'])
+if job is None:
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(error=['JOB_NOT_FOUND']))
+    toolkit.exit(1)
+
+finished = job['state'] in store.FINISHED
+if sanitized_arguement['offset'] is None:
+    for line in store.tail(job['id'], sanitized_arguement['lines']):
+        print(line)
+else:
+    data, next_offset = store.read_from(job['id'], sanitized_arguement['offset'],
+                                        whole_lines=not finished)
+    stdout.write(data)
+    if data and not data.endswith("\n"):
+        stdout.write("\n")
+    print("jojo_return_value next_offset={n}".format(n=next_offset))
+    print("jojo_return_value eof={eof}".format(
+        eof=finished and next_offset >= store.log_size(job['id'])))
+print("jojo_return_value job_state={state}".format(state=job['state']))
+print("jojo_return_value execution_status=ok")
+
+toolkit.exit(0)
@@ -0,0 +1,80 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Full output and exit code of a finished background ansible job
+# param: job_id - The job id returned when the job was submitted
+# param: wait - Long-poll up to this many seconds for the job to finish. Max is 60.
+# http_method: get
+# lock: False
+# tags: Ansible, Jobs
+# -- jojo --
+
+from sys import stdout
+from common import ToolKit, Constants
+from common import ParamHandle as Param
+from jobs import JobStore
+
+# Spawn Instances
+p = Param()             # <class> Parameter manipulation
+toolkit = ToolKit()     # <class> Misc. functions
+params = p.list()       # <dict>   Input params list
+store = JobStore()      # <class> Background job store
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+sanitized_arguement = {} # The validated API params
+
+param = "job_id"
+job_id = Param()
+job_id.value = params[param]
+job_id.name = param
+job_id.max_length = Constants.POSTGRES_NAMEDATA_LEN
+job_id.require = True
+sanitized_arguement[param] = job_id.get()
+if not store.valid_id(sanitized_arguement[param]):
+    job_id.raise_error(keyname=param, value=sanitized_arguement[param],
+                       expected_msg="a job id")
+
+param = "wait"
+wait = Param()
+wait.value = params[param]
+wait.name = param
+wait.max_length = 3
+wait.default_value = "0"
+sanitized_arguement[param] = wait.get()
+if not sanitized_arguement[param].isdigit():
+    wait.raise_error(keyname=param, value=sanitized_arguement[param],
+                     expected_msg="a number of seconds")
+sanitized_arguement[param] = int(sanitized_arguement[param])
+
+
+# *************
+# *  RESULTS  *
+# *************
+job = store.wait(sanitized_arguement['job_id'], sanitized_arguement['wait'])
+if job is None:
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(error=['JOB_NOT_FOUND']))
+    toolkit.exit(1)
+
+print("jojo_return_value job_state={state}".format(state=job['state']))
+if job['state'] not in store.FINISHED:
+    # Not done yet, poll again later.
+    print("jojo_return_value execution_status=pending")
+    toolkit.exit(0)
+
+store.copy_output(job['id'], stdout)
+print("jojo_return_value job_returncode={rc}".format(rc=job['returncode']))
+if job['state'] == "succeeded":
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+else:
+    print("jojo_return_value execution_status=failed")
+    print("jojo_return_value error_reason_indicator={error}".format(error=['ANSIBLE_JOB_FAILED']))
+    exitcode = 1
+
+toolkit.exit(exitcode)
@@ -0,0 +1,67 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Packages two inventory hosts disagree on (missing on one side or other versions), from the pkgindex.py package index
+# param: host - Inventory host to compare
+# param: other - Inventory host to compare it with
+# http_method: get
+# lock: False
+# tags: Ansible, Packages
+# -- jojo --
+
+from sys import stdout
+from json import dumps
+from common import ToolKit, Constants, ParamSchema
+from pkgindex import PackageIndex
+
+# Spawn Instances
+toolkit = ToolKit()               # <class> Misc. functions
+index = PackageIndex()            # <class> The package index
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+schema = ParamSchema.compile("ansible_package_diff", [
+    {'name': "host", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH, 'require': True,
+     'unquote': True, 'sanitizer': "host_pattern"},
+    {'name': "other", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH, 'require': True,
+     'unquote': True, 'sanitizer': "host_pattern"},
+])
+sanitized_arguement = schema.validate() # The validated API params
+host, other = sanitized_arguement['host'], sanitized_arguement['other']
+
+
+# **********************
+# *  OUTPUT PROCESSOR  *
+# **********************
+# One JSON object per package, with the versions on either host (null
+#  where it is not installed).
+indexed = dict((h['host'], h) for h in index.hosts() if h['collected'])
+error_hint = [name for name in (host, other) if name not in indexed]
+if not error_hint:
+    differences = index.diff(host, other)
+    for row in differences:
+        print(dumps(row))
+    stdout.flush()
+    print("jojo_return_value differences={n}".format(n=len(differences)))
+    print("jojo_return_value only_on_host={n}".format(
+        n=len([row for row in differences if row[other] is None])))
+    print("jojo_return_value only_on_other={n}".format(
+        n=len([row for row in differences if row[host] is None])))
+
+# Report Output
+if not error_hint:
+    # We good
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+else:
+    # Errors should flag an API error code.
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator=HOST_NOT_INDEXED")
+    print("jojo_return_value hosts_not_indexed={h}".format(h=error_hint))
+    exitcode = 1
+
+toolkit.exit(exitcode)
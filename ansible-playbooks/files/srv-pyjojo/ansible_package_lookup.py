@@ -0,0 +1,78 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Installed versions of a package on every inventory host, answered from the pkgindex.py package index without running a playbook
+# param: package - The package to look up, EXAMPLE: openssl
+# param: host - OPTIONAL: only this inventory host
+# param: version - OPTIONAL: only hosts whose package compares to this [epoch:]version[-release], EXAMPLE: 1.0.2k-16.el7
+# param: compare - How installed versions compare to version: lt (default), le, eq, ge or gt
+# http_method: get
+# lock: False
+# tags: Ansible, Packages
+# -- jojo --
+
+from sys import stdout
+from json import dumps
+from time import time
+from common import ToolKit, Constants, ParamSchema
+from common import ParamHandle as Param
+from pkgindex import PackageIndex, RpmVersion
+
+# Spawn Instances
+toolkit = ToolKit()               # <class> Misc. functions
+index = PackageIndex()            # <class> The package index
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+schema = ParamSchema.compile("ansible_package_lookup", [
+    {'name': "package", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH, 'require': True,
+     'pattern': r"[A-Za-z0-9._+\-]+", 'expected': "a package name"},
+    {'name': "host", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH,
+     'unquote': True, 'sanitizer': "host_pattern"},
+    {'name': "version", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH, 'unquote': True,
+     'pattern': r"(?:\d+:)?[A-Za-z0-9._+~^]+(?:-[A-Za-z0-9._+~^]+)?",
+     'expected': "[epoch:]version[-release]"},
+    {'name': "compare", 'max_length': 2, 'default': "lt",
+     'pattern': "lt|le|eq|ge|gt", 'expected': "lt, le, eq, ge or gt"},
+])
+sanitized_arguement = schema.validate() # The validated API params
+
+spec = None
+if sanitized_arguement['version'] is not None:
+    spec = RpmVersion().parse(sanitized_arguement['version'])
+    if spec is None:
+        Param().raise_error(keyname='version', value=sanitized_arguement['version'],
+                            expected_msg="[epoch:]version[-release]")
+
+
+# **********************
+# *  OUTPUT PROCESSOR  *
+# **********************
+# One JSON object per host and installed arch.
+if spec is not None:
+    rows = index.matching(sanitized_arguement['package'], sanitized_arguement['compare'], spec)
+else:
+    rows = index.versions(sanitized_arguement['package'])
+if sanitized_arguement['host'] is not None:
+    rows = [row for row in rows if row['host'] == sanitized_arguement['host']]
+for row in rows:
+    row['label'] = index.label(row)
+    print(dumps(row))
+stdout.flush()
+
+hosts = index.hosts()
+collected = [h['collected'] for h in hosts if h['collected']]
+print("jojo_return_value hosts_matched={n}".format(n=len(set(row['host'] for row in rows))))
+print("jojo_return_value hosts_indexed={n}".format(n=len(collected)))
+print("jojo_return_value hosts_failing={n}".format(n=len([h for h in hosts if h['error']])))
+if collected:
+    print("jojo_return_value oldest_collection_age={s:.0f}".format(s=time() - min(collected)))
+
+# Report Output
+# We good
+print("jojo_return_value execution_status=ok")
+toolkit.exit(0)
@@ -0,0 +1,59 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Collect the installed packages of one host (or pattern) into the pkgindex.py package index now, instead of waiting for the hourly run
+# param: host - Inventory host or ansible host pattern, EXAMPLE: db-n01.dev
+# http_method: post
+# lock: False
+# admission: ansible
+# tags: Ansible, Packages
+# -- jojo --
+
+from common import ToolKit, Constants, ParamSchema
+from pkgindex import PackageCollector
+
+# Spawn Instances
+toolkit = ToolKit()               # <class> Misc. functions
+collector = PackageCollector()    # <class> Fills the package index
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+schema = ParamSchema.compile("ansible_package_refresh", [
+    {'name': "host", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH, 'require': True,
+     'unquote': True, 'sanitizer': "host_pattern"},
+])
+sanitized_arguement = schema.validate() # The validated API params
+
+
+# *****************
+# *  RUN ANSIBLE  *
+# *****************
+outcome = collector.collect(limit=sanitized_arguement['host'])
+
+
+# **********************
+# *  OUTPUT PROCESSOR  *
+# **********************
+print("jojo_return_value stored={h}".format(h=outcome['stored']))
+print("jojo_return_value failed={h}".format(h=outcome['failed']))
+
+# Report Output
+if not outcome['error'] and not outcome['failed']:
+    # We good
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+else:
+    # Errors should flag an API error code.
+    if outcome['stored']:
+        print("jojo_return_value execution_status=partial")
+    else:
+        print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=outcome['error'] or "HOSTS_NOT_COLLECTED"))
+    exitcode = 1
+
+toolkit.exit(exitcode)
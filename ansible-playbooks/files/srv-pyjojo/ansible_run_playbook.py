@@ -38,352 +38,86 @@
 # param: ask_sudo_pass -  When true, ask for sudo password (deprecated, use become)
 # param: ask_su_pass -  When true, ask for su password (deprecated, use become)
 # param: ask_become_pass -  When true, ask for privilege escalation password
+# param: async - When true, queue the run and return a job id right away
 # http_method: post
 # lock: False
+# admission: ansible
 # -- jojo --
 
-from os import linesep
-from common import Sanitize, CmdRun
+from pipes import quote
+from common import CmdRun, ParamSchema
 from common import ToolKit, Constants
-from common import ParamHandle as Param
 
 
 # Spawn Instances
-p = Param()                       # <class> Parameter manipulation
-real_escape_string = Sanitize()   # <class> Escape Routines
 toolkit = ToolKit()               # <class> Misc. functions
-params = p.list()                 # <dict>   Input params list
 run = CmdRun()                    # <class> Runs the query
 
 
 # ************************************
 # *  DEFINE PARAMETERS AND VALIDATE  *
 # ************************************
-sanitized_arguement = {} # The actual API params we pass to psql
-
-param = "playbook"
-playbook = Param()
-playbook.value = params[param]
-playbook.name = param
-playbook.max_length = Constants.LINUX_MAX_FILE_PATH_LENGTH
-playbook.require = True
-sanitized_arguement[param] = playbook.get()
-
-param = "ask_valt_pass"
-ask_valt_pass = Param()
-ask_valt_pass.value = params[param]
-ask_valt_pass.name = param
-ask_valt_pass.max_length = 6
-ask_valt_pass.set_value_if_defined("--ask_valt_pass",custom_else_value="")
-sanitized_arguement[param] = ask_valt_pass.get()
-
-param = "check"
-check = Param()
-check.value = params[param]
-check.name = param
-check.max_length = 6
-ask_valt_pass.set_value_if_defined("--check",custom_else_value="")
-sanitized_arguement[param] = check.get()
-
-param = "diff"
-diff = Param()
-diff.value = params[param]
-diff.name = param
-diff.max_length = 6
-ask_valt_pass.set_value_if_defined("--diff",custom_else_value="")
-sanitized_arguement[param] = diff.get()
-
-param = "diff"
-diff = Param()
-diff.value = params[param]
-diff.name = param
-diff.max_length = 6
-ask_valt_pass.set_value_if_defined("--diff",custom_else_value="")
-sanitized_arguement[param] = diff.get()
-
-param = "extra_vars"
-extra_vars = Param()
-extra_vars.value = params[param]
-extra_vars.name = param
-extra_vars.max_length = 6
-ask_valt_pass.set_value_if_defined("--extra_vars",custom_else_value="")
-sanitized_arguement[param] = extra_vars.get()
-
-param = "flush_cache"
-flush_cache = Param()
-flush_cache.value = params[param]
-flush_cache.name = param
-flush_cache.max_length = 6
-ask_valt_pass.set_value_if_defined("--flush_cache",custom_else_value="")
-sanitized_arguement[param] = flush_cache.get()
-
-param = "force_handlers"
-value_when_true = " --force_handlers {z} ".format(z=params[param])
-value_when_false = ""
-force_handlers = Param()
-force_handlers.value = params[param]
-force_handlers.name = param
-force_handlers.max_length = Constants.POSTGRES_NAMEDATA_LEN
-force_handlers.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = force_handlers.get()
-
-param = "forks"
-value_when_true = " --forks {z} ".format(z=params[param])
-value_when_false = ""
-forks = Param()
-forks.value = params[param]
-forks.name = param
-forks.max_length = Constants.POSTGRES_NAMEDATA_LEN
-forks.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = forks.get()
-
-param = "help"
-helpflg = Param()
-helpflg.value = params[param]
-helpflg.name = param
-helpflg.max_length = 6
-ask_valt_pass.set_value_if_defined("--help",custom_else_value="")
-sanitized_arguement[param] = helpflg.get()
-
-param = "inventory_file"
-value_when_true = " --inventory_file {z} ".format(z=params[param])
-value_when_false = ""
-inventory_file = Param()
-inventory_file.value = params[param]
-inventory_file.name = param
-inventory_file.max_length = Constants.POSTGRES_NAMEDATA_LEN
-inventory_file.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = inventory_file.get()
-
-param = "limit"
-value_when_true = ' --limit \"{z}\" '.format(z=params[param])
-value_when_false = ""
-limit = Param()
-limit.value = params[param]
-limit.name = param
-limit.max_length = Constants.POSTGRES_NAMEDATA_LEN
-limit.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = limit.get()
-
-param = "list_tasks"
-list_tasks = Param()
-list_tasks.value = params[param]
-list_tasks.name = param
-list_tasks.max_length = 6
-ask_valt_pass.set_value_if_defined("--list_tasks",custom_else_value="")
-sanitized_arguement[param] = list_tasks.get()
-
-param = "list_tags"
-list_tags = Param()
-list_tags.value = params[param]
-list_tags.name = param
-list_tags.max_length = 6
-ask_valt_pass.set_value_if_defined("--list_tags",custom_else_value="")
-sanitized_arguement[param] = list_tags.get()
-
-param = "help"
-list_hosts = Param()
-list_hosts.value = params[param]
-list_hosts.name = param
-list_hosts.max_length = 6
-ask_valt_pass.set_value_if_defined("--list_hosts",custom_else_value="")
-sanitized_arguement[param] = list_hosts.get()
-
-param = "new_vault_password"
-value_when_true = " --new_vault_password {z} ".format(z=params[param])
-value_when_false = ""
-new_vault_password = Param()
-new_vault_password.value = params[param]
-new_vault_password.name = param
-new_vault_password.max_length = Constants.POSTGRES_NAMEDATA_LEN
-new_vault_password.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = new_vault_password.get()
-
-param = "output"
-value_when_true = " --output {z} ".format(z=params[param])
-value_when_false = ""
-output = Param()
-output.value = params[param]
-output.name = param
-output.max_length = Constants.POSTGRES_NAMEDATA_LEN
-output.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = output.get()
-
-param = "skip_tags"
-value_when_true = " --skip_tags {z} ".format(z=params[param])
-value_when_false = ""
-skip_tags = Param()
-skip_tags.value = params[param]
-skip_tags.name = param
-skip_tags.max_length = Constants.POSTGRES_NAMEDATA_LEN
-skip_tags.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = skip_tags.get()
-
-param = "vault_password_file"
-value_when_true = " --vault_password_file {z} ".format(z=params[param])
-value_when_false = ""
-vault_password_file = Param()
-vault_password_file.value = params[param]
-vault_password_file.name = param
-vault_password_file.max_length = Constants.POSTGRES_NAMEDATA_LEN
-vault_password_file.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = vault_password_file.get()
-
-param = "verbose"
-verbose = Param()
-verbose.value = params[param]
-verbose.name = param
-verbose.max_length = 6
-ask_valt_pass.convert_to_bool(
-  custom_whentrue_value=" -v ",
-  custom_whenfalse_value="",
-  custom_badinput_value=" -vvvv "
-  )
-sanitized_arguement[param] = verbose.get()
-
-param = "version"
-version = Param()
-version.value = params[param]
-version.name = param
-version.max_length = 6
-version.set_value_if_defined("--version",custom_else_value="")
-sanitized_arguement[param] = version.get()
-
-param = "ask_pass"
-ask_pass = Param()
-ask_pass.value = params[param]
-ask_pass.name = param
-ask_pass.max_length = 6
-ask_pass.set_value_if_defined("--ask_pass",custom_else_value="")
-sanitized_arguement[param] = ask_pass.get()
-
-param = "private_key"
-value_when_true = " --private_key {z} ".format(z=params[param])
-value_when_false = ""
-private_key = Param()
-private_key.value = params[param]
-private_key.name = param
-private_key.max_length = Constants.POSTGRES_NAMEDATA_LEN
-private_key.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = private_key.get()
-
-param = "user"
-value_when_true = " --connection {z} ".format(z=params[param])
-value_when_false = ""
-user = Param()
-user.value = params[param]
-user.name = param
-user.max_length = Constants.POSTGRES_NAMEDATA_LEN
-user.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = user.get()
-
-param = "user"
-value_when_true = " --user {z} ".format(z=params[param])
-value_when_false = ""
-connection = Param()
-connection.value = params[param]
-connection.name = param
-connection.max_length = Constants.POSTGRES_NAMEDATA_LEN
-connection.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = connection.get()
-
-param = "timeout"
-value_when_true = " --timeout {z} ".format(z=params[param])
-value_when_false = ""
-timeout = Param()
-timeout.value = params[param]
-timeout.name = param
-timeout.max_length = Constants.POSTGRES_NAMEDATA_LEN
-timeout.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = timeout.get()
-
-param = "sudo"
-value_when_true = " --sudo {z} ".format(z=params[param])
-value_when_false = ""
-sudo = Param()
-sudo.value = params[param]
-sudo.name = param
-sudo.max_length = Constants.POSTGRES_NAMEDATA_LEN
-sudo.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = sudo.get()
-
-param = "sudo_user"
-value_when_true = " --sudo_user {z} ".format(z=params[param])
-value_when_false = ""
-sudo_user = Param()
-sudo_user.value = params[param]
-sudo_user.name = param
-sudo_user.max_length = Constants.POSTGRES_NAMEDATA_LEN
-sudo_user.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = sudo_user.get()
-
-param = "su"
-value_when_true = " --su {z} ".format(z=params[param])
-value_when_false = ""
-su = Param()
-su.value = params[param]
-su.name = param
-su.max_length = Constants.POSTGRES_NAMEDATA_LEN
-su.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = su.get()
-
-param = "ask_pass"
-ask_pass = Param()
-ask_pass.value = params[param]
-ask_pass.name = param
-ask_pass.max_length = 6
-ask_pass.set_value_if_defined("--ask_pass",custom_else_value="")
-sanitized_arguement[param] = ask_pass.get()
-
-param = "become"
-become = Param()
-become.value = params[param]
-become.name = param
-become.max_length = 6
-become.set_value_if_defined("--become",custom_else_value="")
-sanitized_arguement[param] = become.get()
-
-param = "become"
-become = Param()
-become.value = params[param]
-become.name = param
-become.max_length = 6
-become.set_value_if_defined("--become",custom_else_value="")
-sanitized_arguement[param] = become.get()
-
-param = "become_method"
-value_when_true = " --become_method {z} ".format(z=params[param])
-value_when_false = ""
-become_method = Param()
-become_method.value = params[param]
-become_method.name = param
-become_method.max_length = Constants.POSTGRES_NAMEDATA_LEN
-become_method.set_value_if_defined(value_when_true, value_when_false)
-sanitized_arguement[param] = become_method.get()
-
-param = "ask_sudo_pass"
-ask_sudo_pass = Param()
-ask_sudo_pass.value = params[param]
-ask_sudo_pass.name = param
-ask_sudo_pass.max_length = 6
-ask_valt_pass.set_value_if_defined("--ask_sudo_pass",custom_else_value="")
-sanitized_arguement[param] = ask_sudo_pass.get()
-
-param = "ask_su_pass"
-ask_su_pass = Param()
-ask_su_pass.value = params[param]
-ask_su_pass.name = param
-ask_su_pass.max_length = 6
-ask_su_pass.set_value_if_defined("--ask_su_pass",custom_else_value="")
-sanitized_arguement[param] = ask_su_pass.get()
-
-param = "ask_become_pass"
-ask_become_pass = Param()
-ask_become_pass.value = params[param]
-ask_become_pass.name = param
-ask_become_pass.max_length = 6
-ask_become_pass.set_value_if_defined("--ask_become_pass",custom_else_value="")
-sanitized_arguement[param] = ask_become_pass.get()
+# API parameter -> ansible-playbook switch, set when the parameter is true.
+ANSIBLE_SWITCHES = [
+    ("ask_valt_pass", "--ask-vault-pass"),
+    ("check", "--check"),
+    ("diff", "--diff"),
+    ("flush_cache", "--flush-cache"),
+    ("force_handlers", "--force-handlers"),
+    ("help", "--help"),
+    ("list_tasks", "--list-tasks"),
+    ("list_tags", "--list-tags"),
+    ("list_hosts", "--list-hosts"),
+    ("version", "--version"),
+    ("ask_pass", "--ask-pass"),
+    ("sudo", "--sudo"),
+    ("su", "--su"),
+    ("become", "--become"),
+    ("ask_sudo_pass", "--ask-sudo-pass"),
+    ("ask_su_pass", "--ask-su-pass"),
+    ("ask_become_pass", "--ask-become-pass"),
+]
+
+# API parameter -> ansible-playbook option taking the parameter's value.
+ANSIBLE_OPTIONS = [
+    ("extra_vars", "--extra-vars"),
+    ("forks", "--forks"),
+    ("inventory_file", "--inventory-file"),
+    ("limit", "--limit"),
+    ("new_vault_password", "--new-vault-password-file"),
+    ("output", "--output"),
+    ("skip_tags", "--skip-tags"),
+    ("vault_password_file", "--vault-password-file"),
+    ("private_key", "--private-key"),
+    ("user", "--user"),
+    ("conection", "--connection"),
+    ("timeout", "--timeout"),
+    ("sudo_user", "--sudo-user"),
+    ("become_method", "--become-method"),
+    ("become_user", "--become-user"),
+]
+
+# Values are unquoted from pyjojo's shell quoting, checked as sent and
+#  quoted again, once, for the ansible-playbook command line.
+specs = [
+    {'name': "playbook", 'max_length': Constants.LINUX_MAX_FILE_PATH_LENGTH, 'require': True,
+     'unquote': True},
+    # true is -v, anything that is neither true nor false is -vvvv (debug)
+    {'name': "verbose", 'type': "bool", 'max_length': 6,
+     'when_true': "-v", 'when_false': None, 'when_bad': "-vvvv"},
+    {'name': "async", 'type': "bool", 'max_length': 6},  # Not an ansible option
+]
+specs += [{'name': name, 'type': "bool", 'max_length': 6} for name, _ in ANSIBLE_SWITCHES]
+for name, _ in ANSIBLE_OPTIONS:
+    spec = {'name': name, 'max_length': Constants.LINUX_MAX_FILE_PATH_LENGTH, 'unquote': True,
+            'sanitizer': "sql"}
+    if name == "extra_vars":
+        # CmdRun.ansible() wraps extra vars in single quotes, they cannot hold one.
+        spec.update(pattern=r"[^']*", expected="a quote free")
+    specs.append(spec)
+
+schema = ParamSchema.compile("ansible_run_playbook", specs)
+sanitized_arguement = schema.validate() # The validated API params
 
 
 # ****************************
@@ -392,21 +126,47 @@ sanitized_arguement[param] = ask_become_pass.get()
 # This will set or override the options inputted by the API user.
 # Special (non arguements) include:
 #  - ansible_opts['playbook'] which is the path to the playbook file
-
-sanitized_arguement['--limit'] = '\"vagrant\"'
-sanitized_arguement['--inventory-file'] = '/opt/playbooks/ansible-hosts'
-sanitized_arguement['--user'] = 'vagrant'
+#  - ansible_opts['append_args'] which value should include any appendable arg like -vvvv
+ansible_opts = {'playbook': quote(sanitized_arguement['playbook'])}
+if sanitized_arguement['verbose']:
+    ansible_opts['append_args'] = sanitized_arguement['verbose']
+for name, switch in ANSIBLE_SWITCHES:
+    if sanitized_arguement[name]:
+        ansible_opts[switch] = switch
+for name, option in ANSIBLE_OPTIONS:
+    if sanitized_arguement[name] is not None:
+        value = sanitized_arguement[name]
+        ansible_opts[option] = value if option == "--extra-vars" else quote(value)
+
+ansible_opts['--limit'] = '\"vagrant\"'
+ansible_opts['--inventory-file'] = '/opt/playbooks/ansible-hosts'
+ansible_opts['--user'] = 'vagrant'
 
 
 # *****************
 # *  RUN ANSIBLE  *
 # *****************
-output = run.ansible(sanitized_arguement)
+if sanitized_arguement['async']:
+    # Poll ansible_job_status / ansible_job_log / ansible_job_result
+    job = run.ansible_job(ansible_opts)
+    print("jojo_return_value job_id={id}".format(id=job['id']))
+    print("jojo_return_value job_state={state}".format(state=job['state']))
+    exit(0)
+result = run.ansible_run(ansible_opts, sink=run.echo)  # Streamed to STDOUT as it runs
 
 
 # *************
 # *  RESULTS  *
 # *************
-print(output)
 print("jojo_return_value ansible_options={opt}".format(opt=ansible_opts))
-exit(0)
+print("jojo_return_value ansible_returncode={rc}".format(rc=result.returncode))
+if result.ok():
+    print("jojo_return_value execution_status=ok")
+    exit(0)
+print("jojo_return_value execution_status=rollback")
+if result.structured:
+    # Only the executor knows which hosts, ansible-playbook output is text.
+    print("jojo_return_value failed_hosts={hosts}".format(hosts=result.failed_hosts()))
+if result.error:
+    print("jojo_return_value error_reason_indicator={error}".format(error=[result.error]))
+exit(1)
@@ -0,0 +1,362 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Resident Ansible executor for CmdRun.ansible().
+#
+#   /bin/python /srv/pyjojo/ansibled.py serve
+#
+#  Without `serve` it just quits, this file lives next to the scripts
+#  pyjojo exposes and must not start a second executor by accident.
+#
+#  ansible-playbook pays for importing Ansible, loading its plugins and
+#  parsing the inventory on every call, usually far longer than the
+#  playbook itself takes. The executor does that once. Every request is
+#  then served by a fork of the warm process, so a play can mutate the
+#  inventory and variable manager (add_host, set_fact, ...) without the
+#  next request seeing it, and several playbooks can run at once.
+#
+#  Scripts send one JSON line describing the run and read back one JSON
+#  line per event while it goes:
+#
+#   {"event": "task", "play": ..., "task": ..., "host": ..., "status": "ok", "result": {...}}
+#   {"event": "done", "returncode": 0, "stats": {"<host>": {"ok": 2, ...}}}
+#
+#  SSH connections go through the shared sshpool.py control sockets.
+#  Inventories are reloaded whenever a file under them changes. Ansible
+#  2.4 or newer is needed, with anything older (or the daemon down) the
+#  client returns None and CmdRun falls back to forking ansible-playbook.
+
+from __future__ import print_function
+from os import path, unlink, chmod, walk
+from sys import argv
+from json import dumps, loads
+from collections import namedtuple
+import socket
+import SocketServer
+
+from common import Constants, ToolKit
+from sshpool import SshPool
+
+if __name__ == "__main__":
+    SshPool().export()  # Ansible reads its settings when imported.
+
+try:
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.inventory.manager import InventoryManager
+    from ansible.vars.manager import VariableManager
+    from ansible.executor.playbook_executor import PlaybookExecutor
+    from ansible.plugins.callback import CallbackBase
+    from ansible.plugins.loader import module_loader, connection_loader, strategy_loader
+except ImportError:
+    PlaybookExecutor = None
+    CallbackBase = object
+
+try:
+    from ansible import context                 # 2.8+ reads options from here
+    from ansible.module_utils.common.collections import ImmutableDict
+except ImportError:
+    context = None
+
+
+class EventCallback(CallbackBase):
+    """
+    CLASS: Stdout callback that writes every task result to the client
+           as a JSON line instead of formatting it for a terminal.
+    """
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'stdout'
+    CALLBACK_NAME = 'pyjojo_events'
+
+    def __init__(self, emit):
+        super(EventCallback, self).__init__()
+        self.emit = emit
+        self.play = None
+        self.task = None
+
+    def v2_playbook_on_play_start(self, play):
+        self.play = play.get_name().strip()
+        self.emit({'event': "play", 'play': self.play})
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.task = task.get_name().strip()
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.task = task.get_name().strip()
+
+    def result(self, status, result):
+        self.emit({'event': "task", 'play': self.play, 'task': self.task,
+                   'host': result._host.get_name(), 'status': status,
+                   'result': self.trim(result._result)})
+
+    def trim(self, result):
+        """
+        :return <dict>: the module result without Ansible's bookkeeping
+        """
+        return dict((k, v) for k, v in result.items()
+                    if k != "invocation" and not k.startswith("_ansible"))
+
+    def v2_runner_on_ok(self, result):
+        self.result("changed" if result._result.get('changed') else "ok", result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.result("ignored" if ignore_errors else "failed", result)
+
+    def v2_runner_on_unreachable(self, result):
+        self.result("unreachable", result)
+
+    def v2_runner_on_skipped(self, result):
+        self.result("skipped", result)
+
+    def v2_runner_item_on_failed(self, result):
+        self.result("failed", result)
+
+
+class Inventories():
+    """
+    CLASS: Parsed inventories and their variable managers, kept in the
+           parent process and reloaded when a file under them changes.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.cache = {}
+
+    def stamp(self, source):
+        """
+        :param source: <STR> inventory file or directory
+        :return <FLOAT>: newest mtime under it, None if it is missing
+        """
+        if not path.exists(source):
+            return None
+        newest = path.getmtime(source)
+        for root, dirs, files in walk(source):
+            for name in dirs + files:
+                try:
+                    newest = max(newest, path.getmtime(path.join(root, name)))
+                except OSError:
+                    pass
+        return newest
+
+    def load(self, source):
+        inventory = InventoryManager(loader=self.loader, sources=[source])
+        variables = VariableManager(loader=self.loader, inventory=inventory)
+        self.cache[source] = (self.stamp(source), inventory, variables)
+
+    def refresh(self):
+        """
+        Reload what changed. An inventory that no longer parses keeps
+        being served as it was.
+        """
+        for source, cached in self.cache.items():
+            if self.stamp(source) != cached[0]:
+                try:
+                    self.load(source)
+                except Exception as e:
+                    ToolKit().print_stderr("inventory {s} not reloaded: {e}".format(s=source, e=e))
+
+    def get(self, source):
+        """
+        :return <tuple>: (InventoryManager, VariableManager)
+        """
+        if source not in self.cache:
+            self.load(source)
+        return self.cache[source][1:]
+
+
+class PlaybookRunner():
+    """
+    CLASS: Runs one playbook with the warm loader and inventories. Only
+           ever called in a forked child, it is free to mutate them.
+    """
+    # What PlaybookExecutor and PlayContext read from the command line.
+    OPTIONS = {'connection': "smart", 'module_path': None, 'forks': Constants.ANSIBLED_FORKS,
+               'remote_user': None, 'private_key_file': None, 'ssh_common_args': None,
+               'ssh_extra_args': None, 'sftp_extra_args': None, 'scp_extra_args': None,
+               'become': False, 'become_method': "sudo", 'become_user': None,
+               'check': False, 'diff': False, 'syntax': False, 'listhosts': False,
+               'listtasks': False, 'listtags': False, 'start_at_task': None,
+               'tags': ("all",), 'skip_tags': (), 'verbosity': 0, 'timeout': 10,
+               'subset': None, 'extra_vars': ()}
+
+    def __init__(self, loader, inventories):
+        self.loader = loader
+        self.inventories = inventories
+
+    def options(self, request):
+        options = dict(self.OPTIONS)
+        for key in ("remote_user", "become", "become_user", "check", "diff", "verbosity"):
+            if request.get(key) is not None:
+                options[key] = request[key]
+        for key in ("tags", "skip_tags"):
+            if request.get(key):
+                options[key] = tuple(request[key])
+        if request.get('forks'):
+            options['forks'] = request['forks']
+        options['subset'] = request.get('limit')
+        if context is not None:
+            context.CLIARGS = ImmutableDict(options)
+            return None
+        return namedtuple("Options", options.keys())(**options)
+
+    def run(self, request, emit):
+        """
+        :param request: <dict> playbook, inventory, limit, extra_vars, ...
+        :param emit: <FUNCTION> called with every event dict
+        :return <dict>: the closing event
+        """
+        playbook = request['playbook']
+        if not path.isfile(playbook):
+            return {'event': "done", 'returncode': 1, 'error': "PLAYBOOK_NOT_FOUND"}
+        options = self.options(request)
+        inventory, variables = self.inventories.get(
+            request.get('inventory') or Constants.ANSIBLED_INVENTORY)
+        if context is not None:
+            variables._extra_vars = request.get('extra_vars') or {}
+        else:
+            variables.extra_vars = request.get('extra_vars') or {}
+        if request.get('limit'):
+            inventory.subset(request['limit'])
+        if not inventory.list_hosts():
+            return {'event': "done", 'returncode': 1, 'error': "NO_HOSTS_MATCHED"}
+
+        if options is None:
+            executor = PlaybookExecutor(playbooks=[playbook], inventory=inventory,
+                                        variable_manager=variables, loader=self.loader,
+                                        passwords={})
+        else:
+            executor = PlaybookExecutor(playbooks=[playbook], inventory=inventory,
+                                        variable_manager=variables, loader=self.loader,
+                                        options=options, passwords={})
+        executor._tqm._stdout_callback = EventCallback(emit)
+        returncode = executor.run()
+
+        stats = executor._tqm._stats
+        summary = dict((host, stats.summarize(host)) for host in sorted(stats.processed))
+        return {'event': "done", 'returncode': returncode, 'stats': summary}
+
+    def preload(self):
+        """
+        Find the plugins nearly every playbook needs now, rather than in
+        every child.
+        """
+        for module in Constants.ANSIBLED_PRELOAD_MODULES:
+            module_loader.find_plugin(module)
+        connection_loader.get("ssh", class_only=True)
+        connection_loader.get("local", class_only=True)
+        strategy_loader.get("linear", class_only=True)
+
+
+class ExecutorRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    CLASS: One JSON line in, one JSON line per event out, always ending
+           with a "done" event.
+    """
+
+    def handle(self):
+        try:
+            request = loads(self.rfile.readline())
+            request['playbook']
+        except (ValueError, KeyError, TypeError):
+            return self.emit({'event': "done", 'returncode': 1, 'error': "BAD_REQUEST"})
+        try:
+            done = self.server.runner.run(request, self.emit)
+        except Exception as e:
+            done = {'event': "done", 'returncode': 1, 'error': "EXECUTOR_FAILED",
+                    'detail': "{t}: {e}".format(t=type(e).__name__, e=e)}
+        self.emit(done)
+
+    def emit(self, event):
+        self.wfile.write(dumps(event, default=str) + "\n")
+        self.wfile.flush()
+
+
+class ExecutorServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    """
+    CLASS: Forking unix socket front end. The parent only accepts and
+           forks, so the warm state it holds never changes under a run.
+    """
+    max_children = Constants.ANSIBLED_MAX_CHILDREN
+
+    def __init__(self, socket_path, runner):
+        if path.exists(socket_path):
+            unlink(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, ExecutorRequestHandler)
+        chmod(socket_path, 0660)
+        self.runner = runner
+
+    def verify_request(self, request, client_address):
+        # Runs in the parent before each fork, children inherit the result.
+        self.runner.inventories.refresh()
+        return True
+
+
+class ExecutorClient():
+    """
+    CLASS: What CmdRun talks to. run() returns None when the executor
+           is not reachable so callers can fall back to ansible-playbook.
+    """
+
+    def __init__(self, socket_path=Constants.ANSIBLED_SOCKET,
+                 timeout=Constants.ANSIBLED_CONNECT_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def run(self, request, sink=None):
+        """
+        :param request: <dict> see PlaybookRunner.run()
+        :param sink: <FUNCTION> called with every event dict as it arrives
+        :return <list>: every event, the "done" one last, or None
+        """
+        if not path.exists(self.socket_path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        events = []
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall(dumps(request) + "\n")
+            # Tasks can take as long as they like once the run started.
+            sock.settimeout(None)
+            for line in sock.makefile('rb'):
+                event = loads(line)
+                events.append(event)
+                if sink:
+                    sink(event)
+                if event['event'] == "done":
+                    break
+        except (socket.error, socket.timeout, ValueError):
+            if not events:
+                return None
+            events.append({'event': "done", 'returncode': 1, 'error': "EXECUTOR_LOST"})
+        finally:
+            sock.close()
+        if not events:
+            return None
+        if events[-1]['event'] != "done":
+            events.append({'event': "done", 'returncode': 1, 'error': "EXECUTOR_LOST"})
+        return events
+
+
+if __name__ == "__main__":
+    if argv[1:] != ["serve"]:
+        # Just quit.
+        exit(0)
+    toolkit = ToolKit()
+    if PlaybookExecutor is None:
+        toolkit.print_stderr("ansibled requires Ansible 2.4 or newer (pip install ansible)")
+        exit(1)
+    loader = DataLoader()
+    runner = PlaybookRunner(loader, Inventories(loader))
+    runner.preload()
+    runner.inventories.get(Constants.ANSIBLED_INVENTORY)
+    server = ExecutorServer(Constants.ANSIBLED_SOCKET, runner)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        unlink(Constants.ANSIBLED_SOCKET)
@@ -5,14 +5,132 @@
 # License Apache Commons v2
 
 from __future__ import print_function      # for print_stderr
-from sys import stderr                     # for print_stderr
+import sys                                 # for print_stderr
 from os import environ as env              # for paramaters
 from os import chmod, chown, unlink        # for tempfile
+from os import path                        # for result cache
 from tempfile import NamedTemporaryFile    # for tempfile
 from pwd import getpwnam                   # for tempfile
 from subprocess import Popen, PIPE, STDOUT  # for command runs
 from pwd import getpwnam                   # for tempfile
+from json import loads, dumps              # for sql results
+from collections import OrderedDict        # for sql results
+from collections import deque              # for streamed runs
+import threading                           # for sql streams
+import atexit                              # for instrumentation
+from time import time                      # for instrumentation
+from resource import getrusage, RUSAGE_CHILDREN  # for instrumentation
 import re as regex                         # for eval sanitize
+import shlex                               # for ansible runs
+
+
+class Instrument():
+    """
+    CLASS: Hot path timing. instrumented() methods record a sample per
+           call (wall time, CPU and peak RSS of the children reaped
+           meanwhile, exit code of the command run), the samples are kept
+           in memory and merged into jojometrics.MetricStore in one go
+           when the process exits, so the hot path never touches disk.
+    """
+    samples = []
+    registered = False
+    local = threading.local()   # last child exit code, per thread
+    main_thread = threading.current_thread()   # the only one rusage deltas mean anything in
+    started = time()            # the running script's start, jojod resets it per request
+    paused = False              # the running script asked not to be recorded
+
+    @classmethod
+    def enabled(cls):
+        """
+        :return <BOOL>: whether the running script is being recorded
+        """
+        return Constants.METRICS_ENABLED and not cls.paused
+
+    @classmethod
+    def begin(cls):
+        """
+        A script starts running in this (possibly long lived) process.
+        """
+        cls.started = time()
+        cls.paused = False
+
+    @classmethod
+    def pause(cls):
+        """
+        Record nothing more for the running script, only.
+        """
+        cls.paused = True
+
+    @classmethod
+    def record(cls, phase, wall, cpu=0.0, rss=0, code=None, script=None):
+        """
+        :param phase: <STR> EXAMPLE: "sql"
+        :param wall: <FLOAT> seconds
+        :param cpu: <FLOAT> child user+system seconds
+        :param rss: <INT> child peak RSS in KB
+        :param code: <INT> exit code, None when nothing exited
+        :param script: <STR> filed under, the running script if None
+        """
+        if not cls.registered:
+            atexit.register(cls.flush)
+            cls.registered = True
+        script = script or path.basename(sys.argv[0])[:-len(".py")] or "unknown"
+        cls.samples.append((script, phase, wall, cpu, rss, code))
+
+    @classmethod
+    def exit_code(cls, code):
+        """
+        Remember the exit code of the command that just finished.
+        """
+        cls.local.code = code
+
+    @classmethod
+    def flush(cls):
+        """
+        Merge what was recorded so far into the shared histograms.
+        Metrics must never break a script, so failures are dropped.
+        """
+        samples, cls.samples = cls.samples, []
+        if not samples:
+            return
+        try:
+            from jojometrics import MetricStore  # Only loaded once there is data.
+            MetricStore().merge(samples)
+        except (IOError, OSError, ValueError):
+            pass
+
+
+def instrumented(phase, children=True):
+    """
+    Decorator recording a sample for every call of the wrapped method.
+
+    :param phase: <STR> name the samples are filed under
+    :param children: <BOOL> also account for child processes (rusage)
+    """
+    def wrap(method):
+        def timed(*args, **kwargs):
+            if not Instrument.enabled():
+                return method(*args, **kwargs)
+            Instrument.exit_code(None)
+            # RUSAGE_CHILDREN is per process, with other threads reaping
+            #  children meanwhile the delta would be theirs too.
+            counted = children and threading.current_thread() is Instrument.main_thread
+            before = getrusage(RUSAGE_CHILDREN) if counted else None
+            start = time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                wall = time() - start
+                cpu, rss = 0.0, 0
+                if counted:
+                    after = getrusage(RUSAGE_CHILDREN)
+                    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+                    rss = after.ru_maxrss
+                Instrument.record(phase, wall, cpu, rss, getattr(Instrument.local, 'code', None))
+        timed.__name__ = method.__name__
+        timed.__doc__ = method.__doc__
+        return timed
+    return wrap
 
 
 class CmdRun():
@@ -20,30 +138,314 @@ class CmdRun():
     CLASS: Handles the execution of commands using subprocess.
            run() is the main business end of the class, while subsequent functions
            are primarily made to aid customized command processing.
-    """
 
-    def run(self, command):
+           backend selects how sql() reaches PostgreSQL:
+             'psql' forks sudo+psql for every call (the default)
+             'pool' hands the SQL to the resident pgpool.py daemon and
+                    falls back to 'psql' when the daemon is not running
+
+           ansible_backend selects how ansible() runs playbooks:
+             'executor' hands the run to the resident ansibled.py and
+                        falls back to 'cli' when the daemon is not
+                        running or an option is beyond it (the default)
+             'cli'      forks ansible-playbook for every call
+    """
+    # ansible_opts keys the executor understands -> its request keys.
+    EXECUTOR_OPTIONS = {'--limit': "limit", '-l': "limit", '--inventory-file': "inventory",
+                        '--inventory': "inventory", '-i': "inventory", '--user': "remote_user",
+                        '-u': "remote_user", '--become-user': "become_user",
+                        '--forks': "forks", '-f': "forks", '--tags': "tags", '-t': "tags",
+                        '--skip-tags': "skip_tags"}
+    EXECUTOR_SWITCHES = {'--check': "check", '-C': "check", '--diff': "diff", '-D': "diff",
+                         '--become': "become", '-b': "become"}
+
+    def __init__(self, backend=None, sql_file_mode=None, ansible_backend=None):
+        self.backend = backend or Constants.SQL_BACKEND
+        self.ansible_backend = ansible_backend or Constants.ANSIBLE_BACKEND
+        if sql_file_mode is None:
+            sql_file_mode = Constants.SQL_FILE_MODE
+        self.sql_file_mode = sql_file_mode
+
+    @instrumented("run")
+    def run(self, command, stdin_data=None):
         """
         Runs a command and returns combined STDERR/STDOUT
 
         :param command: <STR> command to run
+        :param stdin_data: <STR> fed to the command's STDIN if given
         :return <str>:
         """
-        out = Popen(command.split(), stderr=STDOUT, stdout=PIPE, shell=False)
-        stdout = out.communicate()[0]
+        ToolKit().admit()
+        stdin = PIPE if stdin_data is not None else None
+        out = Popen(command.split(), stdin=stdin, stderr=STDOUT, stdout=PIPE, shell=False)
+        stdout = out.communicate(stdin_data)[0]
+        Instrument.exit_code(out.returncode)
         return stdout
 
-    def sql(self, sql_code):
+    @instrumented("run")
+    def run_lines(self, command, sink=None, keep=None):
+        """
+        Like run(), but hands combined STDERR/STDOUT to sink as the
+        command prints it and only keeps the last `keep` lines, so memory
+        stays flat however chatty the command is. Lines longer than
+        Constants.RUN_MAX_LINE_BYTES arrive in pieces.
+
+        :param command: <STR> command to run, or its argv <list>
+        :param sink: <FUNCTION> called with every line, newline included
+        :param keep: <INT> lines kept in the ring buffer
+        :return <tuple>: (the kept lines as one <STR>, returncode)
+        """
+        ToolKit().admit()
+        ring = deque(maxlen=keep or Constants.RUN_RING_LINES)
+        args = command if isinstance(command, list) else command.split()
+        out = Popen(args, stderr=STDOUT, stdout=PIPE, shell=False)
+        for line in iter(lambda: out.stdout.readline(Constants.RUN_MAX_LINE_BYTES), ""):
+            ring.append(line)
+            if sink:
+                sink(line)
+        out.stdout.close()
+        returncode = out.wait()
+        Instrument.exit_code(returncode)
+        return "".join(ring), returncode
+
+    @instrumented("run")
+    def run_split(self, args, stdin_data=None):
+        """
+        Runs a command keeping STDOUT and STDERR apart.
+
+        :param args: <list> argv of the command
+        :param stdin_data: <STR> fed to the command's STDIN if given
+        :return <tuple>: (stdout, stderr, returncode)
+        """
+        ToolKit().admit()
+        stdin = PIPE if stdin_data is not None else None
+        out = Popen(args, stdin=stdin, stderr=PIPE, stdout=PIPE, shell=False)
+        stdout, stderr = out.communicate(stdin_data)
+        Instrument.exit_code(out.returncode)
+        return stdout, stderr, out.returncode
+
+    @instrumented("sql")
+    def query(self, sql_code, database=None):
+        """
+        Runs a single SELECT and returns its rows as a SqlResult.
+        Through psql every row comes back as one row_to_json() line so
+        values keep their JSON types and never need text scraping.
+        Honors the calling script's cache_ttl/cache_invalidate.
+
+        :param sql_code: <STR> one SELECT statement
+        :param database: <STR> database to connect to (psql default if None)
+        :return <SqlResult>:
+        """
+        return self.through_cache(self.run_query, sql_code, database)
+
+    def run_query(self, sql_code, database=None):
+        """
+        query() without the cache.
+        """
+        if self.backend == "pool":
+            result = self.sql_pool_structured(sql_code, database)
+            if result is not None:
+                return result
+
+        wrapped = "SELECT row_to_json(jojo_row) FROM ({sql}) AS jojo_row;".format(
+            sql=sql_code.strip().rstrip(";"))
+        stdout, stderr, returncode = self.run_split(
+            self.psql_args(database), stdin_data=wrapped)
+        result = SqlResult(output=stdout + stderr, returncode=returncode)
+        result.parse_errors(stderr)
+        for line in stdout.splitlines():
+            if line:
+                row = loads(line, object_pairs_hook=OrderedDict)
+                result.columns = result.columns or list(row.keys())
+                result.rows.append(row)
+        return result
+
+    @instrumented("sql")
+    def execute(self, sql_code, database=None):
+        """
+        Runs a script of commands (BEGIN, CREATE ROLE, ...) and returns
+        a SqlResult holding every command tag and error, in order.
+        Honors the calling script's cache_ttl/cache_invalidate.
+
+        :param sql_code: <STR> SQL commands to run
+        :param database: <STR> database to connect to (psql default if None)
+        :return <SqlResult>:
+        """
+        return self.through_cache(self.run_execute, sql_code, database)
+
+    def run_execute(self, sql_code, database=None):
+        """
+        execute() without the cache.
+        """
+        if self.backend == "pool":
+            result = self.sql_pool_structured(sql_code, database)
+            if result is not None:
+                return result
+
+        stdout, stderr, returncode = self.run_split(
+            self.psql_args(database), stdin_data=sql_code)
+        result = SqlResult(output=stdout + stderr, returncode=returncode)
+        result.parse_errors(stderr)
+        result.parse_tags(stdout)
+        return result
+
+    def stream(self, sql_code, database=None, limit=None, columns=None):
+        """
+        Runs a single SELECT and yields its rows one at a time as psql
+        prints them, so memory stays flat however big the answer is.
+        psql pages through a cursor (FETCH_COUNT) instead of buffering
+        the whole result. Streams always go to psql directly, they are
+        neither pooled nor cached.
+
+        :param sql_code: <STR> one SELECT statement
+        :param database: <STR> database to connect to (psql default if None)
+        :param limit: <INT> stop after this many rows (None for all)
+        :param columns: <list> only return these columns (None for all)
+        :return <SqlStream>: iterate it for rows, then check its errors
+        """
+        ToolKit().admit()
+        projection = "*"
+        if columns:
+            for column in columns:
+                if not regex.match(r"^[A-Za-z_][A-Za-z0-9_]*$", column):
+                    raise ValueError("bad column name: {c}".format(c=column))
+            projection = ", ".join('"{c}"'.format(c=c) for c in columns)
+        selected = "SELECT {cols} FROM ({sql}) AS jojo_src".format(
+            cols=projection, sql=sql_code.strip().rstrip(";"))
+        if limit is not None:
+            limit = int(limit)
+            selected = "{sql} LIMIT {n}".format(sql=selected, n=limit)
+        wrapped = "SELECT row_to_json(jojo_row) FROM ({sql}) AS jojo_row;".format(sql=selected)
+
+        args = self.psql_args(database, {'FETCH_COUNT': Constants.SQL_STREAM_FETCH_COUNT})
+        return SqlStream(args, wrapped, limit)
+
+    def through_cache(self, runner, sql_code, database=None):
+        """
+        Serves read-only scripts from jojocache.ResultCache when their jojo
+        block sets cache_ttl, and drops cached results named by
+        cache_invalidate after a mutating script ran.
+
+        :param runner: <FUNCTION> run_query or run_execute
+        :return <SqlResult>:
+        """
+        script = sys.argv[0]
+        header = JojoHeader.for_script(script)
+        ttl = float(header.get("cache_ttl", 0)) if header else 0
+        invalidate = header.get("cache_invalidate") if header else None
+        if not ttl and not invalidate:
+            return runner(sql_code, database)
+
+        from jojocache import ResultCache  # Only loaded when opted in.
+
+        cache = ResultCache()
+        name = path.basename(script)[:-len(".py")]
+        if ttl:
+            params = Environment().params()
+            scoped = dict((p, params.get(p)) for p in header.params)
+            result = cache.fetch(name, scoped, sql_code, database, ttl,
+                                 lambda: runner(sql_code, database))
+        else:
+            result = runner(sql_code, database)
+        if invalidate:
+            cache.invalidate([s.strip() for s in invalidate.split(",")])
+        return result
+
+    def psql_args(self, database=None, variables=None):
         """
-        Runs a set of SQL code using run(), and returns the run() object back.
+        psql reading STDIN in unaligned, tuples only mode, reporting
+        the SQLSTATE of every error on STDERR.
+
+        :param variables: <dict> extra psql -v NAME=VALUE settings
+        :return <list>: argv for run_split()
+        """
+        args = ["/usr/bin/sudo", "-u", "postgres", "/usr/bin/psql", "-U", "postgres",
+                "-X", "-A", "-t", "-v", "VERBOSITY=verbose", "-f", "-"]
+        for name, value in sorted((variables or {}).items()):
+            args.extend(["-v", "{n}={v}".format(n=name, v=value)])
+        if database:
+            args.extend(["-d", database])
+        return args
+
+    @instrumented("sql")
+    def sql(self, sql_code, database=None):
+        """
+        Runs a set of SQL code and returns the psql output.
+        The SQL is piped to psql over STDIN, nothing touches the disk.
+        With sql_file_mode on, it goes through sql_file() instead.
+
+        :param sql_code: <STR> SQL query to run
+        :param database: <STR> database to connect to (psql default if None)
+        :return <FUNCTION self.run>:
+        """
+        if self.backend == "pool":
+            output = self.sql_pool(sql_code, database)
+            if output is not None:
+                return output
+
+        if self.sql_file_mode:
+            return self.sql_file(sql_code, database)
+
+        return self.run(self.psql_shell("-", database), stdin_data=sql_code)
+
+    def sql_file(self, sql_code, database=None):
+        """
+        Debugging aid: writes the SQL to a temporary file and runs it with
+        psql -f. The file is left behind and its path printed to STDERR
+        so the exact SQL can be inspected or replayed by hand.
 
         :param sql_code: <STR> SQL query to run
+        :param database: <STR> database to connect to (psql default if None)
         :return <FUNCTION self.run>:
         """
+        fname = ToolKit().write_temp(sql_code)
+        ToolKit().print_stderr("SQL kept in {f}".format(f=fname))
+        return self.run(self.psql_shell(fname, database))
+
+    def psql_shell(self, source, database=None):
+        """
+        :param source: <STR> file for psql -f, '-' reads STDIN
+        :return <STR>: the psql command line
+        """
         sql_shell = "/usr/bin/sudo -u postgres /usr/bin/psql -U postgres -a -f {sql}".format(
-            sql=sql_code)
-        return self.run(sql_shell)
+            sql=source)
+        if database:
+            sql_shell = "{shell} -d {db}".format(shell=sql_shell, db=database)
+        return sql_shell
 
+    def sql_pool(self, sql_code, database=None):
+        """
+        Runs SQL through the pgpool.py daemon.
+
+        :param sql_code: <STR> SQL query to run
+        :param database: <STR> database to connect to
+        :return <STR>: psql compatible output or None to fall back
+        """
+        ToolKit().admit()
+        from pgpool import PoolClient  # Only loaded when opted in.
+
+        return PoolClient().sql(sql_code, source="<stdin>",
+                                database=database or Constants.PGPOOL_DEFAULT_DATABASE)
+
+    def sql_pool_structured(self, sql_code, database=None):
+        """
+        Runs SQL through the pgpool.py daemon, which answers with rows,
+        command tags and SQLSTATEs straight from the protocol.
+
+        :param sql_code: <STR> SQL to run
+        :param database: <STR> database to connect to
+        :return <SqlResult>: or None to fall back
+        """
+        ToolKit().admit()
+        from pgpool import PoolClient  # Only loaded when opted in.
+
+        reply = PoolClient().structured(
+            sql_code, database=database or Constants.PGPOOL_DEFAULT_DATABASE)
+        if reply is None:
+            return None
+        return SqlResult.from_dict(reply)
+
+    @instrumented("ansible")
     def ansible(self, ansible_opts):
         """
         Supports running external ansible-playbook commands.
@@ -52,8 +454,142 @@ class CmdRun():
         Special exceptions for playbook and append_args as those
         are not exactly straight up flags.
 
+        Output goes to STDOUT line by line while it runs, only the tail
+        of it is held on to and returned. Runs the executor took print
+        one JSON line per task result instead of ansible-playbook text.
+
         :param ansible_opts: <dict> with k,v of options to use
-        :return <FUNCTION self.run>:
+        :return <STR>: the last Constants.RUN_RING_LINES lines of output
+        """
+        return self.ansible_run(ansible_opts, sink=self.echo).output
+
+    def ansible_run(self, ansible_opts, sink=None, fallback=True):
+        """
+        Like ansible(), but hands back the per host, per task results.
+
+        :param ansible_opts: <dict> with k,v of options to use
+        :param sink: <FUNCTION> called with every output line
+        :param fallback: <BOOL> run ansible-playbook when the executor
+                         cannot, rather than failing with
+                         EXECUTOR_UNAVAILABLE
+        :return <AnsibleResult>: structured unless ansible-playbook ran
+        """
+        ToolKit().admit()
+        request = None
+        if self.ansible_backend == "executor":
+            request = self.ansible_request(ansible_opts)
+        if request is not None:
+            from ansibled import ExecutorClient  # Only loaded when it can be used.
+            ring = deque(maxlen=Constants.RUN_RING_LINES)
+
+            def printed(event):
+                line = dumps(event) + "\n"
+                ring.append(line)
+                if sink:
+                    sink(line)
+            events = ExecutorClient().run(request, sink=printed)
+            if events is not None:
+                result = AnsibleResult.from_events(events, "".join(ring))
+                Instrument.exit_code(result.returncode)
+                return result
+        if not fallback:
+            result = AnsibleResult(returncode=1)
+            result.error = "EXECUTOR_UNAVAILABLE"
+            return result
+
+        from sshpool import SshPool  # Only loaded when forking ansible-playbook.
+        SshPool().export()
+        # No shell in between, shlex honours the quoting ansible_command() does.
+        output, returncode = self.run_lines(shlex.split(self.ansible_command(ansible_opts)),
+                                            sink=sink)
+        return AnsibleResult(output, returncode)
+
+    def ansible_request(self, ansible_opts):
+        """
+        Translates ansible_opts for the ansibled.py executor.
+
+        :param ansible_opts: <dict> with k,v of options to use
+        :return <dict>: the executor request, None when an option is
+                        one only ansible-playbook itself understands
+        """
+        request = {'verbosity': 0}
+        for k, v in ansible_opts.iteritems():
+            if k in ("--extra-vars", "-e"):
+                # Taken literally, ansible_command() single quotes it.
+                request['extra_vars'] = v
+                continue
+            words = shlex.split(str(v))
+            if k == "append_args":
+                if [w for w in words if not regex.match(r"^-v+$", w)]:
+                    return None
+                request['verbosity'] = sum(len(w) - 1 for w in words)
+            elif len(words) != 1:
+                return None
+            elif k == "playbook":
+                request['playbook'] = words[0]
+            elif k in self.EXECUTOR_SWITCHES and v == k:
+                request[self.EXECUTOR_SWITCHES[k]] = True
+            elif k in self.EXECUTOR_OPTIONS:
+                request[self.EXECUTOR_OPTIONS[k]] = words[0]
+            else:
+                return None
+
+        if 'forks' in request:
+            if not request['forks'].isdigit():
+                return None
+            request['forks'] = int(request['forks'])
+        for key in ("tags", "skip_tags"):
+            if key in request:
+                request[key] = request[key].split(",")
+        if 'extra_vars' in request:
+            request['extra_vars'] = self.ansible_extra_vars(request['extra_vars'])
+            if request['extra_vars'] is None:
+                return None
+        return request if 'playbook' in request else None
+
+    def ansible_extra_vars(self, extra_vars):
+        """
+        :param extra_vars: <STR> JSON object or key=value pairs
+        :return <dict>: the variables, None for @file and anything odd
+        """
+        if extra_vars.startswith("{"):
+            try:
+                parsed = loads(extra_vars)
+            except ValueError:
+                return None
+            return parsed if isinstance(parsed, dict) else None
+        parsed = {}
+        for pair in shlex.split(extra_vars):
+            key, equals, value = pair.partition("=")
+            if not equals or not regex.match(r"^[A-Za-z_][A-Za-z0-9_]*$", key):
+                return None
+            parsed[key] = value
+        return parsed
+
+    def echo(self, line):
+        """
+        Passes a line straight through to STDOUT, unbuffered.
+        """
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+    def ansible_job(self, ansible_opts):
+        """
+        Same command line as ansible(), but queued for jobs.py to run in
+        the background instead of waiting for ansible-playbook here.
+
+        :param ansible_opts: <dict> with k,v of options to use
+        :return <dict>: the queued job, EXAMPLE: {'id': '20160301T101500-3f2a9c', 'state': 'queued', ...}
+        """
+        from jobs import JobStore  # Only loaded for async runs.
+        # No shell in between either, same argv as ansible_run().
+        return JobStore().submit(shlex.split(self.ansible_command(ansible_opts)), kind="ansible",
+                                 script=path.basename(sys.argv[0]))
+
+    def ansible_command(self, ansible_opts):
+        """
+        :param ansible_opts: <dict> with k,v of options to use
+        :return <STR>: the ansible-playbook command line
         """
         args = ""
         for k, v in ansible_opts.iteritems():
@@ -77,17 +613,7 @@ class CmdRun():
                 print("Error?")
                 exit(1)
 
-        command = ('/usr/bin/ansible-playbook {args}').format(args=args)
-        toolkit = ToolKit()
-        print("XXXXX")
-        print(command)
-        proxyscript = ("#!/bin/bash\n\n{cmd}").format(cmd=command)
-        sh = toolkit.write_temp(proxyscript)
-
-        exe = "/bin/bash {tmpfname}".format(tmpfname=sh)
-        result = self.run(exe)
-        toolkit.close()
-        return result
+        return ('/usr/bin/ansible-playbook {args}').format(args=args)
 
     def fabric(self, fab_opts):
         """
@@ -146,6 +672,9 @@ class Constants():
     LINUX_MAX_FILE_PATH_LENGTH = 4096
     POSTGRES_NAMEDATA_LEN = 64
 
+    # Socket limit when the user does not pick one
+    POSTGRES_DEFAULT_CONNECTION_LIMIT = 10
+
     # User selectable socket limits can go this high
     POSTGRES_CONNECTION_LIMIT = 25
 
@@ -153,6 +682,398 @@ class Constants():
     # We don't need to get sockets too high.
     POSTGRES_MAXIMUM_CONNECTION_LIMIT = 150
 
+    # Connection budget (psql_connection_capacity.py): slots kept out of
+    # every role budget on top of superuser_reserved_connections, and
+    # whether role create/alter refuse limits that overcommit by default
+    CONNECTION_HEADROOM = 0
+    CONNECTION_REJECT_OVERCOMMIT = False
+
+    # pg_stat_activity.state values
+    POSTGRES_BACKEND_STATES = ("active", "idle", "idle in transaction",
+                               "idle in transaction (aborted)", "fastpath function call",
+                               "disabled")
+
+    # Default CmdRun.sql() backend, 'psql' or 'pool'
+    SQL_BACKEND = "psql"
+
+    # Default CmdRun.ansible() backend, 'executor' or 'cli'
+    ANSIBLE_BACKEND = "executor"
+
+    # Run SQL from kept temp files instead of STDIN (debugging only)
+    SQL_FILE_MODE = False
+
+    # Rows psql fetches per round trip when CmdRun.stream()ing
+    SQL_STREAM_FETCH_COUNT = 500
+
+    # psql_terminate_sockets.py rate limiting, backends per batch and
+    # the longest pause between batches (milliseconds)
+    TERMINATE_MAX_BATCH = 1000
+    TERMINATE_MAX_PAUSE = 10000
+
+    # psql_create_roles_batch.py, specs per call and statements per
+    # transaction (0 puts the whole batch in one transaction)
+    ROLES_BATCH_MAX_ITEMS = 1000
+    ROLES_BATCH_MAX_BYTES = 1024 * 1024
+    ROLES_BATCH_CHUNK = 0
+
+    # psql_create_role_db_hierarchy_batch.py, applications per call and
+    # how many are provisioned at the same time
+    HIERARCHY_MAX_APPLICATIONS = 100
+    HIERARCHY_WORKERS = 4
+    HIERARCHY_MAX_WORKERS = 16
+
+    # pgpool.py daemon settings (seconds where applicable)
+    PGPOOL_SOCKET = "/var/run/pyjojo-pgpool/pgpool.sock"
+    PGPOOL_POSTGRES_SOCKET_DIR = "/var/run/postgresql"
+    PGPOOL_POSTGRES_USER = "postgres"
+    PGPOOL_DEFAULT_DATABASE = "postgres"
+    PGPOOL_MAX_CONNECTIONS = 10
+    PGPOOL_MAX_PER_DATABASE = 4
+    PGPOOL_MAX_AGE = 1800
+    PGPOOL_HEALTH_CHECK_IDLE = 30
+    PGPOOL_ACQUIRE_TIMEOUT = 5
+    PGPOOL_CLIENT_TIMEOUT = 30
+
+    # lagmon.py replication lag sampler (seconds where applicable), an
+    # hour of history at one sample a second
+    LAGMON_SOCKET = "/var/run/pyjojo-lagmon/lagmon.sock"
+    LAGMON_INTERVAL = 1.0
+    LAGMON_SAMPLES = 3600
+    LAGMON_WINDOW = 60
+    LAGMON_MAX_AGE = 5
+    LAGMON_CLIENT_TIMEOUT = 2
+
+    # ansibled.py resident Ansible executor (seconds where applicable)
+    ANSIBLED_SOCKET = "/var/run/pyjojo-ansibled/ansibled.sock"
+    ANSIBLED_INVENTORY = "/opt/playbooks/ansible-hosts"
+    ANSIBLED_FORKS = 5
+    ANSIBLED_MAX_CHILDREN = 8
+    ANSIBLED_CONNECT_TIMEOUT = 5
+    ANSIBLED_PRELOAD_MODULES = ("command", "shell", "setup", "debug", "yum", "copy",
+                                "template", "file", "service", "systemd")
+
+    # sshpool.py shared SSH control sockets (seconds where applicable)
+    SSHPOOL_DIR = "/var/run/pyjojo-sshpool"
+    SSHPOOL_IDLE = 600
+    SSHPOOL_KEEPALIVE = 15
+    SSHPOOL_MAX_MASTERS = 256
+    SSHPOOL_PIPELINING = True
+
+    # pkgindex.py fleet package index
+    PKGINDEX_DB = "/var/lib/pyjojo-pkgindex/packages.db"
+    PKGINDEX_PLAYBOOK = "/opt/playbooks/ansible-playbooks/package_inventory.yml"
+    PKGINDEX_HOSTS = "nodes"
+    PKGINDEX_FORKS = 20
+
+    # stmtsnap.py pg_stat_statements snapshots (seconds where applicable)
+    STMTSNAP_DB = "/var/lib/pyjojo-stmtsnap/statements.db"
+    STMTSNAP_RETENTION = 7 * 24 * 3600
+    STMTSNAP_QUERY_LENGTH = 1000
+
+    # jojocache.py result cache
+    CACHE_DIR = "/dev/shm/pyjojo-cache"
+    CACHE_COALESCE_TIMEOUT = 30
+    CACHE_SWEEP_INTERVAL = 60   # seconds between sweeps of expired entries
+
+    # jojolock.py per-resource locks (seconds)
+    LOCK_DIR = "/dev/shm/pyjojo-locks"
+    LOCK_TIMEOUT = 30
+    LOCK_POLL_INTERVAL = 0.01
+    LOCK_MAX_POLL_INTERVAL = 0.25
+
+    # jojoadmit.py admission control (seconds where applicable). A
+    #  queued request holds its jojod worker, size --workers to match.
+    ADMISSION_ENABLED = True
+    ADMISSION_DIR = "/dev/shm/pyjojo-admission"
+    ADMISSION_CLASSES = {'read': {'limit': 8, 'reserve': 2, 'queue': 32},
+                         'write': {'limit': 2, 'reserve': 0, 'queue': 8},
+                         'ansible': {'limit': 2, 'reserve': 0, 'queue': 4}}
+    ADMISSION_PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+    ADMISSION_QUEUE_TIMEOUT = 10
+    ADMISSION_POLL_INTERVAL = 0.01
+    ADMISSION_MAX_POLL_INTERVAL = 0.25
+    ADMISSION_MAX_RETRY_AFTER = 60
+
+    # jojod.py resident worker settings
+    JOJOD_SCRIPT_DIR = "/srv/pyjojo"
+    JOJOD_BIND = "0.0.0.0"
+    JOJOD_PORT = 3001
+    JOJOD_WORKERS = 4
+    JOJOD_MAX_REQUESTS = 1000
+
+    # fanout.py fleet sweeps (seconds where applicable)
+    FANOUT_INVENTORY_DIR = "/opt/playbooks/ansible-hosts"
+    FANOUT_PYJOJO_PORT = 3000
+    FANOUT_WORKERS = 16
+    FANOUT_MAX_WORKERS = 64
+    FANOUT_TIMEOUT = 5
+    FANOUT_MAX_TIMEOUT = 60
+
+    # jobs.py background ansible jobs (seconds where applicable)
+    JOBS_DIR = "/var/lib/pyjojo-jobs"
+    JOBS_MAX_RUNNING = 2
+    JOBS_POLL_INTERVAL = 0.5
+    JOBS_MAX_WAIT = 60
+    JOBS_LOG_TAIL_LINES = 100
+    JOBS_RETENTION = 7 * 24 * 3600
+    JOBS_LOG_READ_BYTES = 1024 * 1024
+
+    # CmdRun.run_lines() ring buffer, and the longest piece read at once
+    RUN_RING_LINES = 200
+    RUN_MAX_LINE_BYTES = 64 * 1024
+
+    # Instrumentation, jojometrics.py histograms (seconds)
+    METRICS_ENABLED = True
+    METRICS_DIR = "/dev/shm/pyjojo-metrics"
+    METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class SqlError():
+    """
+    CLASS: One ERROR/FATAL reported by PostgreSQL.
+    """
+
+    def __init__(self, severity, sqlstate, message, line=None, hint=None):
+        self.severity = severity    # ERROR, FATAL, PANIC
+        self.sqlstate = sqlstate    # EXAMPLE: "42710", None if unknown
+        self.message = message
+        self.line = line            # Script line it happened on, if known
+        self.hint = hint            # error_reason_indicator when not PostgreSQL's, EXAMPLE: "POOL_TIMEOUT"
+
+    def __str__(self):
+        return "{sev}:  {code}: {msg}".format(sev=self.severity, code=self.sqlstate, msg=self.message)
+
+
+class SqlResult():
+    """
+    CLASS: What CmdRun.query() and CmdRun.execute() hand back.
+           columns and rows describe the (last) result set, tags lists
+           every command tag in order and errors the SqlError(s) seen.
+           output keeps the raw text for printing.
+    """
+    # psql:<stdin>:12: ERROR:  42710: role "x" already exists
+    ERROR_LINE = regex.compile(
+        r"^(?:psql:[^:]*:(\d+): |psql: )?(ERROR|FATAL|PANIC):  (?:([0-9A-Z]{5}): )?(.*)$")
+    # BEGIN / CREATE ROLE / INSERT 0 1 / ROLLBACK
+    TAG_LINE = regex.compile(r"^[A-Z]+(?: [A-Z]+)*(?: \d+)*$")
+    TRANSACTION_ABORTED = "25P02"
+
+    def __init__(self, output="", returncode=0):
+        self.output = output
+        self.returncode = returncode
+        self.columns = []
+        self.rows = []
+        self.tags = []
+        self.errors = []
+
+    @classmethod
+    def from_dict(cls, reply):
+        """
+        Build a result from to_dict() output or a pgpool.py structured
+        reply, which share the same shape.
+        """
+        result = cls(output=reply.get('output', u'').encode('utf-8'),
+                     returncode=reply.get('returncode', 0))
+        result.columns = reply['columns']
+        result.rows = [OrderedDict(zip(result.columns, row)) for row in reply['rows']]
+        result.tags = reply['tags']
+        result.errors = [SqlError(e['severity'], e['sqlstate'], e['message'], e['line'],
+                                  e.get('hint')) for e in reply['errors']]
+        return result
+
+    def to_dict(self):
+        """
+        :return <dict>: JSON friendly form, see from_dict()
+        """
+        return {'output': self.output.decode('utf-8', 'replace'),
+                'returncode': self.returncode,
+                'columns': self.columns,
+                'rows': [list(row.values()) for row in self.rows],
+                'tags': self.tags,
+                'errors': [{'severity': e.severity, 'sqlstate': e.sqlstate,
+                            'message': e.message, 'line': e.line, 'hint': e.hint}
+                           for e in self.errors]}
+
+    def parse_errors(self, stderr):
+        """
+        Picks the ERROR/FATAL lines out of psql's STDERR. Anything else
+        psql itself complains about (can't connect, ...) is a FATAL
+        without a SQLSTATE.
+        """
+        for line in stderr.splitlines():
+            match = self.ERROR_LINE.match(line)
+            if match:
+                lineno, severity, sqlstate, message = match.groups()
+                self.errors.append(SqlError(severity, sqlstate, message,
+                                            int(lineno) if lineno else None))
+            elif line.startswith("psql: ") or line.startswith("sudo: "):
+                self.errors.append(SqlError("FATAL", None, line))
+
+    def parse_tags(self, stdout):
+        for line in stdout.splitlines():
+            if self.TAG_LINE.match(line):
+                self.tags.append(line)
+
+    def rolled_back(self):
+        """
+        True when a transaction was aborted: COMMIT/END answered with
+        ROLLBACK, or commands were ignored inside a failed block.
+        """
+        return "ROLLBACK" in self.tags or self.has_sqlstate(self.TRANSACTION_ABORTED)
+
+    def has_sqlstate(self, *sqlstates):
+        for error in self.errors:
+            if error.sqlstate in sqlstates:
+                return True
+        return False
+
+    def ok(self):
+        return not self.errors and not self.rolled_back() and self.returncode == 0
+
+    def first(self, column, default=None):
+        """
+        :return: column of the first row, or default when there is none
+        """
+        if not self.rows:
+            return default
+        return self.rows[0].get(column, default)
+
+    def error_hints(self, sqlstate_hints=None):
+        """
+        Translate errors into error_reason_indicator names.
+
+        :param sqlstate_hints: <dict> SQLSTATE -> hint for script specific
+                               cases, EXAMPLE: {'42710': 'ROLE_ALREADY_EXIST'}
+        :return <list>: hints in a stable order, [] when all went well
+        """
+        sqlstate_hints = sqlstate_hints or {}
+        hints = []
+        for error in self.errors:
+            if error.hint:
+                hint = error.hint
+            elif error.sqlstate in sqlstate_hints:
+                hint = sqlstate_hints[error.sqlstate]
+            elif error.sqlstate == self.TRANSACTION_ABORTED:
+                hint = 'TRANSACTION_ROLLBACK'
+            elif error.severity == "ERROR":
+                hint = 'SQL_ERROR'
+            else:
+                hint = 'FATAL_ERROR'
+            if hint not in hints:
+                hints.append(hint)
+        if self.rolled_back() and 'TRANSACTION_ROLLBACK' not in hints:
+            hints.append('TRANSACTION_ROLLBACK')
+        if not hints and self.returncode != 0:
+            hints.append('UNKNOWN')
+        return hints
+
+
+class SqlStream(SqlResult):
+    """
+    CLASS: A SqlResult whose rows are yielded while psql produces them
+           instead of being kept. errors and returncode are filled in
+           once the rows are exhausted (or the stream is closed).
+    """
+
+    def __init__(self, args, sql_code, limit=None):
+        SqlResult.__init__(self)
+        self.limit = limit
+        self.row_count = 0
+        self.closed = False
+        self.stderr_lines = []
+        self.proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=False)
+        self.proc.stdin.write(sql_code)
+        self.proc.stdin.close()
+        # Drain STDERR aside so a chatty psql can never block STDOUT.
+        self.stderr_reader = threading.Thread(target=self.drain_stderr)
+        self.stderr_reader.daemon = True
+        self.stderr_reader.start()
+
+    def drain_stderr(self):
+        for line in iter(self.proc.stderr.readline, ''):
+            self.stderr_lines.append(line)
+
+    def __iter__(self):
+        try:
+            for line in iter(self.proc.stdout.readline, ''):
+                line = line.strip()
+                if not line:
+                    continue
+                row = loads(line, object_pairs_hook=OrderedDict)
+                if not self.columns:
+                    self.columns = list(row.keys())
+                self.row_count += 1
+                yield row
+                if self.limit is not None and self.row_count >= self.limit:
+                    break
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop psql if it is still sending and collect its errors.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.proc.poll() is None and self.limit is not None and self.row_count >= self.limit:
+            self.proc.terminate()
+        self.proc.stdout.close()
+        self.returncode = self.proc.wait()
+        self.stderr_reader.join()
+        stderr = "".join(self.stderr_lines)
+        self.output = stderr
+        self.parse_errors(stderr)
+        if self.returncode < 0:
+            # We terminated it ourselves after hitting the limit.
+            self.returncode = 0
+
+
+class AnsibleResult():
+    """
+    CLASS: What CmdRun.ansible_run() hands back. results has one dict
+           per task and host (play, task, host, status, result), stats
+           the recap per host. Both stay empty and structured False when
+           ansible-playbook was forked instead of the executor.
+           output keeps the tail of what was printed.
+    """
+    FAILED = ("failed", "unreachable")
+
+    def __init__(self, output="", returncode=0, structured=False):
+        self.output = output
+        self.returncode = returncode
+        self.structured = structured
+        self.results = []
+        self.stats = {}
+        self.error = None
+
+    @classmethod
+    def from_events(cls, events, output=""):
+        """
+        Build a result from the events ansibled.py sent, "done" last.
+        """
+        done = events[-1]
+        result = cls(output=output, returncode=done['returncode'], structured=True)
+        result.results = [e for e in events if e['event'] == "task"]
+        result.stats = done.get('stats', {})
+        result.error = done.get('error')
+        return result
+
+    def ok(self):
+        return self.returncode == 0
+
+    def task_results(self, task=None, host=None):
+        """
+        :param task: <STR> only results of the task with this name
+        :param host: <STR> only results of this host
+        :return <list>: matching result dicts, in the order they came
+        """
+        return [r for r in self.results
+                if task in (None, r['task']) and host in (None, r['host'])]
+
+    def failed_hosts(self):
+        return sorted(set(r['host'] for r in self.results if r['status'] in self.FAILED))
+
 
 class Environment():
     """
@@ -172,6 +1093,62 @@ class Environment():
         return params
 
 
+class JojoHeader():
+    """
+    CLASS: Reads the `# -- jojo --` block at the top of a script.
+           Every `# key: value` line becomes an entry in meta, except
+           `# param: name - description` lines which are collected,
+           in order, into params.
+    """
+    MARKER = "# -- jojo --"
+    parsed = {}  # filename -> JojoHeader, see for_script()
+
+    @classmethod
+    def for_script(cls, filename):
+        """
+        Parse a script's header once per process.
+
+        :return <JojoHeader>: or None if filename is not a script
+        """
+        if filename not in cls.parsed:
+            header = None
+            if filename.endswith(".py") and path.isfile(filename):
+                header = cls(filename)
+            cls.parsed[filename] = header
+        return cls.parsed[filename]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.meta = {}
+        self.params = []
+        self.parse()
+
+    def parse(self):
+        inside = False
+        with open(self.filename) as f:
+            for line in f:
+                line = line.strip()
+                if line == self.MARKER:
+                    if inside:
+                        break
+                    inside = True
+                    continue
+                if not inside or not line.startswith("#") or ":" not in line:
+                    continue
+                key, value = line.lstrip("# ").split(":", 1)
+                key, value = key.strip(), value.strip()
+                if key == "param":
+                    self.params.append(value.split(" ", 1)[0].strip())
+                else:
+                    self.meta[key] = value
+
+    def has_block(self):
+        return bool(self.meta) or bool(self.params)
+
+    def get(self, key, default=None):
+        return self.meta.get(key, default)
+
+
 class ToolKit():
     """
     CLASS: Misc. functions
@@ -183,7 +1160,73 @@ class ToolKit():
         Requires sys.stderr
 
         """
-        print(*args, file=stderr, **kwargs)
+        print(*args, file=sys.stderr, **kwargs)
+
+    def lock(self, values, keys=None):
+        """
+        Takes the locks the calling script's `lock:` header names, filled
+        from its params, plus any keys given. Waits for conflicting calls
+        up to Constants.LOCK_TIMEOUT and reports how long it waited, or
+        exits with LOCK_TIMEOUT. Held until the script ends.
+
+        :param values: <dict> validated params, sanitized_arguement
+        :param keys: <list> extra keys, EXAMPLE: ['role:app_svc']
+        :return <FLOAT>: seconds spent waiting
+        """
+        from jojolock import LockManager, LockTimeout  # Only loaded by mutating scripts.
+
+        header = JojoHeader.for_script(sys.argv[0])
+        declared = (header.get("lock", "False") if header else "False").strip()
+        exclusive = declared.lower() == "true"
+        wanted = list(keys or [])
+        if declared.lower() not in ("true", "false"):
+            wanted += LockManager.keys(declared, values)
+        if not exclusive and not wanted:
+            return 0.0
+        try:
+            waited = LockManager().acquire(wanted, exclusive=exclusive)
+        except LockTimeout as e:
+            print("jojo_return_value execution_status=rollback")
+            print("jojo_return_value error_reason_indicator=LOCK_TIMEOUT")
+            self.print_stderr("Lock `{key}` still held by another call after {s}s".format(
+                key=e.key, s=Constants.LOCK_TIMEOUT))
+            self.exit(1)
+        print("jojo_return_value lock_keys={keys}".format(keys=",".join(sorted(set(wanted))) or "*"))
+        print("jojo_return_value lock_wait={s:.3f}".format(s=waited))
+        return waited
+
+    def admit(self):
+        """
+        Takes a slot of the calling script's admission class, queueing
+        for one if needed, once per run; CmdRun calls it before any work
+        leaves the process. Exits with OVERLOADED and a retry_after when
+        the class's queue is full or the wait runs out. Processes that
+        are not jojo scripts (daemons, cron jobs) are not held back.
+        Scripts that run commands from threads call it before starting
+        them, the slot is the process's.
+
+        :return <FLOAT>: seconds spent queued
+        """
+        if not Constants.ADMISSION_ENABLED:
+            return 0.0
+        from jojoadmit import AdmissionController, Overloaded  # Only loaded once there is work.
+
+        if AdmissionController.ticket is not None:
+            return 0.0
+        controller = AdmissionController()
+        wanted = controller.classify(JojoHeader.for_script(sys.argv[0]))
+        if wanted is None:
+            return 0.0
+        try:
+            waited = controller.admit(*wanted)
+        except Overloaded as e:
+            print("jojo_return_value execution_status=rollback")
+            print("jojo_return_value error_reason_indicator=OVERLOADED")
+            print("jojo_return_value retry_after={s}".format(s=e.retry_after))
+            self.print_stderr("No `{c}` slot free and its queue is full, retry in {s}s".format(
+                c=e.admission_class, s=e.retry_after))
+            self.exit(1)
+        return waited
 
     def fail_beyond_maxlength(self, maxlength=0, string=""):
         """
@@ -205,6 +1248,7 @@ class ToolKit():
         chmod(fname, 0777)      # o+rw
         # chown(fname, uid, gid)  # chown postgres: fname
 
+    @instrumented("write_temp", children=False)
     def write_temp(self, content):
         """
         Write intermediary contents to a temporary file handle.
@@ -221,12 +1265,15 @@ class ToolKit():
     def exit(self,value=0):
         """
         Exits the application, unlinks write_temp resouce from /tmp
+        if one was written.
 
         :param value: exit value
 
         :return: exit(value)
         """
-        unlink(self.f)
+        self.unlink_temp()
+        if Instrument.enabled():
+            Instrument.record("script", time() - Instrument.started, code=value)
         return exit(value)
 
     def close(self,value=0):
@@ -237,18 +1284,100 @@ class ToolKit():
 
         :return: exit(value)
         """
-        unlink(self.f)
+        self.unlink_temp()
         return value
 
+    def unlink_temp(self):
+        """
+        Removes the write_temp resource, if any.
+        """
+        fname = getattr(self, 'f', None)
+        if fname:
+            unlink(fname)
+            self.f = None
+
 class Sanitize():
     """
     CLASS:  String sanitization functions for safe eval
             You put a string in, get  a string out.
+
+            Every rule below is compiled once into the cheapest test that
+            decides it: rules with a fixed core string are a substring test
+            (plain C, far quicker than any regex scan) confirmed by their
+            regex only when the core shows up, character class rules are a
+            precompiled regex. A rule set runs its rules in order and stops
+            at the first violation.
     """
+    # name: (literal every match contains or None, regex or None)
+    RULES = {
+        'escape': ("'\"'\"'", r"''\"'\"'|'\"'\"''"),       # pipes.quote escape sequences
+        'pattern': ("%", None),                              # SQL LIKE patterns
+        'identifier': (None, r"^[0-9]|[^A-Za-z0-9_]"),       # plain SQL identifiers
+        'control': (None, r"[\x00-\x1f\x7f]"),               # control characters
+        'host_pattern': (None, r"[^A-Za-z0-9_.*!&:,\-]"),    # ansible host patterns, unquoted
+        'path': (None, r"[^A-Za-z0-9_./\-]|(?:^|/)\.\.(?:/|$)"),  # no odd chars, no ..
+    }
+    RULESETS = {
+        'escape': ('escape',),
+        'sql': ('escape', 'pattern'),
+        'identifier': ('escape', 'identifier'),
+        'password': ('escape', 'control'),
+        'host_pattern': ('escape', 'host_pattern'),
+        'path': ('escape', 'path'),
+    }
+    MESSAGES = {
+        'pattern': "Patterns are not allowed in parameters",
+        'identifier': "`{value}` is not a valid identifier",
+        'control': "Control characters are not allowed in parameters",
+        'host_pattern': "`{value}` is not a valid host pattern",
+        'path': "`{value}` is not a valid path",
+    }
+    compiled = dict([(rule, (literal, regex.compile(pattern) if pattern else None))
+                     for rule, (literal, pattern) in RULES.items()])
+    programs = dict([(ruleset, tuple([(rule,) + compiled[rule] for rule in rules]))
+                     for ruleset, rules in RULESETS.items()])
+    NON_WORD = regex.compile(r'\W+')
 
     def __init__(self):
         self.err = ToolKit()
 
+    def violation(self, text, ruleset="escape"):
+        """
+        :param text: <STR> input to scan
+        :param ruleset: <STR> a RULESETS key, EXAMPLE: "identifier"
+        :return <STR>: name of the first rule broken, None when clean
+        """
+        for rule, literal, scanner in self.programs[ruleset]:
+            if literal is not None and literal not in text:
+                continue
+            if scanner is None or scanner.search(text):
+                return rule
+        return None
+
+    def check(self, text, ruleset="escape"):
+        """
+        Returns text when it passes every rule of ruleset, else fails the
+        request: quietly (254) on escape sequences, with a reason (240)
+        on anything else.
+
+        :param text: <STR> input to check
+        :param ruleset: <STR> a RULESETS key, EXAMPLE: "path"
+        :return <STR>: text, unchanged
+        """
+        rule = self.violation(text, ruleset)
+        if rule is None:
+            return text
+        print("jojo_return_value execution_status=500")
+        if rule == "escape":
+            # We're getting escape sequences
+            #  This user may be fuzzing the API so
+            #   quietly exit stage right
+            #    -->
+            self.err.print_stderr("An internal error has occurred.")
+            exit(254)
+        self.err.print_stderr(self.MESSAGES[rule].format(value=text))
+        exit(240)
+
     def terminate_suspicious_input(self, testtext):
         """
         At least every Sanitize() method should run the data through here
@@ -259,22 +1388,9 @@ class Sanitize():
         If one pair (or more) of escape sequences is detected
         this request will fail.
         """
-        # This will count the number of escape sequences attempted and then 
-        #  promplty throw an exception.
         # TODO Audit logging for this sort of event?
-        begin_escape_seqs = len(tuple(regex.finditer(r"''\"'\"'", testtext)))
-        end_escape_seqs = len(tuple(regex.finditer(r"'\"'\"''", testtext)))
-        escape_sequences_count = begin_escape_seqs + end_escape_seqs
-        if escape_sequences_count > 0:
-            # We're getting escape sequences
-            #  This user may be fuzzing the API so 
-            #   quietly exit stage right
-            #    -->
-            print("jojo_return_value execution_status=500")
-            self.err.print_stderr("An internal error has occurred.")
-            exit(254)
-        else:
-            return 0
+        self.check(testtext, "escape")
+        return 0
 
     def non_alphanumeric_text(self, varied_input):
         """
@@ -283,28 +1399,29 @@ class Sanitize():
 
         :param your_string: The string you wish to escape.
         """
-        self.terminate_suspicious_input(varied_input)
-        return regex.sub(r'\W+', '', varied_input)
+        self.check(varied_input, "escape")
+        return self.NON_WORD.sub('', varied_input)
 
     def sql(self, sql):
         """
         Place holder for SQL sanitizer. This is well handled by the 
         pipes.quote / shlex.quote library it seems and the tamper detection.
         """
-        fail = 0
-        errmessage = ""
-        self.terminate_suspicious_input(sql)
-
-        if len(tuple(regex.finditer(r"%", sql))):
-            fail = 240
-            errmessage = "Patterns are not allowed in parameters"
+        return self.check(sql, "sql")
 
-        if fail > 0:
-            print("jojo_return_value execution_status=500")
-            self.err.print_stderr(errmessage)
-            exit(fail)
+    def identifier_list(self, identifiers):
+        """
+        Splits a comma separated list of plain SQL identifiers (column
+        names and such), failing on anything that would need quoting.
 
-        return sql
+        :param identifiers: <STR> EXAMPLE: "pid,usename,query"
+        :return <list>: EXAMPLE: ['pid', 'usename', 'query']
+        """
+        self.check(identifiers, "escape")
+        names = [i.strip() for i in identifiers.split(",") if i.strip()]
+        for name in names:
+            self.check(name, "identifier")
+        return names
 
 
 class ParamHandle():
@@ -326,6 +1443,7 @@ class ParamHandle():
     # UTF-8 character as a 4th default state.
     default_value = False  # If this property is set, auto-return this value if the
     # user neglects to define this parameter.
+    NIL = """''\"'\"''\"'\"''"""  # What a parameter the user left out looks like
 
     def __init__(self):
         self.err = ToolKit()
@@ -340,6 +1458,7 @@ class ParamHandle():
         env = Environment()  # Instance the shell environment class
         return env.params()
 
+    @instrumented("param_get", children=False)
     def get(self):
         """
         This will return a dictionary of environment variables.
@@ -355,7 +1474,8 @@ class ParamHandle():
                              expected_msg="ARG CLASS MISSING NAME")
         if self.require:
             self.fail_if_nil(self.name, self.value)
-        if self.max_length > 1:
+        if self.max_length > 1 and not self.is_nil(self.value):
+            # The nil marker itself is longer than some limits.
             if len(self.value) > self.max_length:
                 msg = "input less than {max} bytes".format(max=self.max_length)
                 self.raise_error(keyname=self.name,
@@ -403,11 +1523,29 @@ class ParamHandle():
 
         # if param == "\\'\\'\\\"\\'\\\"\\'\\'\\\"\\'\\\"\\'\\'":
         #\\'\\'\\\"\\'\\\"\\'\\'\\\"\\'\\\"\\'\\'
-        if param == """''\"'\"''\"'\"''""":
+        if param == self.NIL:
             return True
         else:
             return False
 
+    def unquote(self, keyname, value):
+        """
+        Undoes the pipes.quote pyjojo (and jojod) put every parameter
+        through, for values checked or parsed as they were sent: host
+        patterns with * ! &, anything with a space, JSON. Anything but
+        exactly one shell word is an error.
+
+        :param value: <STR> EXAMPLE: 'nodes:!prod'
+        :return <STR>: EXAMPLE: nodes:!prod
+        """
+        try:
+            words = shlex.split(value)
+        except ValueError:
+            words = []
+        if len(words) != 1:
+            self.raise_error(keyname=keyname, value=value, expected_msg="a single shell quoted")
+        return words[0]
+
     def fail_if_nil(self, keyname, value):
         """
         Causes an error message then exits, used when a parameter is nil.
@@ -465,6 +1603,143 @@ class ParamHandle():
         else:
             self.isbool = custom_badinput_value
 
+
+class ParamSchema():
+    """
+    CLASS: Declarative parameters. A script lists every parameter once and
+           validate() checks them all in one pass over the environment,
+           reading only the declared names. Validators are compiled once
+           per schema name and kept in ParamSchema.compiled, so resident
+           workers (jojod.py) reuse them from one request to the next.
+
+           Spec keys, all optional but name:
+             name          parameter name, EXAMPLE: "role"
+             type          'str' (default), 'int', 'bool' or 'flag'
+             max_length    maximum len() of the raw value
+             require       fail when the parameter was not given
+             unquote       undo pyjojo's shell quoting first, see
+                           ParamHandle.unquote(), for values that are
+                           used as sent rather than as SQL literals
+             sanitizer     None, 'nonalphanumeric' or a Sanitize.RULESETS key
+                           ('sql', 'identifier', 'password', 'path', ...)
+             pattern       regex the (sanitized) value must match fully
+             default       returned when the parameter was not given
+             min, max      bounds for 'int'
+             when_true, when_false, when_bad
+                           'bool' mapping, like ParamHandle.convert_to_bool()
+             when_defined  'flag' value when given, "{value}" is replaced
+                           by the input, like ParamHandle.set_value_if_defined()
+
+           EXAMPLE:
+             schema = ParamSchema.compile("psql_alter_role", [
+                 {'name': "role", 'max_length': 64, 'require': True, 'sanitizer': "sql"},
+                 {'name': "login", 'type': "bool", 'when_true': " LOGIN ", 'when_false': " NOLOGIN "},
+             ])
+             sanitized_arguement = schema.validate()
+    """
+    compiled = {}   # schema name -> ParamSchema
+
+    def __init__(self, specs):
+        self.handle = ParamHandle()   # Error reporting and nil detection
+        self.sanitize = Sanitize()
+        self.validators = [(spec['name'], self.compile_one(spec)) for spec in specs]
+
+    @classmethod
+    def compile(cls, name, specs):
+        """
+        :param name: <STR> cache key, usually the script name
+        :param specs: <list> of spec dicts, see the class docstring
+        :return <ParamSchema>: compiled once, then served from the cache
+        """
+        schema = cls.compiled.get(name)
+        if schema is None:
+            schema = cls.compiled[name] = cls(specs)
+        return schema
+
+    def validate(self, environment=None, prefix=""):
+        """
+        :param environment: <dict> upper case names, defaults to os.environ
+        :param prefix: <STR> put in front of names in error messages,
+                       EXAMPLE: "roles[3]."
+        :return <dict>: parameter name -> validated value
+        """
+        source = env if environment is None else environment
+        values = {}
+        for name, validator in self.validators:
+            values[name] = validator(source.get(name.upper()), prefix + name)
+        return values
+
+    def sanitizer(self, name):
+        """
+        :param name: <STR> 'nonalphanumeric' or a Sanitize.RULESETS key
+        :return <FUNCTION>: sanitizer(value) -> value, None for no sanitizer
+        """
+        if name is None:
+            return None
+        if name == "nonalphanumeric":
+            return self.sanitize.non_alphanumeric_text
+        scanner = self.sanitize.check
+        return lambda value: scanner(value, name)
+
+    def compile_one(self, spec):
+        """
+        :return <FUNCTION>: validator(raw value) -> value, exits on bad input
+        """
+        name = spec['name']
+        kind = spec.get('type', "str")
+        max_length = spec.get('max_length', -1)
+        require = spec.get('require', False)
+        default = spec.get('default')
+        minimum, maximum = spec.get('min'), spec.get('max')
+        when_true = spec.get('when_true', True)
+        when_false = spec.get('when_false', False)
+        when_bad = spec.get('when_bad', when_false)
+        when_defined = spec.get('when_defined', True)
+        pattern = regex.compile("(?:{p})$".format(p=spec['pattern'])) if 'pattern' in spec else None
+        sanitizer = self.sanitizer(spec.get('sanitizer'))
+        unquote = spec.get('unquote', False)
+        if kind == "bool" and 'default' not in spec:
+            default = when_false
+        handle = self.handle
+
+        def validator(value, keyname=name):
+            if value is None or handle.is_nil(value):
+                if require:
+                    handle.fail_if_nil(keyname, handle.NIL)
+                return default
+            if max_length > 1 and len(value) > max_length:
+                msg = "input less than {max} bytes".format(max=max_length)
+                handle.raise_error(keyname=keyname, value='too large', expected_msg=msg,
+                                   error_reason_indi="BUFFER_OUT_OF_SPACE")
+            if kind == "bool":
+                lowered = value.lower()
+                if lowered.startswith('t') or value == "1" or lowered.startswith('y'):
+                    return when_true
+                if lowered.startswith('f') or value == "0" or lowered.startswith('n'):
+                    return when_false
+                return when_bad
+            if unquote:
+                value = handle.unquote(keyname, value)
+            if sanitizer:
+                value = sanitizer(value)
+            if pattern and not pattern.match(value):
+                handle.raise_error(keyname=keyname, value=value,
+                                   expected_msg=spec.get('expected', "a well formed"))
+            if kind == "flag":
+                if isinstance(when_defined, basestring):
+                    return when_defined.format(value=value)
+                return when_defined
+            if kind == "int":
+                if not value.isdigit():
+                    handle.raise_error(keyname=keyname, value=value, expected_msg="numeric")
+                value = int(value)
+                if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+                    msg = "{lo} to {hi}".format(lo=minimum, hi=maximum)
+                    handle.raise_error(keyname=keyname, value=value, expected_msg=msg)
+            return value
+        return validator
+
+
 if __name__ == "__main__":
     # Just quit.
     exit(0)
@@ -0,0 +1,226 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Runs one pyjojo script on many hosts at once.
+#
+#  Hosts come from the same ansible-hosts/<environment>/ inventory the
+#  ansible_* scripts hand to ansible-playbook, and are picked with an
+#  ansible style pattern (`postgres-slaves`, `dc1:!db-masters-prod`).
+#  Every host is asked over its own pyjojo API from a bounded pool of
+#  threads, each request with its own timeout, and the answers come
+#  back merged in inventory order. Hosts that time out or refuse the
+#  connection are part of the answer, not an exception.
+
+from __future__ import print_function
+from os import path, listdir
+from json import dumps, loads
+from urllib import urlencode
+from Queue import Queue, Empty
+from time import time
+from fnmatch import fnmatchcase
+import urllib2
+import socket
+import threading
+import re as regex
+
+from common import Constants
+
+
+class Inventory():
+    """
+    CLASS: Ansible INI inventory, a single file or a directory of them
+           (EXAMPLE: ansible-hosts/prod/). Resolves group patterns to hosts.
+    """
+    SECTION = regex.compile(r"^\[([^\]:]+)(?::(\w+))?\]$")
+
+    def __init__(self, source):
+        self.hosts_in = {}     # group -> set of hosts
+        self.children = {}     # group -> set of child groups
+        self.addresses = {}    # host  -> ansible_host (when set)
+        self.order = []        # hosts in the order they were declared
+        if path.isdir(source):
+            for fname in sorted(listdir(source)):
+                fullpath = path.join(source, fname)
+                if path.isfile(fullpath) and not fname.startswith("."):
+                    self.parse(fullpath)
+        else:
+            self.parse(source)
+
+    def parse(self, filename):
+        group, kind = "ungrouped", "hosts"
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#") or line.startswith(";"):
+                    continue
+                section = self.SECTION.match(line)
+                if section:
+                    group, kind = section.group(1), section.group(2) or "hosts"
+                    self.hosts_in.setdefault(group, set())
+                    self.children.setdefault(group, set())
+                    continue
+                if kind == "children":
+                    self.children.setdefault(group, set()).add(line.split()[0])
+                elif kind == "hosts":
+                    self.add_host(group, line)
+
+    def add_host(self, group, line):
+        """
+        :param line: <STR> EXAMPLE: "db-n01.prod.dc1 ansible_host=10.0.0.5"
+        """
+        fields = line.split()
+        host = fields[0]
+        for field in fields[1:]:
+            key, _, value = field.partition("=")
+            if key == "ansible_host" or key == "ansible_ssh_host":
+                self.addresses[host] = value
+        self.hosts_in.setdefault(group, set()).add(host)
+        if host not in self.order:
+            self.order.append(host)
+
+    def group_hosts(self, group, seen=None):
+        """
+        :return <set>: every host in group and, recursively, its children
+        """
+        seen = seen or set()
+        if group in seen:
+            return set()
+        seen.add(group)
+        hosts = set(self.hosts_in.get(group, ()))
+        for child in self.children.get(group, ()):
+            hosts |= self.group_hosts(child, seen)
+        return hosts
+
+    def hosts(self, pattern="all"):
+        """
+        Resolves an ansible style pattern. `a:b` is a union, `!a`
+        excludes and `&a` intersects, host names match themselves and
+        `*` wildcards match group and host names alike, as in ansible.
+
+        :param pattern: <STR> EXAMPLE: "postgres-slaves:!dc3", "db-*:&dc1"
+        :return <list>: matching hosts in inventory order
+        """
+        selected = set()
+        for term in [t for t in regex.split(r"[:,]", pattern) if t]:
+            op = term[0] if term[0] in "!&" else ""
+            name = term[len(op):]
+            if name in ("all", "*"):
+                matched = set(self.order)
+            elif "*" in name:
+                matched = set(h for h in self.order if fnmatchcase(h, name))
+                for group in set(self.hosts_in) | set(self.children):
+                    if fnmatchcase(group, name):
+                        matched |= self.group_hosts(group)
+            elif name in self.hosts_in or name in self.children:
+                matched = self.group_hosts(name)
+            else:
+                matched = set([name]) & set(self.order)
+            if op == "!":
+                selected -= matched
+            elif op == "&":
+                selected &= matched
+            else:
+                selected |= matched
+        return [h for h in self.order if h in selected]
+
+    def address(self, host):
+        return self.addresses.get(host, host)
+
+
+class FanOut():
+    """
+    CLASS: Calls call(host, timeout) for every host from at most
+           `workers` threads and collects one result per host.
+    """
+
+    def __init__(self, workers=Constants.FANOUT_WORKERS,
+                 timeout=Constants.FANOUT_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+
+    def run(self, hosts, call):
+        """
+        :param hosts: <list> host names
+        :param call: <FUNCTION> call(host, timeout), returns the host's reply
+        :return <list>: one dict per host, in the order given. status is
+                        one of ok, timeout, unreachable, http_error, bad_reply
+        """
+        pending = Queue()
+        for host in hosts:
+            pending.put(host)
+        results = {}
+
+        def worker():
+            while True:
+                try:
+                    host = pending.get_nowait()
+                except Empty:
+                    return
+                results[host] = self.call_one(host, call)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.workers, len(hosts)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return [results[h] for h in hosts]
+
+    def call_one(self, host, call):
+        start = time()
+        result = {'host': host, 'status': "ok", 'reply': None, 'error': None}
+        try:
+            result['reply'] = call(host, self.timeout)
+        except urllib2.HTTPError as e:
+            result['status'], result['error'] = "http_error", str(e)
+        except urllib2.URLError as e:
+            timed_out = isinstance(e.reason, socket.timeout)
+            result['status'] = "timeout" if timed_out else "unreachable"
+            result['error'] = str(e.reason)
+        except socket.timeout as e:
+            result['status'], result['error'] = "timeout", str(e) or "timed out"
+        except socket.error as e:
+            result['status'], result['error'] = "unreachable", str(e)
+        except ValueError as e:
+            result['status'], result['error'] = "bad_reply", str(e)
+        result['elapsed'] = round(time() - start, 3)
+        return result
+
+
+class PyjojoCall():
+    """
+    CLASS: A call(host, timeout) for FanOut that runs one script on the
+           host's pyjojo and returns its decoded JSON reply.
+    """
+
+    def __init__(self, script, params=None, http_method="get",
+                 port=Constants.FANOUT_PYJOJO_PORT, inventory=None):
+        self.script = script
+        self.params = params or {}
+        self.http_method = http_method
+        self.port = port
+        self.inventory = inventory
+
+    def url(self, host):
+        address = self.inventory.address(host) if self.inventory else host
+        return "http://{host}:{port}/scripts/{script}".format(
+            host=address, port=self.port, script=self.script)
+
+    def __call__(self, host, timeout):
+        url = self.url(host)
+        data = None
+        if self.http_method == "get":
+            if self.params:
+                url = "{url}?{query}".format(url=url, query=urlencode(self.params))
+        else:
+            data = dumps(self.params)
+        request = urllib2.Request(url, data, {'Content-Type': "application/json"})
+        reply = urllib2.urlopen(request, timeout=timeout)
+        try:
+            return loads(reply.read())
+        finally:
+            reply.close()
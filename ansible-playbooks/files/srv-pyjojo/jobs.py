@@ -0,0 +1,292 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Background jobs for long running ansible-playbook calls.
+#
+#   /bin/python /srv/pyjojo/jobs.py serve
+#
+#  Scripts queue a job with CmdRun.ansible_job() and answer right away
+#  with its id. The executor started above picks queued jobs up in
+#  submission order, runs at most Constants.JOBS_MAX_RUNNING of them at
+#  once and records state, return code and combined output on disk:
+#
+#   <JOBS_DIR>/<job id>/job.json     <- state, only ever replaced by rename
+#   <JOBS_DIR>/<job id>/output.log   <- ansible-playbook stdout+stderr
+#
+#  Because everything lives in the store, neither pyjojo nor jobs.py
+#  needs to stay up for a job to be found again; queued jobs wait for
+#  the executor and jobs it was running when it died are marked failed.
+#
+#  Without `serve` it just quits, this file lives next to the scripts
+#  pyjojo exposes.
+
+from __future__ import print_function
+from os import path, makedirs, rename, listdir, getpid, setsid, killpg
+from sys import argv
+from json import dumps, loads
+from time import time, sleep, strftime, gmtime
+from subprocess import Popen, STDOUT
+from shutil import rmtree
+from uuid import uuid4
+import signal
+import errno
+import re as regex
+
+from common import Constants
+from sshpool import SshPool
+
+
+class JobStore():
+    """
+    CLASS: The on-disk job store shared by submitters, the executor and
+           the status/log/result scripts.
+    """
+    JOB_ID = regex.compile(r"^\d{8}T\d{6}-[0-9a-f]{6}$")
+    FINISHED = ("succeeded", "failed")
+
+    def __init__(self, directory=Constants.JOBS_DIR):
+        self.directory = directory
+        if not path.isdir(directory):
+            try:
+                makedirs(directory, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def valid_id(self, job_id):
+        return bool(job_id) and bool(self.JOB_ID.match(job_id))
+
+    def job_dir(self, job_id):
+        return path.join(self.directory, job_id)
+
+    def log_path(self, job_id):
+        return path.join(self.job_dir(job_id), "output.log")
+
+    def submit(self, argv, kind, script=None):
+        """
+        :param argv: <list> command to run, no shell involved
+        :param kind: <STR> EXAMPLE: "ansible"
+        :param script: <STR> submitting script, for the record
+        :return <dict>: the queued job
+        """
+        job_id = "{ts}-{rand}".format(ts=strftime("%Y%m%dT%H%M%S", gmtime()),
+                                      rand=uuid4().hex[:6])
+        makedirs(self.job_dir(job_id), 0700)
+        open(self.log_path(job_id), "a").close()
+        job = {'id': job_id, 'kind': kind, 'script': script, 'argv': argv,
+               'state': "queued", 'submitted': time(), 'started': None,
+               'finished': None, 'returncode': None, 'pid': None, 'error': None}
+        self.save(job)
+        return job
+
+    def save(self, job):
+        """
+        Atomically replace job.json (write aside, then rename).
+        """
+        final = path.join(self.job_dir(job['id']), "job.json")
+        scratch = "{f}.{pid}".format(f=final, pid=getpid())
+        with open(scratch, "w") as f:
+            f.write(dumps(job))
+        rename(scratch, final)
+
+    def load(self, job_id):
+        """
+        :return <dict>: the job, None for unknown or malformed ids
+        """
+        if not self.valid_id(job_id):
+            return None
+        try:
+            with open(path.join(self.job_dir(job_id), "job.json")) as f:
+                return loads(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def jobs(self, state=None):
+        """
+        :return <list>: jobs (optionally only in `state`), oldest first
+        """
+        found = []
+        for job_id in listdir(self.directory):
+            job = self.load(job_id)
+            if job is not None and (state is None or job['state'] == state):
+                found.append(job)
+        return sorted(found, key=lambda j: j['submitted'])
+
+    def wait(self, job_id, timeout):
+        """
+        Long-poll: return once the job finished or timeout seconds passed.
+
+        :return <dict>: the job as last seen
+        """
+        deadline = time() + min(timeout, Constants.JOBS_MAX_WAIT)
+        job = self.load(job_id)
+        while job is not None and job['state'] not in self.FINISHED and time() < deadline:
+            sleep(Constants.JOBS_POLL_INTERVAL)
+            job = self.load(job_id)
+        return job
+
+    def tail(self, job_id, lines=Constants.JOBS_LOG_TAIL_LINES):
+        """
+        :return <list>: the last `lines` lines of the job output
+        """
+        chunk = 8192
+        with open(self.log_path(job_id), "rb") as f:
+            f.seek(0, 2)
+            end = f.tell()
+            data = ""
+            while end > 0 and data.count("\n") <= lines:
+                start = max(0, end - chunk)
+                f.seek(start)
+                data = f.read(end - start) + data
+                end = start
+        return data.splitlines()[-lines:] if lines else []
+
+    def read_from(self, job_id, offset, max_bytes=Constants.JOBS_LOG_READ_BYTES,
+                  whole_lines=True):
+        """
+        Incremental read for clients following a job: hand back the log
+        from offset on and the offset to ask for next time.
+
+        :param offset: <INT> byte offset, 0 for the start of the log
+        :param whole_lines: <BOOL> hold a trailing partial line back for the
+                            next read (pass False once the job finished)
+        :return <tuple>: (data, next offset)
+        """
+        with open(self.log_path(job_id), "rb") as f:
+            f.seek(offset)
+            data = f.read(max_bytes)
+        if whole_lines and not data.endswith("\n"):
+            cut = data.rfind("\n") + 1
+            if cut or len(data) < max_bytes:
+                data = data[:cut]
+        return data, offset + len(data)
+
+    def wait_output(self, job_id, offset, timeout):
+        """
+        Long-poll: return once read_from(offset) has whole lines to give,
+        the job finished or timeout seconds passed.
+
+        :return <dict>: the job as last seen
+        """
+        deadline = time() + min(timeout, Constants.JOBS_MAX_WAIT)
+        job = self.load(job_id)
+        while (job is not None and job['state'] not in self.FINISHED and
+               not self.read_from(job_id, offset)[0] and time() < deadline):
+            sleep(Constants.JOBS_POLL_INTERVAL)
+            job = self.load(job_id)
+        return job
+
+    def log_size(self, job_id):
+        return path.getsize(self.log_path(job_id))
+
+    def copy_output(self, job_id, out):
+        """
+        Write the whole log to the file object out, a chunk at a time.
+        """
+        with open(self.log_path(job_id), "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), ""):
+                out.write(chunk)
+
+    def prune(self, retention=Constants.JOBS_RETENTION):
+        """
+        Drop finished jobs older than retention seconds.
+        """
+        cutoff = time() - retention
+        for job in self.jobs():
+            if job['state'] in self.FINISHED and job['finished'] < cutoff:
+                rmtree(self.job_dir(job['id']), ignore_errors=True)
+
+
+class JobExecutor():
+    """
+    CLASS: Runs queued jobs, at most max_running at a time, and is the
+           only writer of job state once a job has been submitted.
+    """
+
+    def __init__(self, store, max_running=Constants.JOBS_MAX_RUNNING):
+        self.store = store
+        self.max_running = max_running
+        self.running = {}    # job id -> (job, Popen)
+        self.stopping = False
+
+    def recover(self):
+        """
+        Jobs left 'running' by a previous executor lost their process.
+        """
+        for job in self.store.jobs("running"):
+            job['state'] = "failed"
+            job['finished'] = time()
+            job['error'] = "interrupted, jobs.py was restarted"
+            self.store.save(job)
+
+    def fail(self, job, error):
+        job['state'] = "failed"
+        job['finished'] = time()
+        job['error'] = error
+        self.store.save(job)
+
+    def start(self, job):
+        if 'argv' not in job:
+            # Queued as a shell command line, before jobs ran without a shell.
+            return self.fail(job, "queued by an older jobs.py, submit it again")
+        log = open(self.store.log_path(job['id']), "ab")
+        try:
+            proc = Popen(job['argv'], stdout=log, stderr=STDOUT,
+                         close_fds=True, preexec_fn=setsid)
+        except OSError as e:
+            return self.fail(job, "could not start: {e}".format(e=e))
+        finally:
+            log.close()
+        job['state'] = "running"
+        job['started'] = time()
+        job['pid'] = proc.pid
+        self.store.save(job)
+        self.running[job['id']] = (job, proc)
+
+    def reap(self):
+        for job_id, (job, proc) in list(self.running.items()):
+            returncode = proc.poll()
+            if returncode is None:
+                continue
+            job['returncode'] = returncode
+            job['state'] = "succeeded" if returncode == 0 else "failed"
+            job['finished'] = time()
+            self.store.save(job)
+            del self.running[job_id]
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def serve(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.recover()
+        last_prune = 0
+        while not self.stopping:
+            self.reap()
+            if len(self.running) < self.max_running:
+                for job in self.store.jobs("queued")[:self.max_running - len(self.running)]:
+                    self.start(job)
+            if time() - last_prune > 3600:
+                self.store.prune()
+                last_prune = time()
+            sleep(Constants.JOBS_POLL_INTERVAL)
+        for job_id, (job, proc) in list(self.running.items()):
+            job['error'] = "stopped together with jobs.py"
+            try:
+                killpg(proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            proc.wait()
+        self.reap()
+
+
+if __name__ == "__main__":
+    if argv[1:] != ["serve"]:
+        # Just quit.
+        exit(0)
+    SshPool().export()  # Inherited by every ansible-playbook it starts
+    JobExecutor(JobStore()).serve()
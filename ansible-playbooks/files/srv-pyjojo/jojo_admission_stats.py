@@ -0,0 +1,30 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Admission classes, their running/queued scripts and admitted/rejected counters
+# http_method: get
+# lock: False
+# priority: high
+# tags: Pyjojo, Admission
+# -- jojo --
+
+from common import ToolKit
+from jojoadmit import AdmissionController
+
+# Spawn Instances
+toolkit = ToolKit()                    # <class> Misc. functions
+controller = AdmissionController()     # <class> Shared slots and queues
+
+
+# *************
+# *  RESULTS  *
+# *************
+for admission_class, stats in sorted(controller.stats().items()):
+    for counter, value in sorted(stats.items()):
+        print("jojo_return_value {c}_{counter}={value}".format(
+            c=admission_class, counter=counter, value=value))
+print("jojo_return_value execution_status=ok")
+
+toolkit.exit(0)
@@ -0,0 +1,27 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Result cache hit/miss/coalesced/invalidation counters
+# http_method: get
+# lock: False
+# tags: Pyjojo, Cache
+# -- jojo --
+
+from common import ToolKit
+from jojocache import ResultCache
+
+# Spawn Instances
+toolkit = ToolKit()      # <class> Misc. functions
+cache = ResultCache()    # <class> Shared result cache
+
+
+# *************
+# *  RESULTS  *
+# *************
+for counter, value in sorted(cache.stats().items()):
+    print("jojo_return_value {counter}={value}".format(counter=counter, value=value))
+print("jojo_return_value execution_status=ok")
+
+toolkit.exit(0)
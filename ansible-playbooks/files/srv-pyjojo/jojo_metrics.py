@@ -0,0 +1,31 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Per script latency, child CPU/RSS and exit code metrics in Prometheus text format
+# http_method: get
+# lock: False
+# tags: Pyjojo, Metrics
+# -- jojo --
+
+from sys import stdout
+from common import ToolKit, Instrument
+from jojometrics import MetricStore
+
+# Spawn Instances
+toolkit = ToolKit()      # <class> Misc. functions
+store = MetricStore()    # <class> Shared histograms
+
+# Keep the scrape itself out of the numbers it reports.
+Instrument.pause()
+
+
+# *************
+# *  RESULTS  *
+# *************
+for line in store.prometheus():
+    stdout.write(line + "\n")
+print("jojo_return_value execution_status=ok")
+
+toolkit.exit(0)
@@ -0,0 +1,249 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Admission control for the work scripts hand to PostgreSQL and ansible.
+#
+#  Every script belongs to a class with a concurrency limit and a
+#  bounded queue, Constants.ADMISSION_CLASSES:
+#
+#   read     GET scripts, unless they say otherwise
+#   write    POST scripts
+#   ansible  playbook runs
+#
+#  declared, with a priority, in the jojo block:
+#   # admission: ansible
+#   # priority: high                      <- high, normal or low
+#
+#  CmdRun asks for a slot right before it first forks psql or
+#  ansible-playbook (or hands work to pgpool.py/ansibled.py), so cached
+#  answers and param errors never queue. The slot is held until the
+#  script ends. Waiters are served by priority, then in arrival order;
+#  the last `reserve` slots of a class are kept for high priority
+#  scripts, so health checks get through a burst of dashboard polls.
+#  A full queue, or a wait past Constants.ADMISSION_QUEUE_TIMEOUT, is
+#  rejected at once with a Retry-After estimate: jojod answers 503,
+#  scripts under pyjojo roll back with OVERLOADED.
+#
+#  Queue times go to the `queue` phase of jojometrics (code 503 when
+#  rejected), queue depths are in jojo_admission_stats.py.
+
+from __future__ import print_function
+from os import path, makedirs, getpid, kill
+from json import dumps, loads
+from time import time, sleep
+from math import ceil
+import fcntl
+import errno
+import atexit
+
+from common import Constants, Instrument
+
+
+class Overloaded(Exception):
+    """
+    Raised when a class has no slot and no room left in its queue.
+    """
+
+    def __init__(self, admission_class, retry_after):
+        Exception.__init__(self, admission_class, retry_after)
+        self.admission_class = admission_class
+        self.retry_after = retry_after
+
+
+class AdmissionController():
+    """
+    CLASS: Slots and queues of every class, in one JSON file on tmpfs
+           shared by pyjojo's processes and jojod's workers, changed
+           under an exclusive flock only.
+    """
+    ticket = None   # (class, token, admitted at) this process holds, see release()
+    registered = False
+
+    def __init__(self, directory=Constants.ADMISSION_DIR, classes=Constants.ADMISSION_CLASSES,
+                 timeout=Constants.ADMISSION_QUEUE_TIMEOUT):
+        self.directory = directory
+        self.classes = classes
+        self.timeout = timeout
+        if not path.isdir(directory):
+            try:
+                makedirs(directory, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def filename(self):
+        return path.join(self.directory, "admission.json")
+
+    def classify(self, header):
+        """
+        :param header: <JojoHeader> the script's, None when not a script
+        :return <tuple>: (class, rank), None when the script is not
+                         admission controlled
+        """
+        if header is None or not header.has_block():
+            return None
+        default = "read" if header.get("http_method", "post").lower() == "get" else "write"
+        admission_class = header.get("admission", default).strip().lower()
+        if admission_class not in self.classes:
+            admission_class = default
+        priority = header.get("priority", "normal").strip().lower()
+        return admission_class, Constants.ADMISSION_PRIORITIES.get(
+            priority, Constants.ADMISSION_PRIORITIES['normal'])
+
+    def alive(self, pid):
+        try:
+            kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    def update(self, change):
+        """
+        Run change(state) under the lock and write back what it left.
+
+        :return: whatever change returned
+        """
+        with open(self.filename(), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                state = loads(f.read())
+            except ValueError:
+                state = {}
+            outcome = change(state)
+            f.seek(0)
+            f.truncate()
+            f.write(dumps(state))
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return outcome
+
+    def queue(self, state, admission_class):
+        """
+        :return <dict>: the class's running slots and waiters, minus
+                        those of processes that died holding them
+        """
+        entry = state.setdefault(admission_class, {})
+        entry.setdefault('hold', 1.0)
+        for counter in ('admitted', 'rejected'):
+            entry.setdefault(counter, 0)
+        entry['running'] = dict((token, pid) for token, pid in entry.get('running', {}).items()
+                                if self.alive(pid))
+        entry['waiting'] = [w for w in entry.get('waiting', []) if self.alive(w[3])]
+        return entry
+
+    def retry_after(self, entry, admission_class):
+        """
+        :return <INT>: seconds until the queue ahead is likely worked
+                       off, from the mean time a slot is held
+        """
+        limit = max(self.classes[admission_class]['limit'], 1)
+        waves = (len(entry['waiting']) + 1) / float(limit)
+        return int(min(max(ceil(entry['hold'] * waves), 1), Constants.ADMISSION_MAX_RETRY_AFTER))
+
+    def admit(self, admission_class, rank, script=None):
+        """
+        Take a slot, queueing for one if none is free.
+
+        :param admission_class: <STR> one of the classes
+        :param rank: <INT> from Constants.ADMISSION_PRIORITIES, lower first
+        :param script: <STR> metrics name, the running script's if None
+        :return <FLOAT>: seconds spent queued
+        """
+        settings = self.classes[admission_class]
+        slots = settings['limit']
+        if rank > Constants.ADMISSION_PRIORITIES['high']:
+            slots -= settings.get('reserve', 0)
+        pid = getpid()
+        started = time()
+
+        def arrive(state):
+            entry = self.queue(state, admission_class)
+            state['seq'] = state.get('seq', 0) + 1
+            token = "{pid}-{seq}".format(pid=pid, seq=state['seq'])
+            ahead = [w for w in entry['waiting'] if w[0] <= rank]
+            if not ahead and len(entry['running']) < slots:
+                entry['running'][token] = pid
+                entry['admitted'] += 1
+                return token, True, 0
+            if len(entry['waiting']) >= settings['queue']:
+                entry['rejected'] += 1
+                return token, False, self.retry_after(entry, admission_class)
+            entry['waiting'].append([rank, state['seq'], token, pid])
+            return token, None, 0
+
+        def poll(state):
+            entry = self.queue(state, admission_class)
+            entry['waiting'].sort()
+            head = entry['waiting'][0][2] if entry['waiting'] else None
+            if head == token and len(entry['running']) < slots:
+                entry['waiting'].pop(0)
+                entry['running'][token] = pid
+                entry['admitted'] += 1
+                return True, 0
+            if time() - started >= self.timeout:
+                entry['waiting'] = [w for w in entry['waiting'] if w[2] != token]
+                entry['rejected'] += 1
+                return False, self.retry_after(entry, admission_class)
+            return None, 0
+
+        token, admitted, retry = self.update(arrive)
+        pause = Constants.ADMISSION_POLL_INTERVAL
+        while admitted is None:
+            sleep(pause)
+            pause = min(pause * 2, Constants.ADMISSION_MAX_POLL_INTERVAL)
+            admitted, retry = self.update(poll)
+        waited = time() - started
+        if Instrument.enabled():
+            Instrument.record("queue", waited, code=0 if admitted else 503, script=script)
+        if not admitted:
+            raise Overloaded(admission_class, retry)
+        AdmissionController.ticket = (admission_class, token, time())
+        if not AdmissionController.registered:
+            atexit.register(AdmissionController.release_all)
+            AdmissionController.registered = True
+        return waited
+
+    def release(self):
+        """
+        Give this process's slot back, if it holds one, and fold how
+        long it was held into the class's Retry-After estimate.
+        """
+        if AdmissionController.ticket is None:
+            return
+        admission_class, token, admitted = AdmissionController.ticket
+        AdmissionController.ticket = None
+
+        def leave(state):
+            entry = self.queue(state, admission_class)
+            if entry['running'].pop(token, None) is not None:
+                entry['hold'] = 0.8 * entry['hold'] + 0.2 * (time() - admitted)
+        self.update(leave)
+
+    @classmethod
+    def release_all(cls):
+        """
+        Give the slot back at exit, or after every jojod request.
+        """
+        if cls.ticket is not None:
+            cls().release()
+
+    def stats(self):
+        """
+        :return <dict>: per class running, waiting, limit, queue and the
+                        admitted/rejected counters
+        """
+        def look(state):
+            return dict((admission_class, self.queue(state, admission_class))
+                        for admission_class in self.classes)
+        stats = {}
+        for admission_class, entry in self.update(look).items():
+            settings = self.classes[admission_class]
+            stats[admission_class] = {'running': len(entry['running']),
+                                      'waiting': len(entry['waiting']),
+                                      'limit': settings['limit'], 'queue': settings['queue'],
+                                      'admitted': entry['admitted'],
+                                      'rejected': entry['rejected']}
+        return stats
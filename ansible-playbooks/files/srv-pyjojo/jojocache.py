@@ -0,0 +1,249 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Short lived result cache shared by every script process.
+#
+#  A script opts in from its jojo block:
+#   # cache_ttl: 5                              <- seconds to keep results
+#   # cache_invalidate: psql_describe_roles     <- or `all`, comma separated
+#
+#  CmdRun.query()/execute() do the rest. Entries are JSON files on tmpfs
+#  keyed by script + params + SQL. Concurrent misses on the same key are
+#  coalesced with flock(): one process runs the query, the others wait on
+#  its lock and read what it wrote. Misses sweep out expired entries and
+#  the locks of their keys, once a CACHE_SWEEP_INTERVAL at most.
+
+from __future__ import print_function
+from os import path, makedirs, rename, listdir, unlink, getpid, utime
+from json import dumps, loads
+from hashlib import sha1
+from time import time, sleep
+from shutil import rmtree
+import fcntl
+import errno
+
+from common import Constants, SqlResult
+
+
+class ResultCache():
+    """
+    CLASS: File backed, TTL bound SqlResult cache with request coalescing
+           and hit/miss/coalesced/invalidation counters.
+    """
+    COUNTERS = ('hits', 'misses', 'coalesced', 'invalidations')
+
+    def __init__(self, directory=Constants.CACHE_DIR,
+                 coalesce_timeout=Constants.CACHE_COALESCE_TIMEOUT,
+                 sweep_interval=Constants.CACHE_SWEEP_INTERVAL):
+        self.directory = directory
+        self.coalesce_timeout = coalesce_timeout
+        self.sweep_interval = sweep_interval
+        if not path.isdir(directory):
+            try:
+                makedirs(directory, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def key(self, params, sql_code, database):
+        """
+        :return <STR>: digest of everything that shapes the result
+        """
+        material = dumps([sorted(params.items()), sql_code, database])
+        return sha1(material).hexdigest()
+
+    def entry_path(self, script, key):
+        return path.join(self.directory, script, key + ".json")
+
+    def read(self, script, key):
+        """
+        :return <SqlResult>: the cached result, None if missing or stale
+        """
+        try:
+            with open(self.entry_path(script, key)) as f:
+                entry = loads(f.read())
+        except (IOError, ValueError):
+            return None
+        if entry['expires'] < time():
+            return None
+        return SqlResult.from_dict(entry['result'])
+
+    def write(self, script, key, ttl, result):
+        """
+        Atomically publish an entry (write aside, then rename).
+        """
+        script_dir = path.join(self.directory, script)
+        if not path.isdir(script_dir):
+            try:
+                makedirs(script_dir, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        final = self.entry_path(script, key)
+        scratch = "{f}.{pid}".format(f=final, pid=getpid())
+        with open(scratch, "w") as f:
+            f.write(dumps({'expires': time() + ttl, 'result': result.to_dict()}))
+        rename(scratch, final)
+
+    def fetch(self, script, params, sql_code, database, ttl, compute):
+        """
+        Return a cached result or compute it, making sure only one
+        process computes a given key at a time.
+
+        :param script: <STR> script name, EXAMPLE: "psql_slave_delay"
+        :param params: <dict> the script's declared params
+        :param compute: <FUNCTION> runs the query, returns a SqlResult
+        :return <SqlResult>:
+        """
+        key = self.key(params, sql_code, database)
+        result = self.read(script, key)
+        if result is not None:
+            self.count('hits')
+            return result
+
+        lock_path = path.join(self.directory, key + ".lock")
+        with open(lock_path, "a") as lock:
+            if not self.try_lock(lock):
+                # Someone else is running this exact query right now.
+                if self.wait_lock(lock):
+                    result = self.read(script, key)
+                    if result is not None:
+                        self.count('coalesced')
+                        return result
+            else:
+                # We won the lock but a holder may have just finished.
+                result = self.read(script, key)
+                if result is not None:
+                    self.count('hits')
+                    return result
+            try:
+                result = compute()
+                if result.ok():
+                    self.write(script, key, ttl, result)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.count('misses')
+        self.sweep()
+        return result
+
+    def try_lock(self, lock):
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError:
+            return False
+
+    def wait_lock(self, lock):
+        """
+        Poll for the lock up to coalesce_timeout.
+
+        :return <BOOL>: True when the lock was acquired
+        """
+        deadline = time() + self.coalesce_timeout
+        while time() < deadline:
+            sleep(0.01)
+            if self.try_lock(lock):
+                return True
+        return False
+
+    def sweep(self):
+        """
+        Remove expired entries, scratch files of writers that died and
+        the lock files of keys left without an entry, unless another
+        process did so less than sweep_interval seconds ago.
+        """
+        marker = path.join(self.directory, "sweep")
+        with open(marker, "a") as f:
+            if not self.try_lock(f):
+                return  # Someone is sweeping right now
+            try:
+                now = time()
+                if now - path.getmtime(marker) < self.sweep_interval:
+                    return
+                utime(marker, None)
+                live = set()
+                for script in listdir(self.directory):
+                    script_dir = path.join(self.directory, script)
+                    if path.isdir(script_dir):
+                        live.update(self.sweep_entries(script_dir, now))
+                for name in listdir(self.directory):
+                    if name.endswith(".lock") and name[:-len(".lock")] not in live:
+                        self.sweep_lock(path.join(self.directory, name))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def sweep_entries(self, script_dir, now):
+        """
+        :return <set>: keys with an entry still fresh
+        """
+        live = set()
+        for name in listdir(script_dir):
+            filename = path.join(script_dir, name)
+            try:
+                if name.endswith(".json"):
+                    with open(filename) as f:
+                        if loads(f.read())['expires'] >= now:
+                            live.add(name[:-len(".json")])
+                            continue
+                elif now - path.getmtime(filename) < self.sweep_interval:
+                    continue  # Being written
+                unlink(filename)
+            except (IOError, OSError, ValueError, KeyError):
+                pass  # Replaced or removed meanwhile
+        return live
+
+    def sweep_lock(self, lock_path):
+        """
+        Remove a lock file nobody holds. One opened before the unlink
+        can still be locked by a late waiter, at worst that key is
+        computed twice, never read wrong.
+        """
+        try:
+            with open(lock_path, "a") as lock:
+                if self.try_lock(lock):
+                    unlink(lock_path)
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except (IOError, OSError):
+            pass
+
+    def invalidate(self, scripts):
+        """
+        :param scripts: <list> script names, or ['all']
+        """
+        if "all" in scripts:
+            scripts = [d for d in listdir(self.directory)
+                       if path.isdir(path.join(self.directory, d))]
+        for script in scripts:
+            rmtree(path.join(self.directory, script), ignore_errors=True)
+        self.count('invalidations')
+
+    def count(self, counter):
+        """
+        Bump a shared counter under an exclusive lock.
+        """
+        with open(path.join(self.directory, "stats.json"), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                stats = loads(f.read())
+            except ValueError:
+                stats = {}
+            stats[counter] = stats.get(counter, 0) + 1
+            f.seek(0)
+            f.truncate()
+            f.write(dumps(stats))
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    def stats(self):
+        """
+        :return <dict>: every counter, 0 when never bumped
+        """
+        try:
+            with open(path.join(self.directory, "stats.json")) as f:
+                stats = loads(f.read())
+        except (IOError, ValueError):
+            stats = {}
+        return dict((c, stats.get(c, 0)) for c in self.COUNTERS)
@@ -0,0 +1,334 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Resident, preforked worker mode for the /srv/pyjojo scripts.
+#
+#   /bin/python /srv/pyjojo/jojod.py serve [--port 3001] [--workers 4]
+#
+#  pyjojo starts a brand new python for every request. jojod imports
+#  common once, compiles every script once, then forks workers that run
+#  the compiled scripts in-process. Each request gets its own globals,
+#  its own environment (params injected the way pyjojo does it) and its
+#  own stdout/stderr, and the HTTP answer has the same shape as pyjojo's
+#  so jojo_return_value lines keep working for clients.
+#
+#  Requests queue for their admission class (jojoadmit.py) before the
+#  script starts, a full queue is answered 503 with Retry-After.
+#
+#  Without `serve` it just quits, this file lives next to the scripts
+#  pyjojo exposes.
+
+from __future__ import print_function
+from os import environ, listdir, path, fork, getpid, kill, waitpid, _exit
+from sys import argv
+from json import dumps, loads
+from urlparse import urlparse, parse_qsl
+from StringIO import StringIO
+from argparse import ArgumentParser
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from pipes import quote
+import signal
+import sys
+import traceback
+
+from common import Constants, JojoHeader, ToolKit, Instrument
+from jojolock import LockManager
+from jojoadmit import AdmissionController, Overloaded
+
+
+class Script():
+    """
+    CLASS: A script loaded once: its jojo header and compiled code.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.name = path.basename(filename)[:-len(".py")]
+        self.header = JojoHeader(filename)
+        with open(filename) as f:
+            self.code = compile(f.read(), filename, "exec")
+
+    def http_method(self):
+        return self.header.get("http_method", "post").lower()
+
+    def describe(self):
+        return {'name': self.name, 'params': self.header.params,
+                'description': self.header.get("description", ""),
+                'http_method': self.http_method(),
+                'tags': self.header.get("tags", "")}
+
+
+class ScriptCatalog():
+    """
+    CLASS: Every script with a jojo block in the script directory.
+           Files without one (common.py and friends) are libraries.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.scripts = {}
+        for fname in sorted(listdir(directory)):
+            if not fname.endswith(".py"):
+                continue
+            fullpath = path.join(directory, fname)
+            if not JojoHeader(fullpath).has_block():
+                continue
+            script = Script(fullpath)
+            self.scripts[script.name] = script
+
+    def get(self, name):
+        return self.scripts.get(name)
+
+
+class ScriptRunner():
+    """
+    CLASS: Runs a compiled script inside this process as if it had been
+           started by pyjojo, and captures what it would have printed.
+    """
+    RETURN_VALUE = "jojo_return_value "
+
+    def __init__(self):
+        self.base_env = dict(environ)
+
+    def script_env(self, script, params):
+        """
+        Declared params become upper case environment variables, shell
+        quoted like pyjojo does it. Params the caller left out arrive as
+        quoted '' which ParamHandle.is_nil() knows how to spot. JSON body
+        values that are not strings arrive as JSON too, EXAMPLE: true,
+        [{"role": "app_svc"}], like pyjojo hands them over.
+
+        :return <dict>: the environment for this request
+        """
+        env = dict(self.base_env)
+        for name in script.header.params:
+            value = params.get(name, "''")
+            if not isinstance(value, basestring):
+                value = dumps(value)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            env[name.upper()] = quote(value)
+        return env
+
+    def admit(self, script):
+        """
+        Queue for the script's admission class up front, unlike pyjojo
+        runs which only queue once they fork, so that a full queue can
+        still be answered with a 503. The script's own CmdRun calls find
+        the slot already held.
+
+        :return <FLOAT>: seconds spent queued
+        """
+        if not Constants.ADMISSION_ENABLED:
+            return 0.0
+        controller = AdmissionController()
+        wanted = controller.classify(script.header)
+        if wanted is None:
+            return 0.0
+        return controller.admit(*wanted, script=script.name)
+
+    def execute(self, script, params):
+        """
+        :param script: <Script> what to run
+        :param params: <dict> request params
+        :return <tuple>: (retcode, stdout, stderr)
+        """
+        stdout, stderr = StringIO(), StringIO()
+        saved = (sys.stdout, sys.stderr, sys.argv)
+        environ.clear()
+        environ.update(self.script_env(script, params))
+        sys.stdout, sys.stderr = stdout, stderr
+        sys.argv = [script.filename]
+        scope = {'__name__': '__main__', '__file__': script.filename,
+                 '__builtins__': __builtins__}
+        retcode = 0
+        Instrument.begin()
+        try:
+            exec(script.code, scope)
+        except SystemExit as e:
+            retcode = self.exit_code(e.code, stderr)
+        except Exception:
+            traceback.print_exc(file=stderr)
+            retcode = 1
+        finally:
+            sys.stdout, sys.stderr, sys.argv = saved
+            environ.clear()
+            environ.update(self.base_env)
+            LockManager.release_all()  # A lock must not outlive its request
+            AdmissionController.release_all()  # Nor a slot
+            Instrument.flush()  # Workers live on, hand samples over per request
+            Instrument.paused = False  # Nor a script's wish not to be recorded
+        return retcode, stdout.getvalue(), stderr.getvalue()
+
+    def exit_code(self, code, stderr):
+        """
+        Same rules the interpreter applies to exit(code).
+        """
+        if code is None:
+            return 0
+        if isinstance(code, (int, long)):
+            return code & 0xff
+        print(code, file=stderr)
+        return 1
+
+    def response(self, retcode, stdout, stderr):
+        """
+        Split jojo_return_value lines out of stdout, like pyjojo does.
+
+        :return <dict>: JSON body for the client
+        """
+        lines = []
+        return_values = {}
+        for line in stdout.splitlines():
+            if line.startswith(self.RETURN_VALUE):
+                key, _, value = line[len(self.RETURN_VALUE):].partition("=")
+                return_values[key] = value
+            else:
+                lines.append(line)
+        return {'retcode': retcode, 'stdout': lines,
+                'stderr': stderr.splitlines(), 'return_values': return_values}
+
+
+class JojoRequestHandler(BaseHTTPRequestHandler):
+    """
+    CLASS: GET /scripts lists scripts, GET|POST /scripts/<name> runs one.
+    """
+
+    def do_GET(self):
+        self.dispatch("get")
+
+    def do_POST(self):
+        self.dispatch("post")
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["scripts"]:
+            scripts = [s.describe() for s in self.server.catalog.scripts.values()]
+            return self.reply(200, {'scripts': scripts})
+        if len(parts) != 2 or parts[0] != "scripts":
+            return self.reply(404, {'error': 'not found'})
+
+        script = self.server.catalog.get(parts[1])
+        if script is None:
+            return self.reply(404, {'error': 'script not found'})
+        if script.http_method() != method:
+            return self.reply(405, {'error': 'use {m}'.format(m=script.http_method().upper())})
+
+        params = dict(parse_qsl(url.query))
+        if method == "post":
+            length = int(self.headers.getheader('content-length', 0))
+            if length:
+                try:
+                    params.update(loads(self.rfile.read(length)))
+                except ValueError:
+                    return self.reply(400, {'error': 'body is not JSON'})
+
+        runner = self.server.runner
+        try:
+            runner.admit(script)
+        except Overloaded as e:
+            Instrument.flush()
+            return self.reply(503, {'error': 'overloaded', 'admission_class': e.admission_class,
+                                    'retry_after': e.retry_after},
+                              headers={'Retry-After': str(e.retry_after)})
+        body = runner.response(*runner.execute(script, params))
+        self.server.requests_served += 1
+        self.reply(200, body)
+
+    def reply(self, status, body, headers=None):
+        payload = dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in sorted((headers or {}).items()):
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, fmt, *args):
+        ToolKit().print_stderr("jojod[{pid}] {msg}".format(pid=getpid(), msg=fmt % args))
+
+
+class JojoServer(HTTPServer):
+    """
+    CLASS: The listening socket is opened once by the master and shared
+           by every forked worker.
+    """
+
+    def __init__(self, address, catalog):
+        HTTPServer.__init__(self, address, JojoRequestHandler)
+        self.catalog = catalog
+        self.runner = ScriptRunner()
+        self.requests_served = 0
+
+
+class Prefork():
+    """
+    CLASS: Keeps `workers` children serving, replacing any that die or
+           retire after max_requests.
+    """
+
+    def __init__(self, server, workers, max_requests):
+        self.server = server
+        self.workers = workers
+        self.max_requests = max_requests
+        self.children = set()
+        self.running = True
+
+    def spawn(self):
+        pid = fork()
+        if pid:
+            self.children.add(pid)
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            while self.server.requests_served < self.max_requests:
+                self.server.handle_request()
+        finally:
+            _exit(0)
+
+    def stop(self, signum, frame):
+        self.running = False
+        for pid in self.children:
+            kill(pid, signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while self.running:
+            while len(self.children) < self.workers and self.running:
+                self.spawn()
+            try:
+                pid, _ = waitpid(-1, 0)
+            except OSError:
+                continue
+            self.children.discard(pid)
+        for pid in list(self.children):
+            try:
+                waitpid(pid, 0)
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    if argv[1:2] != ["serve"]:
+        # Just quit.
+        exit(0)
+    parser = ArgumentParser(description="Resident pyjojo script workers")
+    parser.add_argument("--dir", default=Constants.JOJOD_SCRIPT_DIR)
+    parser.add_argument("--bind", default=Constants.JOJOD_BIND)
+    parser.add_argument("--port", type=int, default=Constants.JOJOD_PORT)
+    parser.add_argument("--workers", type=int, default=Constants.JOJOD_WORKERS)
+    parser.add_argument("--max-requests", type=int, default=Constants.JOJOD_MAX_REQUESTS)
+    args = parser.parse_args(argv[2:])
+
+    sys.path.insert(0, args.dir)
+    catalog = ScriptCatalog(args.dir)
+    server = JojoServer((args.bind, args.port), catalog)
+    Prefork(server, args.workers, args.max_requests).run()
+    server.server_close()
@@ -0,0 +1,154 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Per-resource locks shared by every script process.
+#
+#  A script names what it mutates in its jojo block, templates filled
+#  from its validated params:
+#   # lock: database:{database}                 <- comma separated keys
+#   # lock: True                                <- everything, alone
+#   # lock: False                               <- nothing
+#
+#  and calls ToolKit.lock(sanitized_arguement) before it touches
+#  anything. Calls on different keys run side by side, calls sharing a
+#  key queue up to Constants.LOCK_TIMEOUT. Locks are flock()s on tmpfs,
+#  so they work between pyjojo's processes and jojod's workers alike and
+#  go away with the process (jojod releases them after every request).
+#
+#  Keyed locks also hold the global key shared, `lock: True` takes it
+#  exclusive and so waits for, and holds off, every keyed call.
+
+from __future__ import print_function
+from os import path, makedirs
+from hashlib import sha1
+from time import time, sleep
+import fcntl
+import errno
+import re as regex
+
+from common import Constants
+
+
+class LockTimeout(Exception):
+    """
+    Raised when a key stays held by someone else past the timeout.
+    """
+
+    def __init__(self, key):
+        Exception.__init__(self, key)
+        self.key = key
+
+
+class LockManager():
+    """
+    CLASS: Takes a set of keys in one go, always in the same order, so
+           two calls wanting overlapping keys can never deadlock.
+    """
+    GLOBAL = "*"
+    UNSAFE = regex.compile(r"[^a-z0-9_.\-]")
+    held = []   # managers holding locks in this process, see release_all()
+
+    def __init__(self, directory=Constants.LOCK_DIR, timeout=Constants.LOCK_TIMEOUT):
+        self.directory = directory
+        self.timeout = timeout
+        self.files = []
+        if not path.isdir(directory):
+            try:
+                makedirs(directory, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def lock_path(self, key):
+        """
+        Readable where the key allows it, the digest keeps distinct keys
+        apart after the unsafe characters are gone.
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        readable = self.UNSAFE.sub("_", key.lower())[:64]
+        return path.join(self.directory, "{r}.{d}.lock".format(
+            r=readable, d=sha1(key).hexdigest()[:12]))
+
+    def acquire(self, keys, exclusive=False):
+        """
+        :param keys: <list> resource keys, EXAMPLE: ['database:app1']
+        :param exclusive: <BOOL> lock everything instead
+        :return <FLOAT>: seconds spent waiting
+        """
+        started = time()
+        deadline = started + self.timeout
+        wanted = [(self.GLOBAL, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)]
+        if not exclusive:
+            wanted += [(key, fcntl.LOCK_EX) for key in sorted(set(keys))]
+        try:
+            for key, mode in wanted:
+                self.take(key, mode, deadline)
+        except LockTimeout:
+            self.release()
+            raise
+        LockManager.held.append(self)
+        return time() - started
+
+    def take(self, key, mode, deadline):
+        lock = open(self.lock_path(key), "a")
+        pause = Constants.LOCK_POLL_INTERVAL
+        while True:
+            try:
+                fcntl.flock(lock, mode | fcntl.LOCK_NB)
+                break
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    lock.close()
+                    raise
+            if time() >= deadline:
+                lock.close()
+                raise LockTimeout(key)
+            sleep(min(pause, max(deadline - time(), 0)))
+            pause = min(pause * 2, Constants.LOCK_MAX_POLL_INTERVAL)
+        self.files.append(lock)
+
+    def release(self):
+        for lock in self.files:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        self.files = []
+        if self in LockManager.held:
+            LockManager.held.remove(self)
+
+    @classmethod
+    def release_all(cls):
+        """
+        Drop every lock this process holds, for long lived workers.
+        """
+        for manager in list(cls.held):
+            manager.release()
+
+    @classmethod
+    def keys(cls, templates, values):
+        """
+        Fill `lock:` header templates. A list value yields one key per
+        item, names are folded to lower case like PostgreSQL does.
+
+        :param templates: <STR> the header value, EXAMPLE: database:{database}
+        :param values: <dict> validated params
+        :return <list>: the keys, templates naming a param that has no
+                        value are left out
+        """
+        keys = []
+        for template in [t.strip() for t in templates.split(",") if t.strip()]:
+            names = regex.findall(r"\{(\w+)\}", template)
+            filled = [template]
+            for name in names:
+                value = values.get(name)
+                if value is None:
+                    continue
+                items = value if isinstance(value, list) else [value]
+                filled = [key.replace("{" + name + "}", item if isinstance(item, basestring)
+                                      else str(item))
+                          for key in filled for item in items if item is not None]
+            keys += [key.lower() for key in filled if "{" not in key]
+        return keys
@@ -0,0 +1,133 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Shared latency/resource histograms fed by common.Instrument.
+#
+#  Every script process keeps its samples in memory and merges them in
+#  here once, at exit, under an exclusive flock on a JSON file on tmpfs.
+#  jojo_metrics.py renders the totals in the Prometheus text format:
+#
+#   jojo_phase_seconds            histogram {script, phase}
+#   jojo_child_cpu_seconds_total  counter   {script, phase}
+#   jojo_child_max_rss_bytes      gauge     {script, phase}
+#   jojo_exit_codes_total         counter   {script, phase, code}
+#
+#  Phases are run (any command), sql, ansible, write_temp, param_get,
+#  queue (waiting for an admission slot, code 503 when turned away) and
+#  script (the whole run, recorded by ToolKit.exit).
+
+from __future__ import print_function
+from os import path, makedirs
+from json import dumps, loads
+import fcntl
+import errno
+
+from common import Constants
+
+
+class MetricStore():
+    """
+    CLASS: File backed histograms, one per script and phase.
+    """
+
+    def __init__(self, directory=Constants.METRICS_DIR, buckets=Constants.METRICS_BUCKETS):
+        self.directory = directory
+        self.buckets = buckets
+        if not path.isdir(directory):
+            try:
+                makedirs(directory, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def filename(self):
+        return path.join(self.directory, "metrics.json")
+
+    def empty(self):
+        return {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0,
+                'cpu': 0.0, 'rss': 0, 'codes': {}}
+
+    def add(self, series, wall, cpu, rss, code):
+        for i, le in enumerate(self.buckets):
+            if wall <= le:
+                series['buckets'][i] += 1
+                break
+        series['sum'] += wall
+        series['count'] += 1
+        series['cpu'] += cpu
+        series['rss'] = max(series['rss'], rss)
+        if code is not None:
+            series['codes'][str(code)] = series['codes'].get(str(code), 0) + 1
+
+    def merge(self, samples):
+        """
+        :param samples: <list> (script, phase, wall, cpu, rss, code) tuples
+        """
+        with open(self.filename(), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                metrics = loads(f.read())
+            except ValueError:
+                metrics = {}
+            for script, phase, wall, cpu, rss, code in samples:
+                series = metrics.setdefault(script, {}).setdefault(phase, self.empty())
+                self.add(series, wall, cpu, rss, code)
+            f.seek(0)
+            f.truncate()
+            f.write(dumps(metrics))
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self):
+        """
+        :return <dict>: script -> phase -> series
+        """
+        try:
+            with open(self.filename()) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def prometheus(self):
+        """
+        :return <list>: lines of Prometheus text exposition format
+        """
+        metrics = self.read()
+        series = [(script, phase, metrics[script][phase])
+                  for script in sorted(metrics) for phase in sorted(metrics[script])]
+        lines = ["# HELP jojo_phase_seconds Wall time per script and phase.",
+                 "# TYPE jojo_phase_seconds histogram"]
+        for script, phase, s in series:
+            labels = 'script="{s}",phase="{p}"'.format(s=script, p=phase)
+            cumulative = 0
+            for le, count in zip(self.buckets, s['buckets']):
+                cumulative += count
+                lines.append('jojo_phase_seconds_bucket{{{l},le="{le}"}} {n}'.format(
+                    l=labels, le=le, n=cumulative))
+            lines.append('jojo_phase_seconds_bucket{{{l},le="+Inf"}} {n}'.format(l=labels, n=s['count']))
+            lines.append('jojo_phase_seconds_sum{{{l}}} {v:.6f}'.format(l=labels, v=s['sum']))
+            lines.append('jojo_phase_seconds_count{{{l}}} {n}'.format(l=labels, n=s['count']))
+
+        lines += ["# HELP jojo_child_cpu_seconds_total User+system CPU of child processes.",
+                  "# TYPE jojo_child_cpu_seconds_total counter"]
+        for script, phase, s in series:
+            lines.append('jojo_child_cpu_seconds_total{{script="{s}",phase="{p}"}} {v:.6f}'.format(
+                s=script, p=phase, v=s['cpu']))
+
+        lines += ["# HELP jojo_child_max_rss_bytes Largest child resident set seen.",
+                  "# TYPE jojo_child_max_rss_bytes gauge"]
+        for script, phase, s in series:
+            lines.append('jojo_child_max_rss_bytes{{script="{s}",phase="{p}"}} {v}'.format(
+                s=script, p=phase, v=s['rss'] * 1024))
+
+        lines += ["# HELP jojo_exit_codes_total Exit codes of commands and scripts.",
+                  "# TYPE jojo_exit_codes_total counter"]
+        for script, phase, s in series:
+            for code in sorted(s['codes']):
+                lines.append('jojo_exit_codes_total{{script="{s}",phase="{p}",code="{c}"}} {n}'.format(
+                    s=script, p=phase, c=code, n=s['codes'][code]))
+        return lines
@@ -0,0 +1,267 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Resident replication lag sampler.
+#
+#  Run it as the postgres user so peer authentication over the local
+#  unix socket works:
+#   sudo -u postgres /bin/python /srv/pyjojo/lagmon.py serve
+#
+#  Without `serve` it just quits, this file lives next to the scripts
+#  pyjojo exposes.
+#
+#  One thread polls replication state every Constants.LAGMON_INTERVAL
+#  seconds over a single long lived connection and keeps the last
+#  Constants.LAGMON_SAMPLES samples in memory:
+#
+#   on a standby  seconds since the last replayed transaction and bytes
+#                 received but not replayed yet
+#   on a primary  bytes each pg_stat_replication standby still has to
+#                 replay, lag_bytes being the worst of them
+#
+#  psql_replication_lag.py and psql_slave_delay.py ask for current,
+#  min, max and percentiles over a window through Constants.LAGMON_SOCKET
+#  (one JSON line each way) and never touch PostgreSQL themselves.
+
+from __future__ import print_function
+from os import path, unlink, chmod
+from sys import argv
+from time import time, sleep
+from json import dumps, loads
+from collections import deque
+import math
+import socket
+import threading
+import SocketServer
+
+from common import Constants, ToolKit
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+
+
+def wal_functions(server_version):
+    """
+    The xlog functions were renamed to wal in PostgreSQL 10.
+
+    :param server_version: <INT> server_version_num, EXAMPLE: 90624
+    :return <dict>: 'diff', 'receive', 'replay', 'current' and 'replay_column' names
+    """
+    if server_version >= 100000:
+        return {'diff': "pg_wal_lsn_diff", 'receive': "pg_last_wal_receive_lsn",
+                'replay': "pg_last_wal_replay_lsn", 'current': "pg_current_wal_lsn",
+                'replay_column': "replay_lsn"}
+    return {'diff': "pg_xlog_location_diff", 'receive': "pg_last_xlog_receive_location",
+            'replay': "pg_last_xlog_replay_location", 'current': "pg_current_xlog_location",
+            'replay_column': "replay_location"}
+
+class LagSampler():
+    """
+    CLASS: Polls replication state into a fixed size ring buffer.
+    """
+    METRICS = ("lag_seconds", "lag_bytes")
+
+    def __init__(self, socket_dir=Constants.PGPOOL_POSTGRES_SOCKET_DIR,
+                 user=Constants.PGPOOL_POSTGRES_USER,
+                 interval=Constants.LAGMON_INTERVAL, size=Constants.LAGMON_SAMPLES):
+        self.socket_dir = socket_dir
+        self.user = user
+        self.interval = interval
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.conn = None
+        self.sql = None
+
+    def connect(self):
+        self.conn = psycopg2.connect(host=self.socket_dir, user=self.user,
+                                     dbname=Constants.PGPOOL_DEFAULT_DATABASE)
+        self.conn.autocommit = True
+        self.sql = self.queries(self.conn.server_version)
+
+    def queries(self, server_version):
+        """
+        :return <dict>: 'standby' and 'primary' SQL for this server
+        """
+        names = wal_functions(server_version)
+        return {
+            'standby': ("SELECT pg_is_in_recovery() AS in_recovery,"
+                        " extract(epoch FROM now() - pg_last_xact_replay_timestamp()) AS lag_seconds,"
+                        " {diff}({receive}(), {replay}()) AS lag_bytes,"
+                        " {receive}() = {replay}() AS caught_up").format(**names),
+            'primary': ("SELECT application_name, client_addr::text AS client_addr, state,"
+                        " {diff}({current}(), {replay_column}) AS lag_bytes"
+                        " FROM pg_stat_replication ORDER BY application_name").format(**names),
+        }
+
+    def sample(self):
+        """
+        :return <dict>: one reading, error set instead of raising
+        """
+        reading = {'ts': time(), 'in_recovery': None, 'lag_seconds': None,
+                   'lag_bytes': None, 'standbys': None, 'error': None}
+        try:
+            if self.conn is None or self.conn.closed:
+                self.connect()
+            cursor = self.conn.cursor()
+            cursor.execute(self.sql['standby'])
+            in_recovery, lag_seconds, lag_bytes, caught_up = cursor.fetchone()
+            reading['in_recovery'] = in_recovery
+            if in_recovery:
+                # An idle primary makes the replay timestamp age while
+                #  there is nothing to replay; that is no lag.
+                reading['lag_seconds'] = 0.0 if caught_up else float(lag_seconds or 0)
+                reading['lag_bytes'] = int(lag_bytes or 0)
+            else:
+                cursor.execute(self.sql['primary'])
+                reading['standbys'] = [
+                    {'application_name': name, 'client_addr': addr, 'state': state,
+                     'lag_bytes': int(behind) if behind is not None else None}
+                    for name, addr, state, behind in cursor.fetchall()]
+                behind = [s['lag_bytes'] for s in reading['standbys'] if s['lag_bytes'] is not None]
+                reading['lag_bytes'] = max(behind) if behind else None
+            cursor.close()
+        except psycopg2.Error as e:
+            reading['error'] = str(e).strip()
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except psycopg2.Error:
+                    pass
+            self.conn = None
+        return reading
+
+    def serve(self):
+        """
+        Sampling loop, meant for a daemon thread.
+        """
+        while True:
+            started = time()
+            reading = self.sample()
+            with self.lock:
+                self.samples.append(reading)
+            sleep(max(0, self.interval - (time() - started)))
+
+    def percentile(self, ordered, p):
+        """
+        Nearest rank percentile of an already sorted list.
+        """
+        rank = int(math.ceil(p / 100.0 * len(ordered)))
+        return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+    def summary(self, window, percentiles=(50, 90, 99)):
+        """
+        :param window: <FLOAT> seconds of history to summarize
+        :param percentiles: <tuple> of percentiles wanted
+        :return <dict>: current sample plus min/max/avg/pNN per metric
+        """
+        cutoff = time() - window
+        with self.lock:
+            current = self.samples[-1] if self.samples else None
+            recent = [s for s in self.samples if s['ts'] >= cutoff]
+        summary = {'current': current, 'window': window, 'samples': len(recent),
+                   'errors': len([s for s in recent if s['error']]),
+                   'interval': self.interval}
+        for metric in self.METRICS:
+            ordered = sorted(s[metric] for s in recent if s[metric] is not None)
+            stats = {'min': None, 'max': None, 'avg': None}
+            if ordered:
+                stats = {'min': ordered[0], 'max': ordered[-1],
+                         'avg': sum(ordered) / float(len(ordered))}
+            for p in percentiles:
+                stats["p{p:g}".format(p=p)] = self.percentile(ordered, p) if ordered else None
+            summary[metric] = stats
+        return summary
+
+
+class LagRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    CLASS: One JSON line in, one JSON line out.
+           {"window": 60, "percentiles": [50, 99]} summarizes the last
+           minute of samples.
+    """
+
+    def handle(self):
+        try:
+            request = loads(self.rfile.readline())
+            window = float(request.get('window', Constants.LAGMON_WINDOW))
+            percentiles = tuple(float(p) for p in request.get('percentiles', (50, 90, 99)))
+        except (ValueError, TypeError, AttributeError):
+            return self.reply({'status': 'error', 'error': 'BAD_REQUEST'})
+        self.reply({'status': 'ok', 'summary': self.server.sampler.summary(window, percentiles)})
+
+    def reply(self, payload):
+        self.wfile.write(dumps(payload) + "\n")
+
+
+class LagServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    CLASS: Threaded unix socket front end for the sampler.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, sampler):
+        if path.exists(socket_path):
+            unlink(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, LagRequestHandler)
+        chmod(socket_path, 0660)
+        self.sampler = sampler
+
+
+class LagClient():
+    """
+    CLASS: What the scripts talk to. summary() returns None when the
+           sampler is not reachable.
+    """
+
+    def __init__(self, socket_path=Constants.LAGMON_SOCKET,
+                 timeout=Constants.LAGMON_CLIENT_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def summary(self, window=Constants.LAGMON_WINDOW, percentiles=(50, 90, 99)):
+        """
+        :return <dict>: see LagSampler.summary(), or None
+        """
+        if not path.exists(self.socket_path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall(dumps({'window': window, 'percentiles': list(percentiles)}) + "\n")
+            reply = loads(sock.makefile('rb').readline())
+        except (socket.error, socket.timeout, ValueError):
+            return None
+        finally:
+            sock.close()
+        if reply.get('status') != 'ok':
+            return None
+        return reply['summary']
+
+
+if __name__ == "__main__":
+    if argv[1:] != ["serve"]:
+        # Just quit.
+        exit(0)
+    toolkit = ToolKit()
+    if psycopg2 is None:
+        toolkit.print_stderr("lagmon requires psycopg2 (yum install python-psycopg2)")
+        exit(1)
+    sampler = LagSampler()
+    sampling = threading.Thread(target=sampler.serve)
+    sampling.daemon = True
+    sampling.start()
+    server = LagServer(Constants.LAGMON_SOCKET, sampler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        unlink(Constants.LAGMON_SOCKET)
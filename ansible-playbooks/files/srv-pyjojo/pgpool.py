@@ -0,0 +1,792 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Resident PostgreSQL connection pool for CmdRun.sql(backend="pool").
+#
+#  Run it as the postgres user so peer authentication over the local
+#  unix socket works:
+#   sudo -u postgres /bin/python /srv/pyjojo/pgpool.py serve
+#
+#  Without `serve` it just quits, this file lives next to the scripts
+#  pyjojo exposes and must not start a second pool by accident.
+#
+#  Scripts talk to it over Constants.PGPOOL_SOCKET with one JSON line
+#  per request and get back the same text psql -a would have printed,
+#  so the existing output processors keep working untouched.
+
+from __future__ import print_function
+from os import path, unlink, chmod
+from sys import argv
+from time import time
+from json import dumps, loads
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+import socket
+import threading
+import SocketServer
+
+from common import Constants, ToolKit
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+
+class PoolExhausted(Exception):
+    """
+    Raised when no connection frees up before the acquire timeout.
+    """
+    pass
+
+
+class PooledConnection():
+    """
+    CLASS: A single warm connection and the bookkeeping the pool needs
+           to decide whether it is still fit to hand out.
+    """
+
+    def __init__(self, database, conn):
+        self.database = database
+        self.conn = conn
+        self.created = time()
+        self.last_used = self.created
+
+    def age(self):
+        return time() - self.created
+
+    def idle(self):
+        return time() - self.last_used
+
+    def is_broken(self):
+        """
+        True when libpq already knows the socket is gone.
+        """
+        return self.conn.closed != 0
+
+    def ping(self):
+        """
+        Health check an idle connection with a trivial round trip.
+
+        :return <BOOL>: True if the connection answered
+        """
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def reset(self):
+        """
+        Leave no open transaction behind for the next borrower.
+        """
+        status = self.conn.get_transaction_status()
+        if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self.conn.rollback()
+
+    def close(self):
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+
+
+class ConnectionPool():
+    """
+    CLASS: Bounded pool of long lived connections over the local unix
+           socket, split into one sub-pool per database.
+
+           Connections are recycled once they pass max_age, pinged when
+           they sat idle longer than health_check_idle, and dropped when
+           broken. Total connections never exceed max_connections no
+           matter how many databases are in play.
+    """
+
+    def __init__(self, socket_dir=Constants.PGPOOL_POSTGRES_SOCKET_DIR,
+                 user=Constants.PGPOOL_POSTGRES_USER,
+                 max_connections=Constants.PGPOOL_MAX_CONNECTIONS,
+                 max_per_database=Constants.PGPOOL_MAX_PER_DATABASE,
+                 max_age=Constants.PGPOOL_MAX_AGE,
+                 health_check_idle=Constants.PGPOOL_HEALTH_CHECK_IDLE,
+                 acquire_timeout=Constants.PGPOOL_ACQUIRE_TIMEOUT):
+        self.socket_dir = socket_dir
+        self.user = user
+        self.max_connections = max_connections
+        self.max_per_database = max_per_database
+        self.max_age = max_age
+        self.health_check_idle = health_check_idle
+        self.acquire_timeout = acquire_timeout
+        self.idle = {}       # database -> [PooledConnection, ...]
+        self.in_use = {}     # database -> int
+        self.total = 0
+        self.stats = {'created': 0, 'recycled': 0, 'failed_health_check': 0,
+                      'acquired': 0, 'timeouts': 0}
+        self.lock = threading.Condition()
+
+    def connect(self, database):
+        conn = psycopg2.connect(host=self.socket_dir, user=self.user,
+                                dbname=database)
+        # psql runs every statement in autocommit unless the script
+        #  opens its own BEGIN; behave the same way.
+        conn.autocommit = True
+        return PooledConnection(database, conn)
+
+    def discard(self, pooled):
+        """
+        Close a connection and free its slot. Caller holds self.lock.
+        """
+        pooled.close()
+        self.total -= 1
+        self.lock.notify_all()
+
+    def evict_one_idle(self):
+        """
+        Close the stalest idle connection of any database to make room
+        for a database that has none. Caller holds self.lock.
+
+        :return <BOOL>: True if a slot was freed
+        """
+        stalest = None
+        for conns in self.idle.values():
+            for pooled in conns:
+                if stalest is None or pooled.last_used < stalest.last_used:
+                    stalest = pooled
+        if stalest is None:
+            return False
+        self.idle[stalest.database].remove(stalest)
+        self.discard(stalest)
+        return True
+
+    def take_idle(self, database):
+        """
+        Pop an idle connection for database, recycling any that are too
+        old or broken. Caller holds self.lock.
+
+        :return <PooledConnection>: or None when there is none left
+        """
+        conns = self.idle.get(database, [])
+        while conns:
+            pooled = conns.pop()
+            if pooled.is_broken() or pooled.age() > self.max_age:
+                self.stats['recycled'] += 1
+                self.discard(pooled)
+                continue
+            return pooled
+        return None
+
+    def reserve(self, database, deadline):
+        """
+        Wait for a slot of database and count it as in use, together
+        with an idle connection when there is one. An empty slot also
+        counts towards total, for the connection about to fill it.
+
+        :return <PooledConnection>: the idle connection, or None to connect
+        """
+        with self.lock:
+            while True:
+                pooled = self.take_idle(database)
+                in_use = self.in_use.get(database, 0)
+                if pooled is None and in_use < self.max_per_database:
+                    if self.total >= self.max_connections:
+                        self.evict_one_idle()
+                    if self.total < self.max_connections:
+                        self.total += 1
+                        self.in_use[database] = in_use + 1
+                        return None
+                if pooled is not None:
+                    self.in_use[database] = in_use + 1
+                    return pooled
+                remaining = deadline - time()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolExhausted(database)
+                self.lock.wait(remaining)
+
+    def acquire(self, database):
+        """
+        Borrow a connection for database, opening a new one when the
+        limits allow it or waiting up to acquire_timeout otherwise.
+
+        The slot is reserved under self.lock, connecting and health
+        checks then run without it: they wait on PostgreSQL, other
+        borrowers and releases must not wait on them.
+
+        :param database: <STR> database name
+        :return <PooledConnection>:
+        """
+        deadline = time() + self.acquire_timeout
+        while True:
+            pooled = self.reserve(database, deadline)
+            if pooled is None:
+                try:
+                    pooled = self.connect(database)
+                except psycopg2.Error:
+                    with self.lock:
+                        self.in_use[database] -= 1
+                        self.total -= 1
+                        self.lock.notify_all()
+                    raise
+                with self.lock:
+                    self.stats['created'] += 1
+                    self.stats['acquired'] += 1
+                return pooled
+            if pooled.idle() > self.health_check_idle and not pooled.ping():
+                with self.lock:
+                    self.stats['failed_health_check'] += 1
+                    self.in_use[database] -= 1
+                    self.discard(pooled)
+                continue
+            with self.lock:
+                self.stats['acquired'] += 1
+            return pooled
+
+    def release(self, pooled):
+        """
+        Hand a borrowed connection back to its sub-pool.
+        """
+        try:
+            if not pooled.is_broken():
+                pooled.reset()  # Still ours, no need to hold self.lock for the round trip
+        except psycopg2.Error:
+            pass
+        with self.lock:
+            self.in_use[pooled.database] -= 1
+            if pooled.is_broken() or pooled.age() > self.max_age:
+                self.stats['recycled'] += 1
+                self.discard(pooled)
+                return
+            pooled.last_used = time()
+            self.idle.setdefault(pooled.database, []).append(pooled)
+            self.lock.notify_all()
+
+    def snapshot(self):
+        """
+        :return <dict>: pool counters for the stats request
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats['total'] = self.total
+            stats['idle'] = dict((k, len(v)) for k, v in self.idle.items())
+            stats['in_use'] = dict(self.in_use)
+            return stats
+
+    def close_all(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for pooled in conns:
+                    self.discard(pooled)
+            self.idle = {}
+
+
+class StatementSplitter():
+    """
+    CLASS: Splits a psql script into single statements the way psql
+           does before sending them, honoring quotes, dollar quoting
+           and comments so semicolons inside them are left alone.
+           Backslash meta-commands run to the end of their line.
+    """
+
+    def split(self, sql):
+        """
+        :param sql: <STR> SQL script
+        :return <list>: of (line_number, statement) tuples
+        """
+        statements = []
+        start = 0
+        start_line = 1
+        line = 1
+        code = False  # Anything but comments and whitespace seen yet?
+        i = 0
+        n = len(sql)
+        while i < n:
+            c = sql[i]
+            if c == "\n":
+                line += 1
+            elif c == "\\" and not code:
+                end = sql.find("\n", i)
+                end = n if end == -1 else end
+                self.append(statements, sql[i:end], line)
+                start = end
+                start_line = line
+                i = end - 1
+            elif c == "'" or c == '"':
+                code = True
+                end = sql.find(c, i + 1)
+                while end != -1 and sql[end + 1:end + 2] == c:
+                    end = sql.find(c, end + 2)
+                end = n - 1 if end == -1 else end
+                line += sql.count("\n", i, end)
+                i = end
+            elif c == "-" and sql[i:i + 2] == "--":
+                end = sql.find("\n", i)
+                i = (n if end == -1 else end) - 1
+            elif c == "/" and sql[i:i + 2] == "/*":
+                end = sql.find("*/", i + 2)
+                end = n - 2 if end == -1 else end
+                line += sql.count("\n", i, end)
+                i = end + 1
+            elif c == "$":
+                code = True
+                tag_end = sql.find("$", i + 1)
+                tag = sql[i:tag_end + 1]
+                if tag_end != -1 and (tag == "$$" or tag[1:-1].replace("_", "").isalnum()):
+                    end = sql.find(tag, tag_end + 1)
+                    end = n - len(tag) if end == -1 else end
+                    line += sql.count("\n", i, end)
+                    i = end + len(tag) - 1
+            elif c == ";":
+                if code:
+                    self.append(statements, sql[start:i + 1], start_line)
+                start = i + 1
+                start_line = line
+                code = False
+            elif not c.isspace():
+                code = True
+            i += 1
+        if code:
+            self.append(statements, sql[start:], start_line)
+        return statements
+
+    def append(self, statements, statement, line):
+        """
+        Keep a statement, pointing line at its first real line rather
+        than the newline that followed the previous one.
+        """
+        stripped = statement.strip()
+        line += statement[:statement.index(stripped[0])].count("\n")
+        statements.append((line, stripped))
+
+
+class PsqlFormatter():
+    """
+    CLASS: Renders psycopg2 results the way `psql -a` prints them.
+    """
+
+    def text(self, value):
+        """
+        Convert a python value back into PostgreSQL's text output.
+        """
+        if value is None:
+            return ""
+        if value is True:
+            return "t"
+        if value is False:
+            return "f"
+        if isinstance(value, timedelta):
+            return self.interval(value)
+        if isinstance(value, datetime):
+            text = value.isoformat(" ")
+            # +00:00 prints as +00 in psql
+            if text[-3:] == ":00" and text[-6:-5] in ("+", "-"):
+                text = text[:-3]
+            return text
+        if isinstance(value, date):
+            return value.isoformat()
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def interval(self, delta):
+        """
+        Render a timedelta like the default IntervalStyle (postgres).
+        """
+        negative = delta < timedelta(0)
+        if negative:
+            delta = -delta
+        hours, rest = divmod(delta.seconds, 3600)
+        minutes, seconds = divmod(rest, 60)
+        clock = "{h:02d}:{m:02d}:{s:02d}".format(h=hours, m=minutes, s=seconds)
+        if delta.microseconds:
+            clock = "{c}.{us:06d}".format(c=clock, us=delta.microseconds)
+        sign = "-" if negative else ""
+        if delta.days:
+            unit = "day" if delta.days == 1 else "days"
+            return "{s}{d} {u} {s}{c}".format(s=sign, d=delta.days, u=unit, c=clock)
+        return "{s}{c}".format(s=sign, c=clock)
+
+    def expanded(self, columns, rows):
+        """
+        Render a result the way psql prints it after \\x on.
+        """
+        cells = [[self.text(v) for v in row] for row in rows]
+        key_width = max([len(c) for c in columns] or [0])
+        value_width = max([len(v) for row in cells for v in row] or [0])
+        lines = []
+        for number, row in enumerate(cells, 1):
+            header = "-[ RECORD {n} ]".format(n=number)
+            lines.append("{h}+{v}".format(h=header.ljust(key_width + 1, "-"),
+                                          v="-" * (value_width + 1)))
+            for column, cell in zip(columns, row):
+                lines.append("{k} | {v}".format(k=column.ljust(key_width), v=cell).rstrip())
+        if not rows:
+            lines.append("(0 rows)")
+        lines.append("")
+        return lines
+
+    def table(self, columns, rows):
+        """
+        Render an aligned result table with its (n rows) footer.
+        """
+        cells = [[self.text(v) for v in row] for row in rows]
+        numeric = [False] * len(columns)
+        for row in rows:
+            for idx, value in enumerate(row):
+                if isinstance(value, (int, long, float, Decimal)) and not isinstance(value, bool):
+                    numeric[idx] = True
+        widths = [len(c) for c in columns]
+        for row in cells:
+            for idx, cell in enumerate(row):
+                widths[idx] = max(widths[idx], len(cell))
+
+        lines = []
+        lines.append("|".join(" {c} ".format(c=c.center(w)) for c, w in zip(columns, widths)).rstrip())
+        lines.append("+".join("-" * (w + 2) for w in widths))
+        for row in cells:
+            out = []
+            for idx, cell in enumerate(row):
+                out.append(cell.rjust(widths[idx]) if numeric[idx] else cell.ljust(widths[idx]))
+            lines.append("|".join(" {c} ".format(c=c) for c in out).rstrip())
+        footer = "(1 row)" if len(rows) == 1 else "({n} rows)".format(n=len(rows))
+        lines.append(footer)
+        lines.append("")
+        return lines
+
+    def error(self, source, line, exc):
+        """
+        psql:/path:LINE: ERROR:  message (same shape as psql's stderr)
+        """
+        message = (exc.pgerror or str(exc)).strip()
+        if message.startswith("ERROR:") or message.startswith("FATAL:"):
+            return "psql:{src}:{line}: {msg}".format(src=source, line=line, msg=message)
+        return "psql:{src}:{line}: ERROR:  {msg}".format(src=source, line=line, msg=message)
+
+
+class ConnectFailed(Exception):
+    """
+    Raised when no connection could be had, before any SQL ran.
+    """
+    pass
+
+
+class UnsupportedMetaCommand(Exception):
+    """
+    Raised for psql meta-commands the pool cannot emulate.
+    """
+    pass
+
+
+class PoolExecutor():
+    """
+    CLASS: Runs a psql script on a pooled connection and returns the text
+           psql -a would have produced for it.
+           Of the psql meta-commands only \\x (expanded display) is
+           understood; anything else is refused up front so the caller
+           can fall back to real psql before any SQL has run.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.splitter = StatementSplitter()
+        self.formatter = PsqlFormatter()
+
+    def run(self, sql_code, source, database):
+        """
+        :param sql_code: <STR> SQL script (no psql meta-commands)
+        :param source: <STR> name used in psql:<source>:<line> messages
+        :param database: <STR> database to run against
+        :return <STR>: psql compatible output
+        """
+        statements = self.splitter.split(sql_code)
+        for line, statement in statements:
+            if statement.startswith("\\") and statement.split()[0] != "\\x":
+                raise UnsupportedMetaCommand(statement)
+
+        out = []
+        expanded = False
+        pooled = self.acquire(database)
+        try:
+            for line, statement in statements:
+                out.append(statement)
+                if statement.startswith("\\"):
+                    expanded = self.toggle_expanded(statement, expanded)
+                    out.append("Expanded display is {s}.".format(s="on" if expanded else "off"))
+                    continue
+                cursor = pooled.conn.cursor()
+                try:
+                    cursor.execute(statement)
+                except psycopg2.Error as e:
+                    out.append(self.formatter.error(source, line, e))
+                    if pooled.is_broken():
+                        break
+                    continue
+                if cursor.description is not None:
+                    columns = [d[0] for d in cursor.description]
+                    if expanded:
+                        out.extend(self.formatter.expanded(columns, cursor.fetchall()))
+                    else:
+                        out.extend(self.formatter.table(columns, cursor.fetchall()))
+                else:
+                    out.append(cursor.statusmessage)
+                cursor.close()
+        finally:
+            self.pool.release(pooled)
+        out.append("")
+        return "\n".join(out)
+
+    def run_structured(self, sql_code, database):
+        """
+        Same as run() but answers with data instead of text: columns and
+        rows of the last result set, every command tag and every error
+        with its SQLSTATE. Meta-commands are not supported here.
+
+        :return <dict>: see SqlResult.from_dict() in common
+        """
+        statements = self.splitter.split(sql_code)
+        for line, statement in statements:
+            if statement.startswith("\\"):
+                raise UnsupportedMetaCommand(statement)
+
+        result = {'columns': [], 'rows': [], 'tags': [], 'errors': []}
+        pooled = self.acquire(database)
+        try:
+            for line, statement in statements:
+                cursor = pooled.conn.cursor()
+                try:
+                    cursor.execute(statement)
+                except psycopg2.Error as e:
+                    result['errors'].append(self.error_dict(line, e))
+                    if pooled.is_broken():
+                        break
+                    continue
+                if cursor.description is not None:
+                    result['columns'] = [d[0] for d in cursor.description]
+                    result['rows'] = [[self.jsonable(v) for v in row]
+                                      for row in cursor.fetchall()]
+                else:
+                    result['tags'].append(cursor.statusmessage)
+                cursor.close()
+        finally:
+            self.pool.release(pooled)
+        result['output'] = "\n".join(
+            [dumps(dict(zip(result['columns'], row))) for row in result['rows']] +
+            result['tags'] +
+            ["{s}:  {c}: {m}".format(s=e['severity'], c=e['sqlstate'], m=e['message'])
+             for e in result['errors']])
+        return result
+
+    def acquire(self, database):
+        """
+        pool.acquire(), telling a failed connect apart from errors once
+        SQL has run.
+        """
+        try:
+            return self.pool.acquire(database)
+        except psycopg2.Error as e:
+            raise ConnectFailed(str(e).strip())
+
+    def error_dict(self, line, exc):
+        message = (exc.pgerror or str(exc)).strip().splitlines()[0]
+        severity = getattr(getattr(exc, 'diag', None), 'severity', None)
+        if severity is None:
+            severity = "FATAL" if message.startswith("FATAL:") else "ERROR"
+        for prefix in ("ERROR:", "FATAL:", "PANIC:"):
+            if message.startswith(prefix):
+                message = message[len(prefix):].strip()
+        return {'severity': severity, 'sqlstate': exc.pgcode,
+                'message': message, 'line': line}
+
+    def jsonable(self, value):
+        """
+        Values as row_to_json() would have typed them.
+        """
+        if isinstance(value, timedelta):
+            return self.formatter.interval(value)
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return float(value)
+        return value
+
+    def toggle_expanded(self, command, expanded):
+        """
+        \\x flips expanded display, \\x on / \\x off set it.
+        """
+        args = command.split()[1:]
+        if not args:
+            return not expanded
+        return args[0] == "on"
+
+
+class PoolRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    CLASS: One JSON line in, one JSON line out.
+           {"sql": ..., "source": ..., "database": ...} runs SQL,
+           adding "structured": true answers with data, not text,
+           {"stats": true} returns pool counters.
+    """
+
+    def handle(self):
+        try:
+            request = loads(self.rfile.readline())
+        except ValueError:
+            return self.reply({'status': 'error', 'error': 'BAD_REQUEST'})
+
+        if request.get('stats'):
+            return self.reply({'status': 'ok', 'stats': self.server.pool.snapshot()})
+
+        executor = self.server.executor
+        database = request.get('database', Constants.PGPOOL_DEFAULT_DATABASE)
+        try:
+            if request.get('structured'):
+                output = executor.run_structured(request['sql'], database)
+            else:
+                output = executor.run(request['sql'], request.get('source', '<stdin>'), database)
+        except UnsupportedMetaCommand:
+            return self.reply({'status': 'error', 'error': 'UNSUPPORTED_META_COMMAND'})
+        except PoolExhausted:
+            return self.reply({'status': 'error', 'error': 'POOL_EXHAUSTED'})
+        except ConnectFailed as e:
+            # Could not even connect, let the caller fall back to psql.
+            return self.reply({'status': 'error', 'error': 'CONNECT_FAILED', 'detail': str(e)})
+        except psycopg2.Error as e:
+            # Lost the connection with SQL already sent, it may have run.
+            return self.reply({'status': 'error', 'error': 'EXECUTION_FAILED',
+                               'detail': str(e).strip()})
+        self.reply({'status': 'ok', 'output': output})
+
+    def reply(self, payload):
+        self.wfile.write(dumps(payload) + "\n")
+
+
+class PoolServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    CLASS: Threaded unix socket front end for the pool.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool):
+        if path.exists(socket_path):
+            unlink(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, PoolRequestHandler)
+        chmod(socket_path, 0660)
+        self.pool = pool
+        self.executor = PoolExecutor(pool)
+
+
+class PoolClient():
+    """
+    CLASS: What CmdRun talks to. Every method returns None when the
+           SQL provably never ran (pool daemon not reachable, pool
+           exhausted, no connection, meta-commands) so callers can fall
+           back to forking psql. Once it may have run, a timeout or a
+           lost connection comes back as an error instead: running it
+           again through psql could run a CREATE or a terminate twice.
+    """
+    FALLBACK_ERRORS = ('POOL_EXHAUSTED', 'UNSUPPORTED_META_COMMAND', 'CONNECT_FAILED')
+    ERROR_MESSAGES = {
+        'POOL_TIMEOUT': "no answer from pgpool.py in time, the SQL may still be running",
+        'POOL_NO_REPLY': "pgpool.py hung up, the SQL may have run",
+        'EXECUTION_FAILED': "lost the connection while the SQL ran",
+    }
+
+    def __init__(self, socket_path=Constants.PGPOOL_SOCKET,
+                 timeout=Constants.PGPOOL_CLIENT_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, payload):
+        if not path.exists(self.socket_path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            try:
+                sock.connect(self.socket_path)
+                # Until the whole line is out the daemon runs nothing.
+                sock.sendall(dumps(payload) + "\n")
+            except socket.error:
+                return None
+            try:
+                reply = sock.makefile('rb').readline()
+            except socket.timeout:
+                return {'status': 'error', 'error': 'POOL_TIMEOUT'}
+            except socket.error:
+                reply = ""
+        finally:
+            sock.close()
+        try:
+            return loads(reply)
+        except ValueError:
+            return {'status': 'error', 'error': 'POOL_NO_REPLY'}
+
+    def fall_back(self, reply):
+        """
+        :return <BOOL>: True when the SQL never ran and psql may run it
+        """
+        return reply is None or reply.get('error') in self.FALLBACK_ERRORS
+
+    def error_message(self, reply):
+        message = "{error}: {text}".format(
+            error=reply.get('error'), text=self.ERROR_MESSAGES.get(reply.get('error'), "failed"))
+        if reply.get('detail'):
+            message = "{message} ({detail})".format(message=message, detail=reply['detail'])
+        return message
+
+    def sql(self, sql_code, source, database=Constants.PGPOOL_DEFAULT_DATABASE):
+        """
+        :return <STR>: psql compatible output, or None to fall back
+        """
+        reply = self.request({'sql': sql_code, 'source': source, 'database': database})
+        if self.fall_back(reply):
+            return None
+        if reply.get('status') != 'ok':
+            # Shaped like psql's own complaints, SqlResult.parse_errors() reads it.
+            return "psql: FATAL:  {m}\n".format(m=self.error_message(reply)).encode('utf-8')
+        return reply['output'].encode('utf-8')
+
+    def structured(self, sql_code, database=Constants.PGPOOL_DEFAULT_DATABASE):
+        """
+        :return <dict>: columns, rows, tags, errors and output, or None
+        """
+        reply = self.request({'sql': sql_code, 'database': database, 'structured': True})
+        if self.fall_back(reply):
+            return None
+        if reply.get('status') != 'ok':
+            message = self.error_message(reply)
+            return {'output': message, 'returncode': 1, 'columns': [], 'rows': [], 'tags': [],
+                    'errors': [{'severity': "FATAL", 'sqlstate': None, 'message': message,
+                                'line': None, 'hint': reply.get('error')}]}
+        return reply['output']
+
+    def stats(self):
+        reply = self.request({'stats': True})
+        if reply is None:
+            return None
+        return reply.get('stats')
+
+
+if __name__ == "__main__":
+    if argv[1:] != ["serve"]:
+        # Just quit.
+        exit(0)
+    toolkit = ToolKit()
+    if psycopg2 is None:
+        toolkit.print_stderr("pgpool requires psycopg2 (yum install python-psycopg2)")
+        exit(1)
+    pool = ConnectionPool()
+    server = PoolServer(Constants.PGPOOL_SOCKET, pool)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close_all()
+        server.server_close()
+        unlink(Constants.PGPOOL_SOCKET)
@@ -0,0 +1,279 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Fleet wide index of installed packages, kept in a local sqlite database.
+#
+#   /bin/python /srv/pyjojo/pkgindex.py collect
+#
+#  runs package_inventory.yml against Constants.PKGINDEX_HOSTS (cron
+#  runs it every hour) and stores what `rpm -qa` said on every host. It
+#  just quits without `collect`, this file lives next to the scripts
+#  pyjojo exposes. ansible_package_lookup.py, ansible_package_diff.py
+#  and ansible_package_refresh.py answer from the index, so auditing a
+#  package across the fleet no longer means a playbook run per package.
+#
+#  Package names are stored once, each host only adds rows of ids and
+#  versions. A host that could not be reached keeps the packages of its
+#  last good collection, with the error recorded next to it.
+
+from __future__ import print_function
+from os import path, makedirs
+from sys import argv
+from time import time
+from json import dumps
+from itertools import izip_longest
+from pipes import quote
+import sqlite3
+import errno
+import re as regex
+
+from common import CmdRun, Constants, ToolKit
+
+
+class RpmVersion():
+    """
+    CLASS: rpm's own ordering of epoch:version-release, rpmvercmp() and
+           labelCompare in Python.
+    """
+    SEGMENT = regex.compile(r"~|\d+|[a-zA-Z]+")
+    # [epoch:]version[-release]
+    SPEC = regex.compile(r"^(?:(\d+):)?([^-:\s]+)(?:-([^-:\s]+))?$")
+
+    def vercmp(self, one, two):
+        """
+        :return <INT>: -1, 0 or 1 as one is older, the same or newer
+        """
+        if one == two:
+            return 0
+        for a, b in izip_longest(self.SEGMENT.findall(one), self.SEGMENT.findall(two)):
+            # A tilde sorts before anything, even the end of the string.
+            if a == "~" or b == "~":
+                if a != b:
+                    return -1 if a == "~" else 1
+                continue
+            if a is None or b is None:
+                return -1 if a is None else 1
+            if a.isdigit() != b.isdigit():
+                # Numbers are newer than letters.
+                return 1 if a.isdigit() else -1
+            if a.isdigit():
+                a, b = int(a), int(b)
+            if a != b:
+                return 1 if a > b else -1
+        return 0
+
+    def compare(self, installed, spec):
+        """
+        Without a release in spec only epoch and version are compared,
+        "< 1.0.2" matches every 1.0.1 build.
+
+        :param installed: <dict> with epoch, version, release
+        :param spec: <tuple> from parse()
+        :return <INT>: -1, 0 or 1 as installed is older, the same or newer
+        """
+        epoch, version, release = spec
+        if installed['epoch'] != epoch:
+            return 1 if installed['epoch'] > epoch else -1
+        outcome = self.vercmp(installed['version'], version)
+        if outcome or release is None:
+            return outcome
+        return self.vercmp(installed['release'], release)
+
+    def parse(self, spec):
+        """
+        :param spec: <STR> EXAMPLE: 1:1.0.2k-8.el7
+        :return <tuple>: (epoch, version, release or None), None if odd
+        """
+        match = self.SPEC.match(spec)
+        if not match:
+            return None
+        epoch, version, release = match.groups()
+        return int(epoch or 0), version, release
+
+
+class PackageIndex():
+    """
+    CLASS: The package index and the lookups on it.
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS hosts ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL,"
+        " collected REAL, attempted REAL, packages INTEGER, error TEXT)",
+        "CREATE TABLE IF NOT EXISTS names ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS installed ("
+        " name INTEGER NOT NULL, host INTEGER NOT NULL, epoch INTEGER NOT NULL,"
+        " version TEXT NOT NULL, release TEXT NOT NULL, arch TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS installed_name ON installed (name, host)",
+        "CREATE INDEX IF NOT EXISTS installed_host ON installed (host)",
+    )
+    COMPARE = {'lt': lambda c: c < 0, 'le': lambda c: c <= 0, 'eq': lambda c: c == 0,
+               'ge': lambda c: c >= 0, 'gt': lambda c: c > 0}
+    ROW = ("SELECT h.name AS host, n.name AS package, i.epoch, i.version, i.release, i.arch,"
+           " h.collected FROM installed i JOIN names n ON n.id = i.name"
+           " JOIN hosts h ON h.id = i.host")
+
+    def __init__(self, filename=Constants.PKGINDEX_DB):
+        directory = path.dirname(filename)
+        if not path.isdir(directory):
+            try:
+                makedirs(directory, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self.rpm = RpmVersion()
+
+    def host_id(self, host):
+        self.db.execute("INSERT OR IGNORE INTO hosts (name) VALUES (?)", (host,))
+        return self.db.execute("SELECT id FROM hosts WHERE name = ?", (host,)).fetchone()[0]
+
+    def store(self, host, packages):
+        """
+        Replace everything known about a host.
+
+        :param packages: <list> of (name, epoch, version, release, arch)
+        """
+        with self.db:
+            host_id = self.host_id(host)
+            self.db.executemany("INSERT OR IGNORE INTO names (name) VALUES (?)",
+                                set((p[0],) for p in packages))
+            ids = dict(self.db.execute("SELECT name, id FROM names"))
+            self.db.execute("DELETE FROM installed WHERE host = ?", (host_id,))
+            self.db.executemany("INSERT INTO installed VALUES (?, ?, ?, ?, ?, ?)",
+                                [(ids[p[0]], host_id) + tuple(p[1:]) for p in packages])
+            now = time()
+            self.db.execute("UPDATE hosts SET collected = ?, attempted = ?, packages = ?,"
+                            " error = NULL WHERE id = ?", (now, now, len(packages), host_id))
+
+    def failed(self, host, error):
+        """
+        Record a collection that did not work, the old packages stay.
+        """
+        with self.db:
+            self.db.execute("UPDATE hosts SET attempted = ?, error = ? WHERE id = ?",
+                            (time(), error, self.host_id(host)))
+
+    def parse(self, stdout):
+        """
+        :param stdout: <STR> rpm -qa in package_inventory.yml's queryformat
+        :return <list>: (name, epoch, version, release, arch) tuples
+        """
+        packages = []
+        for line in stdout.splitlines():
+            fields = line.split("\t")
+            if len(fields) != 5:
+                continue
+            name, epoch, version, release, arch = fields
+            # gpg-pubkey has neither epoch nor arch.
+            packages.append((name, int(epoch) if epoch.isdigit() else 0, version, release,
+                             "" if arch == "(none)" else arch))
+        return packages
+
+    def hosts(self):
+        """
+        :return <list>: every host with when it was collected and any error
+        """
+        return [dict(r) for r in self.db.execute(
+            "SELECT name AS host, collected, attempted, packages, error FROM hosts ORDER BY name")]
+
+    def versions(self, package, host=None):
+        """
+        :return <list>: the package on every host (or one), as dicts
+        """
+        sql = self.ROW + " WHERE n.name = ?"
+        args = [package]
+        if host is not None:
+            sql += " AND h.name = ?"
+            args.append(host)
+        return [dict(r) for r in self.db.execute(sql + " ORDER BY h.name, i.arch", args)]
+
+    def matching(self, package, compare, spec):
+        """
+        :param compare: <STR> one of COMPARE, EXAMPLE: lt for "older than"
+        :param spec: <tuple> from RpmVersion.parse()
+        :return <list>: hosts with an installed package matching
+        """
+        test = self.COMPARE[compare]
+        return [row for row in self.versions(package) if test(self.rpm.compare(row, spec))]
+
+    def packages(self, host):
+        """
+        :return <dict>: "name.arch" -> [epoch:version-release, ...] of a host
+        """
+        installed = {}
+        for row in self.db.execute(self.ROW + " WHERE h.name = ?", (host,)):
+            key = "{n}.{a}".format(n=row['package'], a=row['arch']) if row['arch'] else row['package']
+            installed.setdefault(key, []).append(self.label(row))
+        for labels in installed.values():
+            labels.sort()
+        return installed
+
+    def diff(self, host, other):
+        """
+        :return <list>: dicts of package, the host's and the other's
+                        versions for every package they disagree on
+        """
+        mine, theirs = self.packages(host), self.packages(other)
+        return [{'package': key, host: mine.get(key), other: theirs.get(key)}
+                for key in sorted(set(mine) | set(theirs)) if mine.get(key) != theirs.get(key)]
+
+    def label(self, row):
+        epoch = "{e}:".format(e=row['epoch']) if row['epoch'] else ""
+        return "{e}{v}-{r}".format(e=epoch, v=row['version'], r=row['release'])
+
+
+class PackageCollector():
+    """
+    CLASS: Runs package_inventory.yml through the resident executor and
+           files every host's package list in the index.
+    """
+
+    def __init__(self, index=None, run=None):
+        self.index = index or PackageIndex()
+        self.run = run or CmdRun()
+
+    def collect(self, limit=Constants.PKGINDEX_HOSTS):
+        """
+        :param limit: <STR> ansible host pattern, as is (not shell quoted)
+        :return <dict>: hosts stored and failed, or an error
+        """
+        ansible_opts = {}
+        ansible_opts['playbook'] = Constants.PKGINDEX_PLAYBOOK
+        ansible_opts['--limit'] = quote(limit)
+        ansible_opts['--inventory-file'] = '/opt/playbooks/ansible-hosts'
+        ansible_opts['--user'] = 'vagrant'
+        ansible_opts['--forks'] = Constants.PKGINDEX_FORKS
+        # ansible-playbook output is text, rpm -qa would have to be
+        #  scraped out of it. Only the executor will do.
+        result = self.run.ansible_run(ansible_opts, fallback=False)
+        if not result.structured:
+            return {'stored': [], 'failed': [], 'error': result.error}
+        stored, failed = [], []
+        for task in result.task_results(task="List installed packages"):
+            packages = []
+            if task['status'] in ("ok", "changed") and task['result'].get('rc') == 0:
+                packages = self.index.parse(task['result'].get('stdout', ""))
+            if packages:
+                self.index.store(task['host'], packages)
+                stored.append(task['host'])
+            else:
+                self.index.failed(task['host'], task['result'].get('msg') or task['status'])
+                failed.append(task['host'])
+        return {'stored': stored, 'failed': failed, 'error': result.error}
+
+
+if __name__ == "__main__":
+    if argv[1:] != ["collect"]:
+        # Just quit.
+        exit(0)
+    outcome = PackageCollector().collect()
+    if outcome['error'] or outcome['failed']:
+        ToolKit().print_stderr(dumps(outcome))
+        exit(1)
@@ -14,140 +14,55 @@
 # param: connection_limit_bust - Raise to max_val(150)
 # param: rolename - Which role (only one currently) to add to
 # param: groupname -  Which group (only one currently) to add to
+# param: reject_overcommit - If bool set, fail when the connection limit would overcommit max_connections
 # http_method: post
-# lock: False
+# lock: role:{role}
+# cache_invalidate: psql_describe_roles
 # tags: Postgres, ALTERROLE, Psql
 # -- jojo --
 
-from os import linesep
-from common import Sanitize, CmdRun
+from common import Sanitize, CmdRun, ParamSchema
 from common import ToolKit, Constants
 from common import ParamHandle as Param
+from roles import role_attribute, ConnectionBudget
 
 # Spawn Instances
-p = Param()                       # <class> Parameter manipulation
 real_escape_string = Sanitize()   # <class> Escape Routines
 toolkit = ToolKit()               # <class> Misc. functions
-params = p.list()                 # <dict>   Input params list
 run = CmdRun()                    # <class> Runs the query
 
 
 # ************************************
 # *  DEFINE PARAMETERS AND VALIDATE  *
 # ************************************
-sanitized_arguement = {} # The actual API params we pass to psql
-
-param = "role"
-role = Param()
-role.value = params[param]
-role.name = param
-role.max_length = Constants.POSTGRES_NAMEDATA_LEN
-role.sanitizier = "sql"
-role.require = True
-sanitized_arguement[param] = role.get()
-
-param = "createrole"
-sql_when_true = " {verb} ".format(verb=param.upper())
-sql_when_false = " NO{verb} ".format(verb=param.upper())
-createrole = Param()
-createrole.value = params[param]
-createrole.name = param
-createrole.max_length = Constants.POSTGRES_NAMEDATA_LEN
-createrole.sanitizier = "sql"
-createrole.convert_to_bool(sql_when_true, sql_when_false, sql_when_false)
-sanitized_arguement[param] = createrole.get()
-
-param = "createuser"
-sql_when_true = " {verb} ".format(verb=param.upper())
-sql_when_false = " NO{verb} ".format(verb=param.upper())
-createuser = Param()
-createuser.value = params[param]
-createuser.name = param
-createuser.max_length = Constants.POSTGRES_NAMEDATA_LEN
-createuser.sanitizier = "sql"
-createuser.convert_to_bool(sql_when_true, sql_when_false, sql_when_false)
-sanitized_arguement[param] = createuser.get()
-
-param = "createdb"
-sql_when_true = " {verb} ".format(verb=param.upper())
-sql_when_false = " NO{verb} ".format(verb=param.upper())
-createdb = Param()
-createdb.value = params[param]
-createdb.name = param
-createdb.max_length = Constants.POSTGRES_NAMEDATA_LEN
-createdb.sanitizier = "sql"
-createdb.convert_to_bool(sql_when_true, sql_when_false, sql_when_false)
-sanitized_arguement[param] = createdb.get()
-
-param = "inherit"
-sql_when_true = " {verb} ".format(verb=param.upper())
-sql_when_false = " NO{verb} ".format(verb=param.upper())
-inherit = Param()
-inherit.value = params[param]
-inherit.name = param
-inherit.max_length = Constants.POSTGRES_NAMEDATA_LEN
-inherit.sanitizier = "sql"
-inherit.convert_to_bool(sql_when_true, sql_when_false, sql_when_false)
-sanitized_arguement[param] = inherit.get()
-
-param = "login"
-sql_when_true = " {verb} ".format(verb=param.upper())
-sql_when_false = " NO{verb} ".format(verb=param.upper())
-login = Param()
-login.value = params[param]
-login.name = param
-login.max_length = Constants.POSTGRES_NAMEDATA_LEN
-login.sanitizier = "sql"
-login.convert_to_bool(sql_when_true, sql_when_false, sql_when_false)
-sanitized_arguement[param] = login.get()
-
-param = "rolename"
-sql_when_true = " IN ROLE {rolename} ".format(rolename=params[param])
-sql_when_false = ""
-rolename = Param()
-rolename.value = params[param]
-rolename.name = param
-rolename.max_length = Constants.POSTGRES_NAMEDATA_LEN
-rolename.sanitizier = "sql"
-rolename.set_value_if_defined(sql_when_true, sql_when_false)
-sanitized_arguement[param] = rolename.get()
-
-param = "groupname"
-sql_when_true = " IN GROUP {groupname} ".format(groupname=params[param])
-sql_when_false = ""
-groupname = Param()
-groupname.value = params[param]
-groupname.name = param
-groupname.max_length = Constants.POSTGRES_NAMEDATA_LEN
-groupname.sanitizier = "sql"
-groupname.set_value_if_defined(sql_when_true, sql_when_false)
-sanitized_arguement[param] = groupname.get()
-
-param = "connection_limit"
-connection_limit = Param()
-connection_limit.value = params[param]
-connection_limit.name = param
-connection_limit.max_length = 3
-connection_limit.sanitizier = "sql"
-sanitized_arguement[param] = connection_limit.get()
-
-param = "connection_limit_bust"
-connection_limit_bust = Param()
-connection_limit_bust.value = params[param]
-connection_limit_bust.name = param
-connection_limit_bust.sanitizier = "sql"
-connection_limit_bust.set_value_if_defined(True)  # Set to True is defined for bool comparisons
-sanitized_arguement[param] = connection_limit_bust.get()
+schema = ParamSchema.compile("psql_alter_role", [
+    {'name': "role", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+     'sanitizer': "sql", 'require': True},
+    role_attribute("CREATEROLE"),
+    role_attribute("CREATEUSER"),
+    role_attribute("CREATEDB"),
+    role_attribute("INHERIT"),
+    role_attribute("LOGIN"),
+    {'name': "rolename", 'type': "flag", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+     'sanitizer': "sql", 'when_defined': " IN ROLE {value} ", 'default': ""},
+    {'name': "groupname", 'type': "flag", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+     'sanitizer': "sql", 'when_defined': " IN GROUP {value} ", 'default': ""},
+    {'name': "connection_limit", 'type': "int", 'max_length': 3},
+    {'name': "connection_limit_bust", 'type': "flag", 'default': False},
+    {'name': "reject_overcommit", 'type': "bool",
+     'default': Constants.CONNECTION_REJECT_OVERCOMMIT},
+])
+sanitized_arguement = schema.validate() # The actual API params we pass to psql
 
 # Handling connection limit parsing requires advanced work
 #  While imposing limits and limit busting...
 phelper = Param()  # Using the parameter instance tools for validation.
-if phelper.is_nil(sanitized_arguement['connection_limit']):
+if sanitized_arguement['connection_limit'] is None:
     # If no input, we plan on just setting 10 sockets.
-    connection_limit = 10
+    connection_limit = Constants.POSTGRES_DEFAULT_CONNECTION_LIMIT
 elif sanitized_arguement['connection_limit_bust']:
     # Limit busting has been toggled
-    if int(sanitized_arguement['connection_limit']) > Constants.POSTGRES_MAXIMUM_CONNECTION_LIMIT:
+    if sanitized_arguement['connection_limit'] > Constants.POSTGRES_MAXIMUM_CONNECTION_LIMIT:
         # If the proposed limit is not beyond the POSTGRES_MAXIMUM_CONNECTION_LIMIT, stop
         # We expect a smaller value.
         msg = "value <{max}".format(
@@ -161,7 +76,7 @@ elif sanitized_arguement['connection_limit_bust']:
     connection_limit = sanitized_arguement['connection_limit']
 else:
     # User-submitted connection limit (no limit busting)
-    if int(sanitized_arguement['connection_limit']) > Constants.POSTGRES_CONNECTION_LIMIT:
+    if sanitized_arguement['connection_limit'] > Constants.POSTGRES_CONNECTION_LIMIT:
         # If the proposed limit is beyond the POSTGRES_CONNECTION_LIMIT, stop
         # We expect a smaller value.
         msg = "value <{max}".format(max=Constants.POSTGRES_CONNECTION_LIMIT)
@@ -174,14 +89,24 @@ else:
     connection_limit = sanitized_arguement['connection_limit']
 arg_connlimit = " CONNECTION LIMIT {max} ".format(max=connection_limit)
 
+# Only roles that can log in take connection slots, the role's own
+#  current limit is the one being replaced.
+budget = ConnectionBudget()
+arg_guard = ""
+if sanitized_arguement['reject_overcommit'] and sanitized_arguement['login'].strip() == "LOGIN":
+    arg_guard = budget.guard_sql(connection_limit, role=sanitized_arguement['role'])
+
+toolkit.lock(sanitized_arguement)  # Queues behind calls on the same objects
+
 
 # ******************
 # *  SQL SENTENCE  *
 # ******************
-clean_sql = ("BEGIN; ALTER ROLE {rolname} WITH {connection_limit}{createuser}"
+clean_sql = ("BEGIN;{guard} ALTER ROLE {rolname} WITH {connection_limit}{createuser}"
              "{createrole}{createdb}{inherit}{login}"
              " {inrole}{ingroup}; END;"
              ).format(
+    guard=arg_guard,
     rolname=sanitized_arguement['role'],
     createuser=sanitized_arguement['createuser'],
     createrole=sanitized_arguement['createrole'],
@@ -193,64 +118,34 @@ clean_sql = ("BEGIN; ALTER ROLE {rolname} WITH {connection_limit}{createuser}"
     ingroup=sanitized_arguement['groupname'],
 )
 toolkit.fail_beyond_maxlength(maxlength=2000, string=clean_sql)
-sql_code = toolkit.write_temp(clean_sql)
 
 
 # ****************
 # *  SQL RUNNER  *
 # ****************
-output = run.sql(sql_code)
+result = run.execute(clean_sql)
 
 
 # **********************
 # *  OUTPUT PROCESSOR  *
 # **********************
-print(output)
-exitcode = 0
-error_scenario_1 = False
-error_scenario_2 = False
-error_scenario_3 = False
-error_scenario_4 = False
-
-for line in output.split(linesep):
-    if line == "ROLLBACK":
-        toolkit.print_stderr(line)
-        error_scenario_1 = True
-        exitcode = 1  # Rollbacks should flag an API error code.
-    if "psql:/tmp/" in line and " ERROR:  " in line:
-        toolkit.print_stderr(line)
-        error_scenario_2 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if ("ERROR:" in line) and (" role " in line) and ("does not exist" in line):
-        toolkit.print_stderr(line)
-        error_scenario_3 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if " FATAL: " in line:
-        toolkit.print_stderr(line)
-        error_scenario_4 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
+print(result.output)
+for error in result.errors:
+    toolkit.print_stderr(error)
+error_hint = result.error_hints(dict(ConnectionBudget.SQLSTATE_HINTS, **{
+    '42704': 'ROLE_DOES_NOT_EXIST'
+}))
 
 # Report Output
-if exitcode == 0:
+if not error_hint:
     # We good
     print("jojo_return_value execution_status=ok")
+    exitcode = 0
 else:
     # Errors should flag an API error code.
-    error_hint = []
-    if error_scenario_1:
-        error_hint.append('TRANSACTION_ROLLBACK')
-    if error_scenario_2:
-        error_hint.append('SQL_ERROR')
-    if error_scenario_3:
-        error_hint.append('ROLE_DOES_NOT_EXIST')
-    if error_scenario_4:
-        error_hint.append('FATAL_ERROR')
-    if len(error_hint) == 0:
-        error_hint = ['UNKNOWN']
-    if error_scenario_3:
-        error_hint.append('ROLE_DOES_NOT_EXIST')
     print("jojo_return_value execution_status=rollback")
     print("jojo_return_value error_reason_indicator={error}".format(
         error=error_hint))
+    exitcode = 1
 
 toolkit.exit(exitcode)
@@ -0,0 +1,90 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Connection slot budget, role CONNECTION LIMITs handed out against max_connections, plus live usage per role and database
+# param: kind - role, database or all (default), which usage rows to return
+# param: saturated - If bool set, only rows with as many connections as their limit allows
+# http_method: get
+# lock: False
+# tags: Postgres, Psql, Capacity
+# -- jojo --
+
+from sys import stdout
+from json import dumps
+from common import CmdRun, ToolKit, Constants, ParamSchema
+from roles import ConnectionBudget
+
+# Spawn Instances
+run = CmdRun()                    # <class> Runs the query
+toolkit = ToolKit()               # <class> Misc. functions
+budget = ConnectionBudget()       # <class> Connection slot budget
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+schema = ParamSchema.compile("psql_connection_capacity", [
+    {'name': "kind", 'max_length': 16, 'default': "all",
+     'pattern': "role|database|all", 'expected': "role, database or all"},
+    {'name': "saturated", 'type': "bool"},
+])
+sanitized_arguement = schema.validate() # The validated API params
+
+
+# ****************
+# *  SQL RUNNER  *
+# ****************
+summary = run.query(budget.summary_sql())
+usage = summary
+if summary.ok():
+    usage = run.query(budget.usage_sql())
+
+
+# **********************
+# *  OUTPUT PROCESSOR  *
+# **********************
+# One JSON object per login role, then per database, busiest first.
+for result in (summary, usage):
+    for error in result.errors:
+        toolkit.print_stderr(error)
+error_hint = summary.error_hints() or usage.error_hints()
+if not error_hint:
+    for row in usage.rows:
+        if sanitized_arguement['kind'] not in ("all", row['kind']):
+            continue
+        row['saturated'] = 0 <= row['conn_limit'] <= row['connections']
+        if sanitized_arguement['saturated'] and not row['saturated']:
+            continue
+        print(dumps(row))
+    stdout.flush()
+
+    totals = summary.rows[0]
+    unallocated = totals['capacity'] - totals['allocated']
+    for key, value in totals.items():
+        print("jojo_return_value {k}={v}".format(k=key, v=value))
+    print("jojo_return_value unallocated={n}".format(n=unallocated))
+    print("jojo_return_value overcommitted={v}".format(v=unallocated < 0))
+    print("jojo_return_value free_slots={n}".format(
+        n=totals['max_connections'] - totals['connections']))
+    # How many more roles fit at the limits the role scripts hand out.
+    for name, limit in (("default", Constants.POSTGRES_DEFAULT_CONNECTION_LIMIT),
+                        ("max", Constants.POSTGRES_CONNECTION_LIMIT),
+                        ("bust", Constants.POSTGRES_MAXIMUM_CONNECTION_LIMIT)):
+        print("jojo_return_value roles_left_at_{n}_limit={r}".format(
+            n=name, r=max(unallocated, 0) // limit))
+
+# Report Output
+if not error_hint:
+    # We good
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+else:
+    # Errors should flag an API error code.
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=error_hint))
+    exitcode = 1
+
+toolkit.exit(exitcode)
@@ -16,15 +16,17 @@
 # param: encrypted - If bool set, Toggle UNENCRYPTED else ENCRYPTED
 # param: rolename - Which role (only one currently) to add to
 # param: groupname -  Which group (only one currently) to add to
+# param: reject_overcommit - If bool set, fail when the connection limit would overcommit max_connections
 # http_method: post
-# lock: False
+# lock: role:{role}
+# cache_invalidate: psql_describe_roles
 # tags: Postgres, CREATEROLE, Psql
 # -- jojo --
 
-from os import linesep
 from common import Sanitize, CmdRun
 from common import ToolKit, Constants
 from common import ParamHandle as Param
+from roles import ConnectionBudget
 
 # Spawn Instances
 p = Param()                       # <class> Parameter manipulation
@@ -162,12 +164,23 @@ connection_limit_bust.sanitizier = "sql"
 connection_limit_bust.set_value_if_defined(True)
 sanitized_arguement[param] = connection_limit_bust.get()
 
+param = "reject_overcommit"
+reject_overcommit = Param()
+reject_overcommit.value = params[param]
+reject_overcommit.name = param
+reject_overcommit.sanitizier = "sql"
+if reject_overcommit.is_nil(reject_overcommit.value):
+    reject_overcommit.isbool = Constants.CONNECTION_REJECT_OVERCOMMIT
+else:
+    reject_overcommit.convert_to_bool()
+sanitized_arguement[param] = reject_overcommit.get()
+
 # Handling connection limit parsing requires advanced work
 #  While imposing limits and limit busting...
 phelper = Param()  # Using the parameter instance tools for validation.
 if phelper.is_nil(sanitized_arguement['connection_limit']):
     # If no input, we plan on just setting 10 sockets.
-    connection_limit = 10
+    connection_limit = Constants.POSTGRES_DEFAULT_CONNECTION_LIMIT
 elif sanitized_arguement['connection_limit_bust']:
     # Limit busting has been toggled
     if int(sanitized_arguement['connection_limit']) > Constants.POSTGRES_MAXIMUM_CONNECTION_LIMIT:
@@ -197,14 +210,23 @@ else:
     connection_limit = sanitized_arguement['connection_limit']
 arg_connlimit = " CONNECTION LIMIT {max} ".format(max=connection_limit)
 
+# Only roles that can log in take connection slots.
+budget = ConnectionBudget()
+arg_guard = ""
+if sanitized_arguement['reject_overcommit'] and sanitized_arguement['login'].strip() == "LOGIN":
+    arg_guard = budget.guard_sql(connection_limit)
+
+toolkit.lock(sanitized_arguement)  # Queues behind calls on the same objects
+
 
 # ******************
 # *  SQL SENTENCE  *
 # ******************
-clean_sql = ("BEGIN; CREATE ROLE {username} WITH {connection_limit}{createuser}"
+clean_sql = ("BEGIN;{guard} CREATE ROLE {username} WITH {connection_limit}{createuser}"
              "{createrole}{createdb}{inherit}{login}{encrypted} PASSWORD '{password}'"
              " {inrole}{ingroup}; END;"
              ).format(
+    guard=arg_guard,
     username=real_escape_string.sql(sanitized_arguement['role']),
     password=real_escape_string.sql(sanitized_arguement['password']),
     createuser=real_escape_string.sql(sanitized_arguement['createuser']),
@@ -219,63 +241,34 @@ clean_sql = ("BEGIN; CREATE ROLE {username} WITH {connection_limit}{createuser}"
 )
 # Fail if SQL overruns 2000 bytes
 toolkit.fail_beyond_maxlength(maxlength=2000, string=clean_sql)
-sql_code = toolkit.write_temp(clean_sql)
 
 
 # ****************
 # *  SQL RUNNER  *
 # ****************
-output = run.sql(sql_code)
+result = run.execute(clean_sql)
 
 
 # **********************
 # *  OUTPUT PROCESSOR  *
 # **********************
-print(output)
-exitcode = 0
-error_scenario_1 = False
-error_scenario_2 = False
-error_scenario_3 = False
-error_scenario_4 = False
-
-# Parse Output
-for line in output.split(linesep):
-    if ("ERROR:" in line) and (" role " in line) and ("already exists" in line):
-        toolkit.print_stderr(line)
-        error_scenario_1 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if (line == "ROLLBACK") or ("transaction is aborted, commands ignored" in line):
-        toolkit.print_stderr(line)
-        error_scenario_2 = True
-        exitcode = 1  # Rollbacks should flag an API error code.
-    if ("psql:/tmp/" in line) and (" ERROR:  " in line):
-        toolkit.print_stderr(line)
-        error_scenario_3 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if " FATAL: " in line:
-        toolkit.print_stderr(line)
-        error_scenario_4 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
+print(result.output)
+for error in result.errors:
+    toolkit.print_stderr(error)
+error_hint = result.error_hints(dict(ConnectionBudget.SQLSTATE_HINTS, **{
+    '42710': 'ROLE_ALREADY_EXIST'
+}))
 
 # Report Output
-if exitcode == 0:
+if not error_hint:
     # We good
     print("jojo_return_value execution_status=ok")
+    exitcode = 0
 else:
     # Errors should flag an API error code.
-    error_hint = []
-    if error_scenario_1:
-        error_hint.append('ROLE_ALREADY_EXIST')
-    if error_scenario_2:
-        error_hint.append('TRANSACTION_ROLLBACK')
-    if error_scenario_3:
-        error_hint.append('SQL_ERROR')
-    if error_scenario_4:
-        error_hint.append('FATAL_ERROR')
-    if len(error_hint) == 0:
-        error_hint = ['UNKNOWN']
     print("jojo_return_value execution_status=rollback")
     print("jojo_return_value error_reason_indicator={error}".format(
         error=error_hint))
+    exitcode = 1
 
-toolkit.exit(exitcode)
\ No newline at end of file
+toolkit.exit(exitcode)
@@ -12,11 +12,11 @@
 # param: svc_maxsock - Svc account maximum sockets
 # param: svc_password - Svc account password
 # http_method: post
-# lock: False
+# lock: database:{application}, role:{application}_super_role, role:{application}_super_svc, role:{application}_role, role:{application}_svc
+# cache_invalidate: psql_describe_roles
 # tags: Postgres, CREATEAPPTIER, Psql
 # -- jojo --
 
-from os import linesep
 from common import Sanitize, CmdRun
 from common import ToolKit, Constants
 from common import ParamHandle as Param
@@ -115,13 +115,13 @@ svc_maxsock.sanitizier = "sql"
 svc_maxsock.set_value_if_undefined(
     custom_if_value=val_when_nil, custom_else_value=val_when_not)
 sanitized_arguement[param] = svc_maxsock.get()
+toolkit.lock(sanitized_arguement)  # Queues behind calls on the same objects
 
 
 # ******************
 # *  SQL SENTENCE  *
 # ******************
 clean_sql = (
-    "\echo on\n"
     "BEGIN;\n"
     "/* Make super role  */\n"
     "CREATE  ROLE  {myapplication}_super_role  NOLOGIN;\n"
@@ -154,70 +154,35 @@ clean_sql = (
     svc_password=sanitized_arguement['svc_password']
 )
 toolkit.fail_beyond_maxlength(maxlength=1500, string=clean_sql)
-sql_code = toolkit.write_temp(clean_sql)
 
 
 # ****************
 # *  SQL RUNNER  *
 # ****************
-output = run.sql(sql_code)
+result = run.execute(clean_sql)
 
 
 # **********************
 # *  OUTPUT PROCESSOR  *
 # **********************
-print(output)
-exitcode = 0
-error_scenario_1 = False
-error_scenario_2 = False
-error_scenario_3 = False
-error_scenario_4 = False
-error_scenario_5 = False
-
-# Parse Output
-for line in output.split(linesep):
-    if ("ERROR:" in line) and (" role " in line) and ("already exists" in line):
-        toolkit.print_stderr(line)
-        error_scenario_1 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if ("ERROR:" in line) and (" database " in line) and ("already exists" in line):
-        toolkit.print_stderr(line)
-        error_scenario_2 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if (line == "ROLLBACK") or ("transaction is aborted, commands ignored" in line):
-        toolkit.print_stderr(line)
-        error_scenario_3 = True
-        exitcode = 1  # Rollbacks should flag an API error code.
-    if ("psql:/tmp/" in line) and (" ERROR:  " in line):
-        toolkit.print_stderr(line)
-        error_scenario_4 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if " FATAL: " in line:
-        toolkit.print_stderr(line)
-        error_scenario_5 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
+print(result.output)
+for error in result.errors:
+    toolkit.print_stderr(error)
+error_hint = result.error_hints({
+    '42710': 'ROLE_ALREADY_EXIST',
+    '42P04': 'DATABASE_ALREADY_EXIST'
+})
 
 # Report Output
-if exitcode == 0:
+if not error_hint:
     # We good
     print("jojo_return_value execution_status=ok")
+    exitcode = 0
 else:
     # Errors should flag an API error code.
-    error_hint = []
-    if error_scenario_1:
-        error_hint.append('ROLE_ALREADY_EXIST')
-    if error_scenario_2:
-        error_hint.append('DATABASE_ALREADY_EXIST')
-    if error_scenario_3:
-        error_hint.append('TRANSACTION_ROLLBACK')
-    if error_scenario_4:
-        error_hint.append('SQL_ERROR')
-    if error_scenario_5:
-        error_hint.append('FATAL_ERROR')
-    if len(error_hint) == 0:
-        error_hint = ['UNKNOWN']
     print("jojo_return_value execution_status=rollback")
     print("jojo_return_value error_reason_indicator={error}".format(
         error=error_hint))
+    exitcode = 1
 
-toolkit.exit(exitcode)
\ No newline at end of file
+toolkit.exit(exitcode)
@@ -0,0 +1,101 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: psql_create_role_db_hierarchy for many applications at once. Roles are created in parallel, CREATE DATABASE one at a time.
+# param: applications - JSON list of hierarchy specs, fields as in psql_create_role_db_hierarchy, EXAMPLE: [{"application": "billing", "super_password": "x", "svc_password": "y", "svc_login": true}]
+# param: workers - Applications provisioned at the same time, default is 4. Max is 16.
+# http_method: post
+# lock: database:{applications}, role:{applications}_super_role, role:{applications}_super_svc, role:{applications}_role, role:{applications}_svc
+# cache_invalidate: psql_describe_roles
+# tags: Postgres, CREATEAPPTIER, Psql
+# -- jojo --
+
+from sys import stdout
+from json import dumps, loads
+from time import time
+from common import ParamSchema
+from common import ToolKit, Constants
+from common import ParamHandle as Param
+from roles import HierarchyBatch
+
+# Spawn Instances
+toolkit = ToolKit()               # <class> Misc. functions
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+schema = ParamSchema.compile("psql_create_role_db_hierarchy_batch", [
+    {'name': "applications", 'max_length': Constants.ROLES_BATCH_MAX_BYTES,
+     'unquote': True, 'sanitizer': "escape", 'require': True},
+    {'name': "workers", 'type': "int", 'max_length': 3, 'min': 1,
+     'max': Constants.HIERARCHY_MAX_WORKERS, 'default': Constants.HIERARCHY_WORKERS},
+])
+sanitized_arguement = schema.validate() # The validated API params
+
+phelper = Param()  # Using the parameter instance tools for validation.
+try:
+    specs = loads(sanitized_arguement['applications'])
+except ValueError:
+    specs = None
+if not isinstance(specs, list) or not 0 < len(specs) <= Constants.HIERARCHY_MAX_APPLICATIONS:
+    phelper.raise_error(keyname='applications', value=sanitized_arguement['applications'][:80],
+                        expected_msg="a JSON list of 1 to {m} application specs".format(
+                            m=Constants.HIERARCHY_MAX_APPLICATIONS))
+
+# Nothing runs unless every spec passes.
+batch = HierarchyBatch(workers=sanitized_arguement['workers'])
+for index, spec in enumerate(specs):
+    batch.add(index, spec)
+toolkit.lock({'applications': [spec['application'] for spec in specs]})  # Queues behind calls on the same objects
+
+
+# ****************
+# *  SQL RUNNER  *
+# ****************
+start = time()
+report = batch.run()
+elapsed = time() - start
+
+
+# **********************
+# *  OUTPUT PROCESSOR  *
+# **********************
+# One JSON object per application, in request order.
+error_hint = []
+for item in report:
+    if item['status'] != "ok":
+        toolkit.print_stderr("{app}: {step} failed {error}".format(
+            app=item['application'], step=item['step'], error=item['error'] or ""))
+    if item['hint'] and item['hint'] not in error_hint:
+        error_hint.append(item['hint'])
+    print(dumps(item))
+stdout.flush()
+
+provisioned = len([item for item in report if item['status'] == "ok"])
+print("jojo_return_value applications={n}".format(n=len(report)))
+print("jojo_return_value applications_ok={n}".format(n=provisioned))
+print("jojo_return_value applications_failed={n}".format(n=len(report) - provisioned))
+print("jojo_return_value elapsed_seconds={s:.3f}".format(s=elapsed))
+
+# Report Output
+if provisioned == len(report):
+    # We good
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+elif provisioned:
+    # The other applications were provisioned regardless.
+    print("jojo_return_value execution_status=partial")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=error_hint))
+    exitcode = 1
+else:
+    # Errors should flag an API error code.
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=error_hint))
+    exitcode = 1
+
+toolkit.exit(exitcode)
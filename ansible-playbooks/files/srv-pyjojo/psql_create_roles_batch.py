@@ -0,0 +1,117 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Create or ALTER many ROLEs in one psql session. Every spec is validated before anything runs.
+# param: roles - JSON list of role specs, fields as in psql_create_role/psql_alter_role plus "action" (create or alter), EXAMPLE: [{"role": "app_svc", "password": "x", "login": true}]
+# param: chunk - Specs per transaction, default is 0 (the whole batch in one transaction)
+# http_method: post
+# lock: role:{roles}
+# cache_invalidate: psql_describe_roles
+# tags: Postgres, CREATEROLE, ALTERROLE, Psql
+# -- jojo --
+
+from sys import stdout
+from json import dumps, loads
+from time import time
+from common import CmdRun, ParamSchema
+from common import ToolKit, Constants
+from common import ParamHandle as Param
+from roles import RoleBatch
+
+# Spawn Instances
+toolkit = ToolKit()               # <class> Misc. functions
+run = CmdRun()                    # <class> Runs the query
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+schema = ParamSchema.compile("psql_create_roles_batch", [
+    {'name': "roles", 'max_length': Constants.ROLES_BATCH_MAX_BYTES,
+     'unquote': True, 'sanitizer': "escape", 'require': True},
+    {'name': "chunk", 'type': "int", 'max_length': 4, 'min': 0,
+     'max': Constants.ROLES_BATCH_MAX_ITEMS, 'default': Constants.ROLES_BATCH_CHUNK},
+])
+sanitized_arguement = schema.validate() # The validated API params
+
+phelper = Param()  # Using the parameter instance tools for validation.
+try:
+    specs = loads(sanitized_arguement['roles'])
+except ValueError:
+    specs = None
+if not isinstance(specs, list) or not 0 < len(specs) <= Constants.ROLES_BATCH_MAX_ITEMS:
+    phelper.raise_error(keyname='roles', value=sanitized_arguement['roles'][:80],
+                        expected_msg="a JSON list of 1 to {m} role specs".format(
+                            m=Constants.ROLES_BATCH_MAX_ITEMS))
+
+# Nothing runs unless every spec passes.
+batch = RoleBatch(chunk=sanitized_arguement['chunk'])
+for index, spec in enumerate(specs):
+    batch.add(index, spec)
+toolkit.lock({'roles': [spec['role'] for spec in specs]})  # Queues behind calls on the same objects
+
+
+# ******************
+# *  SQL SENTENCE  *
+# ******************
+clean_sql, lines = batch.script()
+
+
+# ****************
+# *  SQL RUNNER  *
+# ****************
+start = time()
+result = run.execute(clean_sql)
+elapsed = time() - start
+
+
+# **********************
+# *  OUTPUT PROCESSOR  *
+# **********************
+# One JSON object per spec, in request order.
+report = batch.report(result, lines)
+error_hint = []
+for item in report:
+    if item['status'] != "ok":
+        toolkit.print_stderr("roles[{i}] {role}: {status} {error}".format(
+            i=item['index'], role=item['role'], status=item['status'], error=item['error'] or ""))
+    if item['hint'] and item['hint'] not in error_hint:
+        error_hint.append(item['hint'])
+    print(dumps(item))
+stdout.flush()
+# Errors no spec can be blamed for (psql could not connect, ...)
+for error in result.errors:
+    if error.line not in lines:
+        toolkit.print_stderr(error)
+for hint in result.error_hints():
+    if hint not in error_hint and hint not in ('SQL_ERROR', 'TRANSACTION_ROLLBACK'):
+        error_hint.append(hint)
+
+committed = len([item for item in report if item['status'] == "ok"])
+print("jojo_return_value roles={n}".format(n=len(report)))
+print("jojo_return_value roles_ok={n}".format(n=committed))
+print("jojo_return_value roles_failed={n}".format(n=len(report) - committed))
+print("jojo_return_value transactions={n}".format(n=len(batch.chunks())))
+print("jojo_return_value elapsed_seconds={s:.3f}".format(s=elapsed))
+
+# Report Output
+if committed == len(report):
+    # We good
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+elif committed:
+    # Some transactions went through, the rest rolled back.
+    print("jojo_return_value execution_status=partial")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=error_hint))
+    exitcode = 1
+else:
+    # Errors should flag an API error code.
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=error_hint or ['UNKNOWN']))
+    exitcode = 1
+
+toolkit.exit(exitcode)
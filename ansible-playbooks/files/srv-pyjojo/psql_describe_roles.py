@@ -6,10 +6,10 @@
 # description: Retrieve a list of roles.
 # http_method: get
 # lock: False
+# cache_ttl: 10
 # tags: Postgres, Psql
 # -- jojo --
 
-from os import linesep
 from common import CmdRun, ToolKit
 
 # Spawn Instances
@@ -20,15 +20,35 @@ toolkit = ToolKit()  # <class> Misc. functions
 # ******************
 # *  SQL SENTENCE  *
 # ******************
-sql = ("\du")
-sql_code = toolkit.write_temp(sql)
+# What \du shows, as rows
+sql = ("SELECT r.rolname, r.rolsuper, r.rolinherit, r.rolcreaterole,"
+       "    r.rolcreatedb, r.rolcanlogin, r.rolconnlimit, r.rolvaliduntil,"
+       "    ARRAY(SELECT b.rolname FROM pg_catalog.pg_auth_members m"
+       "          JOIN pg_catalog.pg_roles b ON (m.roleid = b.oid)"
+       "          WHERE m.member = r.oid) AS memberof"
+       " FROM pg_catalog.pg_roles r"
+       " ORDER BY 1")
 
 
 # ****************
 # *  SQL RUNNER  *
 # ****************
-output = run.sql(sql_code)
-print(output)
-print("jojo_return_value execution_status=ok")
+result = run.query(sql)
+print(result.output)
+for error in result.errors:
+    toolkit.print_stderr(error)
+error_hint = result.error_hints()
 
-toolkit.exit(0)
+# Report Output
+if not error_hint:
+    # We good
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+else:
+    # Errors should flag an API error code.
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=error_hint))
+    exitcode = 1
+
+toolkit.exit(exitcode)
@@ -6,11 +6,11 @@
 # description: Deletes a role
 # param: role - Your ROLE name
 # http_method: post
-# lock: False
+# lock: role:{role}
+# cache_invalidate: psql_describe_roles
 # tags: Postgres, Psql
 # -- jojo --
 
-from os import linesep
 from common import Sanitize, CmdRun
 from common import ToolKit, Constants
 from common import ParamHandle as Param
@@ -36,6 +36,7 @@ role.max_length = Constants.POSTGRES_NAMEDATA_LEN
 role.require = True
 role.sanitizier = "sql"
 sanitized_arguement[param] = role.get()
+toolkit.lock(sanitized_arguement)  # Queues behind calls on the same objects
 
 
 # ******************
@@ -44,63 +45,34 @@ sanitized_arguement[param] = role.get()
 clean_sql = ("BEGIN; DROP ROLE {rolename}; END;"
              ).format(rolename=sanitized_arguement["role"])
 toolkit.fail_beyond_maxlength(maxlength=2000, string=clean_sql)
-sql_code = toolkit.write_temp(clean_sql)
 
 
 # ****************
 # *  SQL RUNNER  *
 # ****************
-output = run.sql(sql_code)
+result = run.execute(clean_sql)
 
 
 # **********************
 # *  OUTPUT PROCESSOR  *
 # **********************
-print(output)
-exitcode = 0
-error_scenario_1 = False
-error_scenario_2 = False
-error_scenario_3 = False
-error_scenario_4 = False
-
-# Process result
-for line in output.split(linesep):
-    if line == "ROLLBACK":
-        toolkit.print_stderr(line)
-        error_scenario_1 = True
-        exitcode = 1  # Rollbacks should flag an API error code.
-    if "psql:/tmp/" in line and " ERROR:  " in line:
-        toolkit.print_stderr(line)
-        error_scenario_2 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if ("ERROR:" in line) and (" role " in line) and ("does not exist" in line):
-        toolkit.print_stderr(line)
-        error_scenario_3 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if " FATAL: " in line:
-        toolkit.print_stderr(line)
-        error_scenario_4 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
+print(result.output)
+for error in result.errors:
+    toolkit.print_stderr(error)
+error_hint = result.error_hints({
+    '42704': 'ROLE_DOES_NOT_EXIST'
+})
 
 # Report Output
-if exitcode == 0:
+if not error_hint:
     # We good
     print("jojo_return_value execution_status=ok")
+    exitcode = 0
 else:
     # Errors should flag an API error code.
-    error_hint = []
-    if error_scenario_1:
-        error_hint.append('TRANSACTION_ROLLBACK')
-    if error_scenario_2:
-        error_hint.append('SQL_ERROR')
-    if error_scenario_3:
-        error_hint.append('ROLE_DOES_NOT_EXIST')
-    if error_scenario_4:
-        error_hint.append('FATAL_ERROR')
-    if len(error_hint) == 0:
-        error_hint = ['UNKNOWN']
     print("jojo_return_value execution_status=rollback")
     print("jojo_return_value error_reason_indicator={error}".format(
         error=error_hint))
+    exitcode = 1
 
-toolkit.exit(exitcode)
\ No newline at end of file
+toolkit.exit(exitcode)
@@ -0,0 +1,168 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Run a read-only psql script (psql_slave_delay, psql_is_in_recovery, ...) on every host of an inventory group at once
+# param: script - The GET script to run on each host, EXAMPLE: psql_slave_delay
+# param: environment - Inventory under ansible-hosts/, EXAMPLE: prod
+# param: hosts - Ansible host pattern, default is postgres
+# param: timeout - Seconds to wait for each host, default is 5. Max is 60.
+# param: workers - Hosts asked at the same time, default is 16. Max is 64.
+# http_method: get
+# lock: False
+# tags: Postgres, Psql, Fleet
+# -- jojo --
+
+from os import path
+from sys import stdout
+from json import dumps
+from time import time
+import re as regex
+from common import ToolKit, Constants, JojoHeader
+from common import ParamHandle as Param
+from fanout import Inventory, FanOut, PyjojoCall
+
+# Spawn Instances
+p = Param()                       # <class> Parameter manipulation
+toolkit = ToolKit()               # <class> Misc. functions
+params = p.list()                 # <dict>   Input params list
+script_dir = path.dirname(path.abspath(__file__))
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+sanitized_arguement = {} # The validated API params
+
+param = "script"
+script = Param()
+script.value = params[param]
+script.name = param
+script.max_length = Constants.LINUX_MAX_FILE_NAME_LENGTH
+script.require = True
+sanitized_arguement[param] = script.get()
+header = None
+if regex.match(r"^[A-Za-z0-9_]+$", sanitized_arguement[param]):
+    header = JojoHeader.for_script(path.join(script_dir, sanitized_arguement[param] + ".py"))
+if (header is None or not header.has_block() or
+        header.get("http_method", "post").lower() != "get" or
+        sanitized_arguement[param] == "psql_fleet_sweep"):
+    script.raise_error(keyname=param, value=sanitized_arguement[param],
+                       expected_msg="the name of a read-only (GET) script")
+
+param = "environment"
+environment = Param()
+environment.value = params[param]
+environment.name = param
+environment.max_length = Constants.LINUX_MAX_FILE_NAME_LENGTH
+environment.require = True
+sanitized_arguement[param] = environment.get()
+if (not regex.match(r"^[A-Za-z0-9_-]+$", sanitized_arguement[param]) or
+        not path.isdir(path.join(Constants.FANOUT_INVENTORY_DIR, sanitized_arguement[param]))):
+    environment.raise_error(keyname=param, value=sanitized_arguement[param],
+                            expected_msg="an inventory under {d}".format(d=Constants.FANOUT_INVENTORY_DIR))
+
+param = "hosts"
+hosts = Param()
+hosts.value = params[param]
+hosts.name = param
+hosts.max_length = Constants.LINUX_MAX_FILE_NAME_LENGTH
+hosts.default_value = "postgres"
+sanitized_arguement[param] = hosts.get()
+if not hosts.is_nil(hosts.value):
+    # Patterns with * ! or & arrive shell quoted.
+    sanitized_arguement[param] = hosts.unquote(param, sanitized_arguement[param])
+if not regex.match(r"^[A-Za-z0-9_.*!&:,-]+$", sanitized_arguement[param]):
+    hosts.raise_error(keyname=param, value=sanitized_arguement[param],
+                      expected_msg="an ansible host pattern")
+
+param = "timeout"
+timeout = Param()
+timeout.value = params[param]
+timeout.name = param
+timeout.max_length = 3
+timeout.default_value = str(Constants.FANOUT_TIMEOUT)
+sanitized_arguement[param] = timeout.get()
+if (not sanitized_arguement[param].isdigit() or
+        not 0 < int(sanitized_arguement[param]) <= Constants.FANOUT_MAX_TIMEOUT):
+    timeout.raise_error(keyname=param, value=sanitized_arguement[param],
+                        expected_msg="1 to {m}".format(m=Constants.FANOUT_MAX_TIMEOUT))
+sanitized_arguement[param] = int(sanitized_arguement[param])
+
+param = "workers"
+workers = Param()
+workers.value = params[param]
+workers.name = param
+workers.max_length = 3
+workers.default_value = str(Constants.FANOUT_WORKERS)
+sanitized_arguement[param] = workers.get()
+if (not sanitized_arguement[param].isdigit() or
+        not 0 < int(sanitized_arguement[param]) <= Constants.FANOUT_MAX_WORKERS):
+    workers.raise_error(keyname=param, value=sanitized_arguement[param],
+                        expected_msg="1 to {m}".format(m=Constants.FANOUT_MAX_WORKERS))
+sanitized_arguement[param] = int(sanitized_arguement[param])
+
+
+# *******************
+# *  RESOLVE HOSTS  *
+# *******************
+inventory = Inventory(path.join(Constants.FANOUT_INVENTORY_DIR, sanitized_arguement['environment']))
+targets = inventory.hosts(sanitized_arguement['hosts'])
+if not targets:
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(error=['NO_HOSTS_MATCHED']))
+    toolkit.exit(1)
+
+
+# *************
+# *  FAN OUT  *
+# *************
+start = time()
+call = PyjojoCall(sanitized_arguement['script'], inventory=inventory)
+fan = FanOut(workers=sanitized_arguement['workers'], timeout=sanitized_arguement['timeout'])
+results = fan.run(targets, call)
+elapsed = time() - start
+
+
+# **********************
+# *  OUTPUT PROCESSOR  *
+# **********************
+# One JSON object per host, in inventory order.
+error_hint = []
+failed = 0
+for result in results:
+    reply = result['reply'] or {}
+    if result['status'] == "ok" and reply.get('retcode', 0) != 0:
+        result['status'] = "script_error"
+    if result['status'] != "ok":
+        failed += 1
+        indicator = "HOST_{s}".format(s=result['status'].upper())
+        if indicator not in error_hint:
+            error_hint.append(indicator)
+        toolkit.print_stderr("{host}: {status} {error}".format(
+            host=result['host'], status=result['status'], error=result['error'] or ""))
+    print(dumps({'host': result['host'], 'status': result['status'],
+                 'elapsed': result['elapsed'], 'retcode': reply.get('retcode'),
+                 'return_values': reply.get('return_values', {}),
+                 'error': result['error']}))
+stdout.flush()
+
+print("jojo_return_value hosts={n}".format(n=len(results)))
+print("jojo_return_value hosts_ok={n}".format(n=len(results) - failed))
+print("jojo_return_value hosts_failed={n}".format(n=failed))
+print("jojo_return_value elapsed_seconds={s:.3f}".format(s=elapsed))
+
+# Report Output
+if not error_hint:
+    # We good
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+else:
+    # Some hosts did not answer, the rest of the fleet still did.
+    print("jojo_return_value execution_status=partial")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=error_hint))
+    exitcode = 1
+
+toolkit.exit(exitcode)
@@ -6,10 +6,11 @@
 # description: Reload server configs without restarting
 # http_method: get
 # lock: False
+# admission: write
+# cache_invalidate: all
 # tags: Postgres, Psql
 # -- jojo --
 
-from os import linesep
 from common import CmdRun, ToolKit
 
 # Spawn Instances
@@ -20,54 +21,33 @@ toolkit = ToolKit()  # <class> Misc. functions
 # ******************
 # *  SQL SENTENCE  *
 # ******************
-sql = ("BEGIN; select pg_reload_conf(); COMMIT;")
-sql_code = toolkit.write_temp(sql)
+sql = ("SELECT pg_reload_conf();")
 
 
 # ****************
 # *  SQL RUNNER  *
 # ****************
-query_result = run.sql(sql_code)
+result = run.query(sql)
 
 
 # **********************
 # *  OUTPUT PROCESSOR  *
 # **********************
-print(query_result)
-exitcode = 0  # We good
-error_scenario_1 = False
-error_scenario_2 = False
-error_scenario_3 = False
-
-for line in query_result.split(linesep):
-    if (line == "ROLLBACK") or ("transaction is aborted, commands ignored" in line):
-        toolkit.print_stderr(line)
-        error_scenario_1 = True
-        exitcode = 1  # Rollbacks should flag an API error code.
-    if ("psql:/tmp/" in line) and (" ERROR:  " in line):
-        toolkit.print_stderr(line)
-        error_scenario_2 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if " FATAL: " in line:
-        toolkit.print_stderr(line)
-        error_scenario_3 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
+print(result.output)
+for error in result.errors:
+    toolkit.print_stderr(error)
+error_hint = result.error_hints()
 
 # Report Output
-if exitcode == 0:
+if not error_hint:
     # We good
     print("jojo_return_value execution_status=ok")
+    exitcode = 0
 else:
     # Errors should flag an API error code.
-    error_hint = []
-    if error_scenario_1:
-        error_hint.append('TRANSACTION_ROLLBACK')
-    if error_scenario_2:
-        error_hint.append('SQL_ERROR')
-    if len(error_hint) == 0:
-        error_hint = ['UNKNOWN']
     print("jojo_return_value execution_status=rollback")
     print("jojo_return_value error_reason_indicator={error}".format(
         error=error_hint))
+    exitcode = 1
 
 toolkit.exit(exitcode)
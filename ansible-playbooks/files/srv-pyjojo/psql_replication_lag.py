@@ -0,0 +1,86 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: Replication lag from the lagmon.py sampler, current value plus min/max/avg/percentiles over a window. Does not query PostgreSQL.
+# param: window - Seconds of history to summarize, default is 60. Max is 3600.
+# param: percentiles - Comma separated percentiles, default is 50,90,99
+# http_method: get
+# lock: False
+# priority: high
+# tags: Postgres, Replication
+# -- jojo --
+
+from sys import stdout
+from json import dumps
+from time import time
+from common import ToolKit, Constants, ParamSchema
+from lagmon import LagClient
+
+# Spawn Instances
+toolkit = ToolKit()  # <class> Misc. functions
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+schema = ParamSchema.compile("psql_replication_lag", [
+    {'name': "window", 'type': "int", 'max_length': 5, 'min': 1,
+     'max': int(Constants.LAGMON_SAMPLES * Constants.LAGMON_INTERVAL),
+     'default': Constants.LAGMON_WINDOW},
+    {'name': "percentiles", 'max_length': 64, 'default': "50,90,99",
+     'pattern': r"(?:100|\d{1,2}(?:\.\d+)?)(?:,(?:100|\d{1,2}(?:\.\d+)?))*",
+     'expected': "comma separated numbers from 0 to 100"},
+])
+sanitized_arguement = schema.validate() # The validated API params
+percentiles = [float(p) for p in sanitized_arguement['percentiles'].split(",")]
+
+
+# *****************
+# *  LAG SUMMARY  *
+# *****************
+summary = LagClient().summary(sanitized_arguement['window'], percentiles)
+
+
+# **********************
+# *  OUTPUT PROCESSOR  *
+# **********************
+error_hint = []
+if summary is None:
+    toolkit.print_stderr("lagmon.py is not running (systemctl start pyjojo-lagmon)")
+    error_hint.append('LAGMON_NOT_RUNNING')
+elif summary['current'] is None:
+    error_hint.append('LAGMON_NO_SAMPLES')
+else:
+    current = summary['current']
+    if current['error']:
+        toolkit.print_stderr(current['error'])
+        error_hint.append('REPLICATION_STATE_UNAVAILABLE')
+    # On a primary, one JSON object per standby.
+    for standby in current['standbys'] or []:
+        print(dumps(standby))
+    stdout.flush()
+
+    print("jojo_return_value in_recovery={v}".format(v=current['in_recovery']))
+    print("jojo_return_value sample_age_seconds={s:.3f}".format(s=time() - current['ts']))
+    print("jojo_return_value samples={n}".format(n=summary['samples']))
+    print("jojo_return_value sample_errors={n}".format(n=summary['errors']))
+    for metric in ("lag_seconds", "lag_bytes"):
+        print("jojo_return_value current_{m}={v}".format(m=metric, v=current[metric]))
+        for stat, value in sorted(summary[metric].items()):
+            print("jojo_return_value {m}_{s}={v}".format(m=metric, s=stat.replace(".", "_"), v=value))
+
+# Report Output
+if not error_hint:
+    # We good
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+else:
+    # Errors should flag an API error code.
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=error_hint))
+    exitcode = 1
+
+toolkit.exit(exitcode)
@@ -6,91 +6,92 @@
 # description: Show slave delay
 # http_method: get
 # lock: False
+# priority: high
+# cache_ttl: 2
 # tags: Postgres, Psql
 # -- jojo --
 
-from os import linesep
-from common import CmdRun, ToolKit
-import re
+from time import time
+from common import CmdRun, ToolKit, Constants, SqlResult
+from lagmon import LagClient, wal_functions
 
 # Spawn Instances
-run = CmdRun()        # <class> Run
+run = CmdRun(backend="pool")  # <class> Run (pooled, falls back to psql)
 toolkit = ToolKit()  # <class> Misc. functions
 
 
+def interval(seconds):
+    """
+    :return <STR>: seconds the way PostgreSQL prints an interval, EXAMPLE: 00:00:00.346472
+    """
+    sign = "-" if seconds < 0 else ""
+    days, secs = divmod(abs(seconds), 86400)
+    minutes, secs = divmod(secs, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    clock = "{sign}{h:02d}:{m:02d}:{s:09.6f}".format(sign=sign, h=hours, m=minutes, s=secs)
+    if not days:
+        return clock
+    # EXAMPLE: 1 day 02:00:00, 3 days 02:00:00, -1 days -02:00:00
+    unit = "day" if days == 1 and not sign else "days"
+    return "{sign}{d} {unit} {clock}".format(sign=sign, d=int(days), unit=unit, clock=clock)
+
+
 # ******************
 # *  SQL SENTENCE  *
 # ******************
-sql = ("SELECT now() - pg_last_xact_replay_timestamp() AS time_lag;")
-sql_code = toolkit.write_temp(sql)
+# Same rule as lagmon.py: with everything received replayed there is no
+#  lag, however old the last replayed transaction (an idle master).
+sql = ("SELECT lag AS time_lag, extract(epoch FROM lag) AS time_lag_seconds FROM"
+       " (SELECT CASE WHEN {receive}() = {replay}() THEN interval '0'"
+       "  ELSE now() - pg_last_xact_replay_timestamp() END AS lag) AS replica;")
 
 
 # ****************
 # *  SQL RUNNER  *
 # ****************
-query_result = run.sql(sql_code)
+# A fresh lagmon.py sample saves the round trip to PostgreSQL.
+summary = LagClient().summary(window=Constants.LAGMON_MAX_AGE)
+current = summary and summary['current']
+if (current and not current['error'] and current['in_recovery'] and
+        time() - current['ts'] <= Constants.LAGMON_MAX_AGE):
+    result = SqlResult()
+    result.columns = ['time_lag', 'time_lag_seconds']
+    result.rows = [dict(time_lag=interval(current['lag_seconds']),
+                        time_lag_seconds=current['lag_seconds'])]
+else:
+    result = run.query("SELECT current_setting('server_version_num')::int AS v")
+    if result.ok() and result.rows:
+        result = run.query(sql.format(**wal_functions(int(result.first('v')))))
 
 
 # **********************
 # *  OUTPUT PROCESSOR  *
 # **********************
-print(query_result)
-exitcode = 0  # We good
-error_scenario_1 = False
-error_scenario_2 = False
-error_scenario_3 = False
-delay = "-NaN"
-
-# Match the format of  -00:00:00.000549
-#   or   00:00:00.346472
-regexp = re.compile(r'^ [- ]?(\d{2}):(\d{2}):(\d{2})\.(\d+)$')
-
-for line in query_result.split(linesep):
-    if regexp.search(line) is not None:
-        delay = line.lstrip()
+print(result.output)
+for error in result.errors:
+    toolkit.print_stderr(error)
+error_hint = result.error_hints()
 
-    if ("psql:/tmp/" in line) and (" ERROR:  " in line):
-        toolkit.print_stderr(line)
-        error_scenario_1 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if " FATAL: " in line:
-        toolkit.print_stderr(line)
-        error_scenario_2 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-
-if delay != "-NaN":
-    secs = delay.split(':')[2]
-    msecs = "0.{msec}".format(msec=secs.split(".")[1])
-    hours = delay.split(':')[0]
-    mins = delay.split(':')[1]
-    delay_sum_seconds = float(secs.split(
-        ".")[0]) + (float(hours) * 3600) + (float(mins) * 60) + float(msecs)
-else:
-    exitcode = 1
-    error_scenario_3 = True
-    secs = delay
-    hours = delay
-    mins = delay
+# time_lag looks like -00:00:00.000549 or 00:00:00.346472, it is NULL
+#  when nothing was replayed (a master).
+delay = result.first('time_lag')
+delay_sum_seconds = result.first('time_lag_seconds')
+if delay is None:
+    error_hint.append('REPLICA_DELAY_SELECT_WAS_EMPTY')
+    delay = "-NaN"
     delay_sum_seconds = delay
 
 # Report Output
-if exitcode == 0:
+if not error_hint:
     # We good
     print("jojo_return_value execution_status=ok")
+    exitcode = 0
 else:
     # Errors should flag an API error code.
-    error_hint = []
-    if error_scenario_1:
-        error_hint.append('SQL_ERROR')
-    if error_scenario_2:
-        error_hint.append('FATAL_ERROR')
-    if error_scenario_3:
-        error_hint.append('REPLICA_DELAY_SELECT_WAS_EMPTY')
-    if len(error_hint) == 0:
-        error_hint = ['UNKNOWN']
     print("jojo_return_value execution_status=rollback")
     print("jojo_return_value error_reason_indicator={error}".format(
         error=error_hint))
+    exitcode = 1
 
 print("jojo_return_value slave_delay={ts}".format(ts=delay))
 print("jojo_return_value slave_delta_in_seconds={ts}".format(
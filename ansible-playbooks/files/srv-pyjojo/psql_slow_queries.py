@@ -3,72 +3,148 @@
 # Copyright 2016, Jonathan Kelley
 # License Apache Commons v2
 # -- jojo --
-# description: Identify slow queries
+# description: Identify slow queries, longest running transactions first
+# param: min_runtime - Only transactions running at least N seconds
+# param: state - Comma separated backend states, EXAMPLE: active,idle in transaction
+# param: database - Only backends connected to this database
+# param: username - Only backends of this role
+# param: limit - Only return the first N rows
+# param: after_start - Keyset pagination, xact_start of the last row seen (next_after_start)
+# param: after_pid - Keyset pagination, pid of the last row seen (next_after_pid)
+# param: query_length - Truncate query text to N characters
+# param: columns - Comma separated columns to return (pid, xact_start, xact_runtime, state, datname, usename, query)
 # http_method: get
 # lock: False
+# priority: low
 # tags: Postgres, Psql
 # -- jojo --
 
-from os import linesep
-from common import CmdRun, ToolKit
+from sys import stdout
+from json import dumps
+from common import CmdRun, ToolKit, Sanitize, Constants, ParamSchema
+from common import ParamHandle as Param
 
 # Spawn Instances
+real_escape_string = Sanitize()   # <class> Escape Routines
 run = CmdRun()        # <class> Run
 toolkit = ToolKit()  # <class> Misc. functions
 
 
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+schema = ParamSchema.compile("psql_slow_queries", [
+    {'name': "min_runtime", 'type': "int", 'max_length': 9},
+    {'name': "state", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH, 'unquote': True,
+     'pattern': r"[a-z ()]+(?:,[a-z ()]+)*", 'expected': "comma separated backend states"},
+    {'name': "database", 'max_length': Constants.POSTGRES_NAMEDATA_LEN, 'unquote': True,
+     'pattern': r"[A-Za-z0-9_.$-]+", 'expected': "a database name"},
+    {'name': "username", 'max_length': Constants.POSTGRES_NAMEDATA_LEN, 'unquote': True,
+     'pattern': r"[A-Za-z0-9_.$-]+", 'expected': "a role name"},
+    {'name': "limit", 'type': "int", 'max_length': 9, 'min': 1},
+    {'name': "after_start", 'max_length': 40, 'unquote': True,
+     'pattern': r"infinity|\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:\.\d{1,6})?(?:[+-]\d\d(?::?\d\d)?|Z)?",
+     'expected': "a next_after_start value"},
+    {'name': "after_pid", 'type': "int", 'max_length': 10},
+    {'name': "query_length", 'type': "int", 'max_length': 9, 'min': 1},
+    {'name': "columns", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH},
+])
+sanitized_arguement = schema.validate() # The actual API params we pass to psql
+
+phelper = Param()  # Using the parameter instance tools for validation.
+states = None
+if sanitized_arguement['state'] is not None:
+    states = [s.strip() for s in sanitized_arguement['state'].split(",")]
+    for state in states:
+        if state not in Constants.POSTGRES_BACKEND_STATES:
+            phelper.raise_error(keyname='state', value=state,
+                                expected_msg=" or ".join(Constants.POSTGRES_BACKEND_STATES))
+if (sanitized_arguement['after_start'] is None) != (sanitized_arguement['after_pid'] is None):
+    phelper.raise_error(keyname='after_start', value=sanitized_arguement['after_start'],
+                        expected_msg="after_start and after_pid together")
+
+columns = None
+if sanitized_arguement['columns'] is not None:
+    columns = real_escape_string.identifier_list(sanitized_arguement['columns'])
+    if sanitized_arguement['limit'] is not None:
+        # Pages need their keyset columns to point at the next one.
+        columns += [c for c in ("xact_start", "pid") if c not in columns]
+
+
 # ******************
 # *  SQL SENTENCE  *
 # ******************
+# Every filter, the order and the page size are left to PostgreSQL, so
+#  only the rows asked for ever leave the server. Backends with no open
+#  transaction sort last.
+where = ["pid <> pg_backend_pid()"]
+if sanitized_arguement['min_runtime'] is not None:
+    where.append("xact_start <= current_timestamp - interval '{n} seconds'".format(
+        n=sanitized_arguement['min_runtime']))
+if states:
+    where.append("state IN ({states})".format(
+        states=", ".join("'{s}'".format(s=s) for s in states)))
+if sanitized_arguement['database'] is not None:
+    where.append("datname = '{d}'".format(d=sanitized_arguement['database']))
+if sanitized_arguement['username'] is not None:
+    where.append("usename = '{u}'".format(u=sanitized_arguement['username']))
+if sanitized_arguement['after_pid'] is not None:
+    where.append("(coalesce(xact_start, 'infinity'), pid) > ('{ts}'::timestamptz, {pid})".format(
+        ts=sanitized_arguement['after_start'], pid=sanitized_arguement['after_pid']))
+
+query = "query"
+if sanitized_arguement['query_length'] is not None:
+    query = "left(query, {n}) AS query".format(n=sanitized_arguement['query_length'])
+
 sql = ("SELECT"
        "    pid,"
+       "    xact_start,"
        "    current_timestamp - xact_start as xact_runtime,"
-       "    query"
-       " FROM pg_stat_activity WHERE query NOT LIKE '%pg_stat_activity%' "
-       " ORDER BY xact_start;"
-       )
-sql_code = toolkit.write_temp(sql)
+       "    state,"
+       "    datname,"
+       "    usename,"
+       "    {query}"
+       " FROM pg_stat_activity WHERE {where}"
+       " ORDER BY coalesce(xact_start, 'infinity'), pid"
+       ).format(query=query, where=" AND ".join(where))
+if sanitized_arguement['limit'] is not None:
+    sql = "{sql} LIMIT {n}".format(sql=sql, n=sanitized_arguement['limit'])
 
 
 # ****************
 # *  SQL RUNNER  *
 # ****************
-query_result = run.sql(sql_code)
+result = run.stream(sql, limit=sanitized_arguement['limit'], columns=columns)
 
 
 # **********************
 # *  OUTPUT PROCESSOR  *
 # **********************
-print(query_result)
-exitcode = 0  # We good
-error_scenario_1 = False
-error_scenario_2 = False
-
-for line in query_result.split(linesep):
-    if ("psql:/tmp/" in line) and (" ERROR:  " in line):
-        toolkit.print_stderr(line)
-        error_scenario_1 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if " FATAL: " in line:
-        toolkit.print_stderr(line)
-        error_scenario_2 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
+# Rows go out as psql hands them over, one JSON object per line.
+last = None
+for row in result:
+    print(dumps(row))
+    stdout.flush()
+    last = row
+for error in result.errors:
+    toolkit.print_stderr(error)
+error_hint = result.error_hints()
+print("jojo_return_value row_count={n}".format(n=result.row_count))
+if last is not None and result.row_count == sanitized_arguement['limit']:
+    # There may be more, ask again with these for the next page.
+    print("jojo_return_value next_after_start={ts}".format(ts=last['xact_start'] or "infinity"))
+    print("jojo_return_value next_after_pid={pid}".format(pid=last['pid']))
 
 # Report Output
-if exitcode == 0:
+if not error_hint:
     # We good
     print("jojo_return_value execution_status=ok")
+    exitcode = 0
 else:
     # Errors should flag an API error code.
-    error_hint = []
-    if error_scenario_1:
-        error_hint.append('SQL_ERROR')
-    if error_scenario_2:
-        error_hint.append('FATAL_ERROR')
-    if len(error_hint) == 0:
-        error_hint = ['UNKNOWN']
     print("jojo_return_value execution_status=rollback")
     print("jojo_return_value error_reason_indicator={error}".format(
         error=error_hint))
+    exitcode = 1
 
 toolkit.exit(exitcode)
@@ -4,33 +4,109 @@
 # License Apache Commons v2
 # -- jojo --
 # description: Retrieve pg stats connection activity (whos connected)
+# param: stream - If bool set, stream rows as they arrive (never cached)
+# param: limit - Only return the first N rows (implies stream)
+# param: columns - Comma separated pg_stat_activity columns (implies stream)
 # http_method: get
 # lock: False
+# cache_ttl: 2
 # tags: Postgres, PGaaS, cit-ops
 # -- jojo --
 
-from common import ToolKit, CmdRun
+from sys import stdout
+from json import dumps
+from common import CmdRun, ToolKit, Sanitize, Constants
+from common import ParamHandle as Param
 
 # Spawn Instances
+p = Param()                       # <class> Parameter manipulation
+real_escape_string = Sanitize()   # <class> Escape Routines
+params = p.list()                 # <dict>   Input params list
 toolkit = ToolKit()
-run = CmdRun()        # <class> Run
+run = CmdRun(backend="pool")  # <class> Run (pooled, falls back to psql)
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+sanitized_arguement = {} # The actual API params we pass to psql
+
+param = "stream"
+stream = Param()
+stream.value = params[param]
+stream.name = param
+stream.max_length = 6
+stream.convert_to_bool(True, False, False)
+sanitized_arguement[param] = stream.get()
+
+param = "limit"
+limit = Param()
+limit.value = params[param]
+limit.name = param
+limit.max_length = 9
+limit.set_value_if_undefined(None, params[param])
+sanitized_arguement[param] = limit.get()
+if sanitized_arguement[param] is not None and not sanitized_arguement[param].isdigit():
+    limit.raise_error(keyname=param, value=sanitized_arguement[param],
+                      expected_msg="a positive integer")
+if sanitized_arguement[param] is not None:
+    sanitized_arguement[param] = int(sanitized_arguement[param])
+
+param = "columns"
+columns = Param()
+columns.value = params[param]
+columns.name = param
+columns.max_length = Constants.LINUX_MAX_FILE_NAME_LENGTH
+columns.set_value_if_undefined(None, params[param])
+sanitized_arguement[param] = columns.get()
+if sanitized_arguement[param] is not None:
+    sanitized_arguement[param] = real_escape_string.identifier_list(sanitized_arguement[param])
+
+streaming = (sanitized_arguement['stream'] or
+             sanitized_arguement['limit'] is not None or
+             sanitized_arguement['columns'] is not None)
 
 
 # ******************
 # *  SQL SENTENCE  *
 # ******************
-sql = ("BEGIN; select * from pg_stat_activity; COMMIT;")
-sql_code = toolkit.write_temp(sql)
+sql = ("SELECT * FROM pg_stat_activity")
 
 # ****************
 # *  SQL RUNNER  *
 # ****************
-output = run.sql(sql_code)
+if streaming:
+    result = run.stream(sql, limit=sanitized_arguement['limit'],
+                        columns=sanitized_arguement['columns'])
+else:
+    result = run.query(sql)  # Cached for cache_ttl seconds, see jojocache.py
 
 
 # **********************
 # *  OUTPUT PROCESSOR  *
 # **********************
-print(output)
-print("jojo_return_value execution_status=ok")
-toolkit.exit()
\ No newline at end of file
+if streaming:
+    # Rows go out as psql hands them over, one JSON object per line.
+    for row in result:
+        print(dumps(row))
+        stdout.flush()
+    print("jojo_return_value row_count={n}".format(n=result.row_count))
+else:
+    print(result.output)
+for error in result.errors:
+    toolkit.print_stderr(error)
+error_hint = result.error_hints()
+
+# Report Output
+if not error_hint:
+    # We good
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+else:
+    # Errors should flag an API error code.
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=error_hint))
+    exitcode = 1
+
+toolkit.exit(exitcode)
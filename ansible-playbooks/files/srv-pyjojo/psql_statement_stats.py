@@ -0,0 +1,115 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+# -- jojo --
+# description: What each statement cost between two pg_stat_statements snapshots (calls, total/mean time, rows, shared blocks hit/read), most expensive first
+# param: from_snapshot - Older snapshot id (see list)
+# param: to_snapshot - Newer snapshot id, default is the latest
+# param: window - Compare to the latest snapshot at least N seconds older, default is 3600
+# param: fresh - If bool set, take a snapshot now and use it as to_snapshot
+# param: database - Only statements run in this database
+# param: order - total_time (default), calls, mean_time, rows or shared_blks_read
+# param: limit - Statements returned, default is 20. Max is 500.
+# param: list - If bool set, list the snapshots kept instead
+# http_method: get
+# lock: False
+# priority: low
+# tags: Postgres, Psql, Performance
+# -- jojo --
+
+from sys import stdout
+from json import dumps
+from common import ToolKit, Constants, ParamSchema
+from common import ParamHandle as Param
+from stmtsnap import StatementStore
+
+# Spawn Instances
+toolkit = ToolKit()               # <class> Misc. functions
+store = StatementStore()          # <class> Snapshot store
+
+
+# ************************************
+# *  DEFINE PARAMETERS AND VALIDATE  *
+# ************************************
+schema = ParamSchema.compile("psql_statement_stats", [
+    {'name': "from_snapshot", 'type': "int", 'max_length': 12},
+    {'name': "to_snapshot", 'type': "int", 'max_length': 12},
+    {'name': "window", 'type': "int", 'max_length': 9, 'min': 1, 'default': 3600},
+    {'name': "fresh", 'type': "bool"},
+    {'name': "database", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+     'pattern': r"[A-Za-z0-9_.$-]+", 'expected': "a database name"},
+    {'name': "order", 'max_length': 32, 'default': "total_time",
+     'pattern': "|".join(StatementStore.ORDERS), 'expected': " or ".join(StatementStore.ORDERS)},
+    {'name': "limit", 'type': "int", 'max_length': 3, 'min': 1, 'max': 500, 'default': 20},
+    {'name': "list", 'type': "bool"},
+])
+sanitized_arguement = schema.validate() # The validated API params
+phelper = Param()  # Using the parameter instance tools for validation.
+
+
+# ***************
+# *  SNAPSHOTS  *
+# ***************
+error_hint = []
+end = start = None
+if sanitized_arguement['list']:
+    for snapshot in store.snapshots():
+        print(dumps(snapshot))
+    toolkit.exit(0)
+
+if sanitized_arguement['fresh']:
+    snapshot, result = store.take()
+    for error in result.errors:
+        toolkit.print_stderr(error)
+    if snapshot is None:
+        error_hint = result.error_hints({'42P01': 'PG_STAT_STATEMENTS_MISSING'})
+    end = store.get(snapshot)
+elif sanitized_arguement['to_snapshot'] is not None:
+    end = store.get(sanitized_arguement['to_snapshot'])
+    if end is None:
+        error_hint.append('SNAPSHOT_NOT_FOUND')
+else:
+    end = store.latest()
+
+if end is not None:
+    if sanitized_arguement['from_snapshot'] is not None:
+        start = store.get(sanitized_arguement['from_snapshot'])
+        if start is None or start['id'] >= end['id']:
+            phelper.raise_error(keyname='from_snapshot', value=sanitized_arguement['from_snapshot'],
+                                expected_msg="a snapshot older than {id}".format(id=end['id']))
+    else:
+        # Younger than the window, the store still covers what it can.
+        start = store.latest(before=end['taken'] - sanitized_arguement['window']) or store.oldest()
+if not error_hint and (start is None or end is None or start['id'] == end['id']):
+    error_hint.append('NO_SNAPSHOTS')
+
+
+# **********************
+# *  OUTPUT PROCESSOR  *
+# **********************
+# One JSON object per statement, most expensive first.
+if not error_hint:
+    rows = store.deltas(start['id'], end['id'], order=sanitized_arguement['order'],
+                        limit=sanitized_arguement['limit'], datname=sanitized_arguement['database'])
+    for row in rows:
+        print(dumps(row))
+    stdout.flush()
+    print("jojo_return_value from_snapshot={id}".format(id=start['id']))
+    print("jojo_return_value to_snapshot={id}".format(id=end['id']))
+    print("jojo_return_value seconds={s:.3f}".format(s=end['taken'] - start['taken']))
+    print("jojo_return_value statements={n}".format(n=len(rows)))
+
+# Report Output
+if not error_hint:
+    # We good
+    print("jojo_return_value execution_status=ok")
+    exitcode = 0
+else:
+    # Errors should flag an API error code.
+    print("jojo_return_value execution_status=rollback")
+    print("jojo_return_value error_reason_indicator={error}".format(
+        error=error_hint))
+    exitcode = 1
+
+toolkit.exit(exitcode)
@@ -3,96 +3,71 @@
 # Copyright 2016, Jonathan Kelley
 # License Apache Commons v2
 # -- jojo --
-# description: Will terminate sockets to a user or a database.
+# description: Will terminate sockets matching every filter given (user AND database AND state ...), all at once or in paced batches.
 # param: user - If supplied, will terminate all connections to this user.
 # param: database -  If supplied, will terminate all connections to this database.
 # param: application -  If supplied, will terminate all connections to this appliccation.
-# param: pid -  If supplied, will terminate all connections to this pid.
-# param: client_address -  If supplied, will terminate all connections to this IP.
+# param: pid -  If supplied, will terminate all connections to this pid. Comma separated for several.
+# param: client_address -  If supplied, will terminate all connections to this IP, or from this CIDR network.
+# param: state - Comma separated backend states, EXAMPLE: idle in transaction
+# param: min_state_age - Only backends in their current state for at least N seconds
+# param: min_runtime - Only backends whose transaction has run at least N seconds
+# param: dry_run - If bool set, only list the matching backends, terminate nothing
+# param: batch_size - Terminate at most N backends at a time, default is all at once
+# param: pause - Milliseconds to wait between batches, default is 1000. Max is 10000.
 # http_method: post
 # lock: False
+# cache_invalidate: psql_stat_activity
 # tags: Postgres, Psql
 # -- jojo --
 
-from os import linesep
-from common import Sanitize, CmdRun
-from common import ToolKit, Constants
+from sys import stdout
+from json import dumps
+from time import time, sleep
+from common import CmdRun
+from common import ToolKit, Constants, ParamSchema
 from common import ParamHandle as Param
 
 # Spawn Instances
-p = Param()                       # <class> Parameter manipulation
-real_escape_string = Sanitize()   # <class> Escape Routines
 toolkit = ToolKit()               # <class> Misc. functions
-params = p.list()                 # <dict>   Input params list
 run = CmdRun()                    # <class> Runs the query
 
 
 # ************************************
 # *  DEFINE PARAMETERS AND VALIDATE  *
 # ************************************
-sanitized_arguement = {} # The actual API params we pass to psql
-
-param = "database"
-database = Param()
-database.value = params[param]
-database.name = param
-database.max_length = Constants.POSTGRES_NAMEDATA_LEN
-database.sanitizier = "sql"
-database.set_value_if_defined()
-sanitized_arguement[param] = database.get()
-
-param = "application"
-application = Param()
-application.value = params[param]
-application.name = param
-application.max_length = Constants.POSTGRES_NAMEDATA_LEN
-application.sanitizier = "sql"
-application.set_value_if_defined()
-sanitized_arguement[param] = application.get()
-
-param = "user"
-user = Param()
-user.value = params[param]
-user.name = param
-user.max_length = Constants.POSTGRES_NAMEDATA_LEN
-user.sanitizier = "sql"
-user.set_value_if_defined()
-sanitized_arguement[param] = user.get()
-
-param = "pid"
-pid = Param()
-pid.value = params[param]
-pid.name = param
-pid.max_length = Constants.POSTGRES_NAMEDATA_LEN
-pid.sanitizier = "sql"
-pid.set_value_if_defined()
-sanitized_arguement[param] = pid.get()
-
-param = "client_address"
-clientaddr = Param()
-clientaddr.value = params[param]
-clientaddr.name = param
-clientaddr.max_length = Constants.POSTGRES_NAMEDATA_LEN
-clientaddr.sanitizier = "sql"
-clientaddr.set_value_if_defined(True)
-sanitized_arguement[param] = clientaddr.get()
-
-if sanitized_arguement['database']:
-    arg_identifier = "datname"
-    arg_key = database.value
-elif sanitized_arguement['application']:
-    arg_identifier = "application_name"
-    arg_key = application.value
-elif sanitized_arguement['user']:
-    arg_identifier = "usename"
-    arg_key = user.value
-elif sanitized_arguement['pid']:
-    arg_identifier = "procpid"
-    arg_key = pid.value
-elif sanitized_arguement['client_address']:
-    arg_identifier = "client_addr"
-    arg_key = clientaddr.value
-else:
+schema = ParamSchema.compile("psql_terminate_sockets", [
+    {'name': "database", 'max_length': Constants.POSTGRES_NAMEDATA_LEN, 'sanitizer': "sql"},
+    {'name': "application", 'max_length': Constants.POSTGRES_NAMEDATA_LEN, 'sanitizer': "sql"},
+    {'name': "user", 'max_length': Constants.POSTGRES_NAMEDATA_LEN, 'sanitizer': "sql"},
+    {'name': "pid", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH,
+     'pattern': r"\d{1,10}(?:,\d{1,10})*", 'expected': "comma separated pids"},
+    {'name': "client_address", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+     'pattern': r"[0-9A-Fa-f:.]+(?:/\d{1,3})?", 'expected': "an IP address or CIDR network"},
+    {'name': "state", 'max_length': Constants.LINUX_MAX_FILE_NAME_LENGTH, 'unquote': True,
+     'pattern': r"[a-z ()]+(?:,[a-z ()]+)*", 'expected': "comma separated backend states"},
+    {'name': "min_state_age", 'type': "int", 'max_length': 9},
+    {'name': "min_runtime", 'type': "int", 'max_length': 9},
+    {'name': "dry_run", 'type': "bool"},
+    {'name': "batch_size", 'type': "int", 'max_length': 9, 'min': 1,
+     'max': Constants.TERMINATE_MAX_BATCH},
+    {'name': "pause", 'type': "int", 'max_length': 9, 'min': 0,
+     'max': Constants.TERMINATE_MAX_PAUSE, 'default': 1000},
+])
+sanitized_arguement = schema.validate() # The actual API params we pass to psql
+
+phelper = Param()  # Using the parameter instance tools for validation.
+states = None
+if sanitized_arguement['state'] is not None:
+    states = [s.strip() for s in sanitized_arguement['state'].split(",")]
+    for state in states:
+        if state not in Constants.POSTGRES_BACKEND_STATES:
+            phelper.raise_error(keyname='state', value=state,
+                                expected_msg=" or ".join(Constants.POSTGRES_BACKEND_STATES))
+
+filters = ("database", "application", "user", "pid", "client_address",
+           "state", "min_state_age", "min_runtime")
+if not [f for f in filters if sanitized_arguement[f] is not None]:
     toolkit.print_stderr(
         "Must provide at least 1 parameter to kill connections by.")
     exit(1)
@@ -101,77 +76,115 @@ else:
 # ******************
 # *  SQL SENTENCE  *
 # ******************
-clean_sql = ("SELECT row_to_json(t)  FROM ("
-             "    SELECT pg_terminate_backend(pid)"
-             "     FROM pg_stat_activity"
-             "       WHERE {identifier} = '{key}'"
-             ") as t; ;"
-             ).format(identifier=real_escape_string.sql(arg_identifier), key=real_escape_string.sql(arg_key))
-toolkit.fail_beyond_maxlength(maxlength=1000, string=clean_sql)
-sql_code = toolkit.write_temp(clean_sql)
+# Every filter given has to match. The caller's own backend never does.
+where = ["pid <> pg_backend_pid()"]
+if sanitized_arguement['database'] is not None:
+    where.append("datname = '{d}'".format(d=sanitized_arguement['database']))
+if sanitized_arguement['application'] is not None:
+    where.append("application_name = '{a}'".format(a=sanitized_arguement['application']))
+if sanitized_arguement['user'] is not None:
+    where.append("usename = '{u}'".format(u=sanitized_arguement['user']))
+if sanitized_arguement['pid'] is not None:
+    where.append("pid IN ({pids})".format(pids=sanitized_arguement['pid']))
+if sanitized_arguement['client_address'] is not None:
+    where.append("client_addr <<= '{c}'::inet".format(c=sanitized_arguement['client_address']))
+if states:
+    where.append("state IN ({states})".format(
+        states=", ".join("'{s}'".format(s=s) for s in states)))
+if sanitized_arguement['min_state_age'] is not None:
+    where.append("state_change <= current_timestamp - interval '{n} seconds'".format(
+        n=sanitized_arguement['min_state_age']))
+if sanitized_arguement['min_runtime'] is not None:
+    where.append("xact_start <= current_timestamp - interval '{n} seconds'".format(
+        n=sanitized_arguement['min_runtime']))
+where = " AND ".join(where)
+toolkit.fail_beyond_maxlength(maxlength=2000, string=where)
+
+match_sql = ("SELECT pid, datname, usename, application_name, client_addr, state,"
+             " extract(epoch FROM current_timestamp - state_change) AS state_age,"
+             " extract(epoch FROM current_timestamp - xact_start) AS runtime"
+             " FROM pg_stat_activity WHERE {where} ORDER BY pid").format(where=where)
+
+# A batch names its pids and checks the filters again, a pid that was
+#  reused by an unrelated backend in the meantime is left alone.
+terminate_sql = ("SELECT pid, pg_terminate_backend(pid) AS terminated"
+                 " FROM pg_stat_activity WHERE {where} AND pid IN ({pids})")
+remaining_sql = "SELECT pid FROM pg_stat_activity WHERE pid IN ({pids})"
 
 
 # ****************
 # *  SQL RUNNER  *
 # ****************
-output = run.sql(sql_code)
+# The matching backends are picked once. Batches then work through that
+#  list, so clients reconnecting meanwhile are not chased forever.
+error_hint = []
+result = run.query(match_sql)
+for error in result.errors:
+    toolkit.print_stderr(error)
+error_hint += result.error_hints()
+backends = result.rows
+matched = [row['pid'] for row in backends]
+
+signalled = []
+batches = 0
+started = time()
+if not error_hint and not sanitized_arguement['dry_run'] and matched:
+    size = sanitized_arguement['batch_size'] or len(matched)
+    for offset in range(0, len(matched), size):
+        if batches:
+            sleep(sanitized_arguement['pause'] / 1000.0)
+        pids = ", ".join(str(pid) for pid in matched[offset:offset + size])
+        result = run.query(terminate_sql.format(where=where, pids=pids))
+        batches += 1
+        for error in result.errors:
+            toolkit.print_stderr(error)
+        for hint in result.error_hints({'57P01': 'CLIENT_SOCKET_WAS_TERMINATED'}):
+            if hint not in error_hint:
+                error_hint.append(hint)
+        signalled += [row['pid'] for row in result.rows if row['terminated']]
+        if error_hint:
+            break
+elapsed = time() - started
+
+# pg_terminate_backend() only signals, see which backends actually left.
+remaining = []
+if signalled:
+    result = run.query(remaining_sql.format(pids=", ".join(str(pid) for pid in signalled)))
+    remaining = [row['pid'] for row in result.rows]
 
 
 # **********************
 # *  OUTPUT PROCESSOR  *
 # **********************
-print(output)
-exitcode = 0
-error_scenario_1 = False
-error_scenario_2 = False
-error_scenario_3 = False
-error_scenario_4 = False
-
-# Process result
-for line in output.split(linesep):
-    if line == "ROLLBACK":
-        toolkit.print_stderr(line)
-        error_scenario_1 = True
-        exitcode = 1  # Rollbacks should flag an API error code.
-    if "psql:/tmp/" in line and " ERROR:  " in line:
-        toolkit.print_stderr(line)
-        error_scenario_2 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if " FATAL:  " in line and "terminating connection due" in line:
-        toolkit.print_stderr(line)
-        error_scenario_3 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if "connection unexpectedly" in line or "terminated abnormally" in line:
-        toolkit.print_stderr(line)
-        error_scenario_3 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if "connection to server" in line and "lost" in line:
-        toolkit.print_stderr(line)
-        error_scenario_3 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
-    if " FATAL: " in line:
-        toolkit.print_stderr(line)
-        error_scenario_4 = True
-        exitcode = 1  # Parse Errors should flag an API error code.
+# Dry runs list every matching backend, one JSON object per line.
+if sanitized_arguement['dry_run']:
+    for row in backends:
+        print(dumps(row))
+    stdout.flush()
+print("jojo_return_value matched={n}".format(n=len(matched)))
+print("jojo_return_value dry_run={v}".format(v=sanitized_arguement['dry_run']))
+if not sanitized_arguement['dry_run']:
+    print("jojo_return_value batches={n}".format(n=batches))
+    print("jojo_return_value signalled={n}".format(n=len(signalled)))
+    print("jojo_return_value terminated={n}".format(n=len(signalled) - len(remaining)))
+    print("jojo_return_value still_connected={n}".format(n=len(remaining)))
+    print("jojo_return_value seconds={s:.3f}".format(s=elapsed))
+    print("jojo_return_value per_second={r:.1f}".format(
+        r=len(signalled) / elapsed if elapsed > 0 else 0.0))
+
 # Report Output
-if exitcode == 0:
+if not error_hint:
     # We good
     print("jojo_return_value execution_status=ok")
+    exitcode = 0
 else:
     # Errors should flag an API error code.
-    error_hint = []
-    if error_scenario_1:
-        error_hint.append('TRANSACTION_ROLLBACK')
-    if error_scenario_2:
-        error_hint.append('SQL_ERROR')
-    if error_scenario_3:
-        error_hint.append('CLIENT_SOCKET_WAS_TERMINATED')
-    if error_scenario_4:
-        error_hint.append('FATAL_ERROR')
-    if len(error_hint) == 0:
-        error_hint = ['UNKNOWN']
-    print("jojo_return_value execution_status=rollback")
+    if signalled:
+        print("jojo_return_value execution_status=partial")
+    else:
+        print("jojo_return_value execution_status=rollback")
     print("jojo_return_value error_reason_indicator={error}".format(
         error=error_hint))
+    exitcode = 1
 
 toolkit.exit(exitcode)
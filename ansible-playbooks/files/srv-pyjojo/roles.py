@@ -0,0 +1,514 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Role provisioning shared by the psql_*_role scripts.
+#
+#  RoleBatch takes role specs with the same fields psql_create_role.py
+#  and psql_alter_role.py take, validates every one of them before
+#  anything runs and turns the lot into one psql script: one statement
+#  per line, BEGIN/COMMIT around every chunk. The whole batch then costs
+#  one process and one connection. psql reports each error with the
+#  line it happened on, and each COMMIT answers COMMIT or ROLLBACK,
+#  which is all report() needs to tell every spec what became of it.
+#
+#  HierarchyBatch stands up many psql_create_role_db_hierarchy.py style
+#  applications at once. Each application's roles are one transaction
+#  on a connection of its own, several applications at a time; only
+#  CREATE DATABASE, which can neither run inside a transaction nor copy
+#  template1 while another copy is in progress, waits its turn.
+#
+#  ConnectionBudget weighs the CONNECTION LIMIT of every login role
+#  against the slots max_connections leaves to non superusers, and can
+#  make a CREATE/ALTER ROLE refuse a limit that would overcommit them.
+
+from Queue import Queue, Empty
+from time import time
+import threading
+
+from common import Constants, ParamSchema, ParamHandle, SqlResult, CmdRun, ToolKit
+
+
+def role_attribute(verb, negation="NO"):
+    """
+    :return <dict>: ParamSchema spec toggling VERB/NOVERB
+    """
+    return {'name': verb.lower(), 'type': "bool", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+            'when_true': " {verb} ".format(verb=verb),
+            'when_false': " {no}{verb} ".format(no=negation, verb=verb)}
+
+
+def spec_environment(spec, prefix):
+    """
+    JSON values become the strings ParamSchema expects to find in the
+    environment: true/false for booleans, digits for numbers.
+
+    :param spec: <dict> one decoded JSON object
+    :param prefix: <STR> for error messages, EXAMPLE: "roles[3]."
+    :return <dict>: upper case name -> <STR>
+    """
+    environment = {}
+    for name, value in spec.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        elif isinstance(value, (int, long)):
+            value = str(value)
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif not isinstance(value, str):
+            ParamHandle().raise_error(keyname=prefix + name, value=value,
+                                      expected_msg="a string, number or boolean")
+        environment[name.upper()] = value
+    return environment
+
+
+# Batch specs come out of JSON, not out of pyjojo's shell quoting, so no
+# value is a ready made SQL literal: names must be plain identifiers and
+# passwords are quoted here.
+ROLE_SPECS = {
+    'create': [
+        {'name': "role", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+         'sanitizer': "identifier", 'require': True},
+        {'name': "password", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+         'sanitizer': "password", 'require': True},
+        role_attribute("CREATEROLE"),
+        role_attribute("CREATEUSER"),
+        role_attribute("CREATEDB"),
+        role_attribute("INHERIT"),
+        role_attribute("LOGIN"),
+        role_attribute("ENCRYPTED", negation="UN"),
+        {'name': "rolename", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+         'sanitizer': "identifier"},
+        {'name': "groupname", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+         'sanitizer': "identifier"},
+        {'name': "connection_limit", 'type': "int", 'max_length': 3},
+        {'name': "connection_limit_bust", 'type': "flag", 'default': False},
+    ],
+    'alter': [
+        {'name': "role", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+         'sanitizer': "identifier", 'require': True},
+        role_attribute("CREATEROLE"),
+        role_attribute("CREATEUSER"),
+        role_attribute("CREATEDB"),
+        role_attribute("INHERIT"),
+        role_attribute("LOGIN"),
+        {'name': "rolename", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+         'sanitizer': "identifier"},
+        {'name': "groupname", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+         'sanitizer': "identifier"},
+        {'name': "connection_limit", 'type': "int", 'max_length': 3},
+        {'name': "connection_limit_bust", 'type': "flag", 'default': False},
+    ],
+}
+
+
+class RoleBatch():
+    """
+    CLASS: A list of role specs on their way to PostgreSQL.
+
+           EXAMPLE:
+             batch = RoleBatch(chunk=50)
+             for index, spec in enumerate(specs):
+                 batch.add(index, spec)      # exits on the first bad spec
+             sql, lines = batch.script()
+             report = batch.report(run.execute(sql), lines)
+    """
+    SQLSTATE_HINTS = {'42710': 'ROLE_ALREADY_EXIST', '42704': 'ROLE_DOES_NOT_EXIST'}
+
+    def __init__(self, chunk=Constants.ROLES_BATCH_CHUNK):
+        self.chunk = chunk            # specs per transaction, 0 for all of them
+        self.handle = ParamHandle()   # Error reporting
+        self.schemas = dict((action, ParamSchema.compile("roles_batch_" + action, specs))
+                            for action, specs in ROLE_SPECS.items())
+        self.items = []               # (action, validated values), in order
+
+    def add(self, index, spec):
+        """
+        Validate one spec, exiting like a single role script would with
+        the offending field named roles[index].field.
+
+        :param index: <INT> position in the request
+        :param spec: <dict> EXAMPLE: {"role": "x", "password": "y", "login": true}
+        """
+        prefix = "roles[{i}].".format(i=index)
+        if not isinstance(spec, dict):
+            self.handle.raise_error(keyname=prefix[:-1], value=spec, expected_msg="an object")
+        action = spec.get('action', "create")
+        if action not in self.schemas:
+            self.handle.raise_error(keyname=prefix + "action", value=action,
+                                    expected_msg=" or ".join(sorted(self.schemas)))
+        values = self.schemas[action].validate(spec_environment(spec, prefix), prefix)
+        values['connection_limit'] = self.connection_limit(values, prefix)
+        self.items.append((action, values))
+
+    def connection_limit(self, values, prefix):
+        """
+        Same limits as the single role scripts: the default when not
+        given, up to POSTGRES_CONNECTION_LIMIT, or
+        POSTGRES_MAXIMUM_CONNECTION_LIMIT with connection_limit_bust.
+
+        :return <INT>:
+        """
+        if values['connection_limit'] is None:
+            return Constants.POSTGRES_DEFAULT_CONNECTION_LIMIT
+        if values['connection_limit_bust']:
+            maximum = Constants.POSTGRES_MAXIMUM_CONNECTION_LIMIT
+        else:
+            maximum = Constants.POSTGRES_CONNECTION_LIMIT
+        if values['connection_limit'] > maximum:
+            self.handle.raise_error(keyname=prefix + "connection_limit",
+                                    value=values['connection_limit'],
+                                    expected_msg="value <{max}".format(max=maximum))
+        return values['connection_limit']
+
+    def statement(self, action, values):
+        """
+        :return <STR>: the SQL for one spec, on a single line
+        """
+        attributes = "{cu}{cr}{cd}{inh}{login}".format(
+            cu=values['createuser'], cr=values['createrole'], cd=values['createdb'],
+            inh=values['inherit'], login=values['login'])
+        if action == "create":
+            sql = ("CREATE ROLE {role} WITH CONNECTION LIMIT {limit}{attributes}{encrypted}"
+                   "PASSWORD '{password}'{inrole}{ingroup};").format(
+                role=values['role'], limit=values['connection_limit'],
+                attributes=attributes, encrypted=values['encrypted'],
+                password=values['password'].replace("'", "''"),
+                inrole=" IN ROLE {r}".format(r=values['rolename']) if values['rolename'] else "",
+                ingroup=" IN GROUP {g}".format(g=values['groupname']) if values['groupname'] else "")
+        else:
+            # ALTER ROLE has no IN ROLE, membership is a GRANT on the same line.
+            sql = "ALTER ROLE {role} WITH CONNECTION LIMIT {limit}{attributes};".format(
+                role=values['role'], limit=values['connection_limit'], attributes=attributes)
+            for parent in (values['rolename'], values['groupname']):
+                if parent:
+                    sql += " GRANT {parent} TO {role};".format(parent=parent, role=values['role'])
+        return " ".join(sql.split())
+
+    def chunks(self):
+        """
+        :return <list>: lists of item indexes, one per transaction
+        """
+        size = self.chunk or len(self.items) or 1
+        indexes = range(len(self.items))
+        return [indexes[i:i + size] for i in range(0, len(indexes), size)]
+
+    def script(self):
+        """
+        :return <tuple>: (SQL for the whole batch, {line number: item index})
+        """
+        sql = []
+        lines = {}
+        for chunk in self.chunks():
+            sql.append("BEGIN;")
+            for index in chunk:
+                sql.append(self.statement(*self.items[index]))
+                lines[len(sql)] = index
+            sql.append("COMMIT;")
+        return "\n".join(sql) + "\n", lines
+
+    def report(self, result, lines):
+        """
+        :param result: <SqlResult> of running script()
+        :param lines: <dict> line number -> item index, from script()
+        :return <list>: one dict per spec, in order, with status
+                        'ok' (committed), 'failed' (its statement erred),
+                        'rolled_back' (another one in its transaction did)
+                        or 'not_run' (psql never got that far)
+        """
+        report = [{'index': index, 'action': action, 'role': values['role'],
+                   'status': "not_run", 'sqlstate': None, 'hint': None, 'error': None}
+                  for index, (action, values) in enumerate(self.items)]
+        for error in result.errors:
+            index = lines.get(error.line)
+            if index is None or error.sqlstate == SqlResult.TRANSACTION_ABORTED:
+                continue
+            item = report[index]
+            if item['error'] is None:
+                item['sqlstate'] = error.sqlstate
+                item['hint'] = self.SQLSTATE_HINTS.get(error.sqlstate, 'SQL_ERROR')
+                item['error'] = error.message
+        endings = [tag for tag in result.tags if tag in ("COMMIT", "ROLLBACK")]
+        for chunk, ending in zip(self.chunks(), endings):
+            for index in chunk:
+                item = report[index]
+                if ending == "COMMIT":
+                    item['status'] = "ok"
+                else:
+                    item['status'] = "failed" if item['error'] else "rolled_back"
+        return report
+
+
+class ConnectionBudget():
+    """
+    CLASS: Connection slots handed out as role CONNECTION LIMITs.
+
+           capacity   max_connections less superuser_reserved_connections
+                      and Constants.CONNECTION_HEADROOM
+           allocated  sum of the limits of non superuser login roles,
+                      roles without a limit (-1) are counted apart
+
+           EXAMPLE:
+             budget = ConnectionBudget()
+             summary = run.query(budget.summary_sql()).rows[0]
+             sql = "BEGIN;" + budget.guard_sql(25, role="app_svc") + "ALTER ROLE ...; END;"
+    """
+    LOCK_KEY = "pyjojo_connection_budget"
+    OVERCOMMIT_SQLSTATE = "PJ053"
+    SQLSTATE_HINTS = {OVERCOMMIT_SQLSTATE: 'CONNECTION_LIMIT_OVERCOMMIT'}
+
+    def __init__(self, headroom=Constants.CONNECTION_HEADROOM):
+        self.headroom = headroom
+
+    def allocated_sql(self, except_role=None):
+        """
+        :param except_role: <STR> rolname left out (its limit is being replaced)
+        """
+        sql = ("SELECT coalesce(sum(rolconnlimit), 0) FROM pg_roles"
+               " WHERE rolcanlogin AND NOT rolsuper AND rolconnlimit > 0")
+        if except_role is not None:
+            sql += " AND rolname <> {name}".format(name=self.literal(except_role))
+        return sql
+
+    def capacity_sql(self):
+        return ("current_setting('max_connections')::int"
+                " - current_setting('superuser_reserved_connections')::int - {h}").format(
+            h=self.headroom)
+
+    def summary_sql(self):
+        """
+        :return <STR>: one row, the settings, the budget and live usage
+        """
+        return ("SELECT current_setting('max_connections')::int AS max_connections,"
+                " current_setting('superuser_reserved_connections')::int AS superuser_reserved,"
+                " {headroom} AS headroom, {capacity} AS capacity, ({allocated}) AS allocated,"
+                " (SELECT count(*) FROM pg_roles WHERE rolcanlogin AND NOT rolsuper"
+                " AND rolconnlimit = -1) AS unlimited_roles,"
+                " (SELECT count(*) FROM pg_stat_activity WHERE usename IS NOT NULL) AS connections,"
+                " (SELECT count(*) FROM pg_stat_activity a JOIN pg_roles r ON r.rolname = a.usename"
+                " WHERE r.rolsuper) AS superuser_connections").format(
+            headroom=self.headroom, capacity=self.capacity_sql(), allocated=self.allocated_sql())
+
+    def usage_sql(self):
+        """
+        :return <STR>: a row per login role and per database, with its
+                       limit (-1 for none) and the connections it has now
+        """
+        return ("SELECT 'role' AS kind, r.rolname AS name, r.rolconnlimit AS conn_limit,"
+                " r.rolsuper AS superuser, count(a.pid) AS connections"
+                " FROM pg_roles r LEFT JOIN pg_stat_activity a ON a.usename = r.rolname"
+                " WHERE r.rolcanlogin GROUP BY r.rolname, r.rolconnlimit, r.rolsuper"
+                " UNION ALL"
+                " SELECT 'database', d.datname, d.datconnlimit, NULL, count(a.pid)"
+                " FROM pg_database d LEFT JOIN pg_stat_activity a ON a.datid = d.oid"
+                " WHERE d.datallowconn GROUP BY d.datname, d.datconnlimit"
+                " ORDER BY 1 DESC, 5 DESC, 2")
+
+    def guard_sql(self, connection_limit, role=None):
+        """
+        Statements for the top of a role transaction: they raise
+        OVERCOMMIT_SQLSTATE when connection_limit on top of every other
+        role's limit goes over capacity. The advisory lock lines up
+        concurrent guarded transactions, so two of them can not both
+        take the last slots.
+
+        :param connection_limit: <INT> the limit being set
+        :param role: <STR> the role getting it, as written in the SQL
+        :return <STR>: SQL to run inside BEGIN/END
+        """
+        body = (
+            "DECLARE capacity int; allocated int; "
+            "BEGIN "
+            "SELECT {capacity} INTO capacity; "
+            "SELECT ({allocated}) INTO allocated; "
+            "IF allocated + {limit} > capacity THEN "
+            "RAISE EXCEPTION 'CONNECTION LIMIT {limit} overcommits connection slots: % of % already allocated',"
+            " allocated, capacity USING ERRCODE = '{sqlstate}'; "
+            "END IF; "
+            "END"
+        ).format(capacity=self.capacity_sql(), limit=int(connection_limit),
+                 allocated=self.allocated_sql(self.rolname(role) if role else None),
+                 sqlstate=self.OVERCOMMIT_SQLSTATE)
+        if "$budget$" in body:
+            raise ValueError("role name can not hold $budget$")
+        return (" SELECT pg_advisory_xact_lock(hashtext('{key}'));"
+                " DO $budget${body}$budget$; ").format(key=self.LOCK_KEY, body=body)
+
+    def rolname(self, role):
+        """
+        Unquoted identifiers are folded to lower case by PostgreSQL.
+
+        :return <STR>: role as pg_roles.rolname spells it
+        """
+        role = role.strip()
+        if len(role) > 1 and role.startswith('"') and role.endswith('"'):
+            return role[1:-1].replace('""', '"')
+        return role.lower()
+
+    def literal(self, text):
+        return "'{t}'".format(t=text.replace("'", "''"))
+
+
+HIERARCHY_SPECS = [
+    {'name': "application", 'max_length': Constants.POSTGRES_NAMEDATA_LEN - len("_super_role"),
+     'sanitizer': "identifier", 'require': True},
+    {'name': "super_password", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+     'sanitizer': "password", 'require': True},
+    {'name': "svc_password", 'max_length': Constants.POSTGRES_NAMEDATA_LEN,
+     'sanitizer': "password", 'require': True},
+    {'name': "super_svc_login", 'type': "bool", 'when_true': " LOGIN ", 'when_false': " NOLOGIN "},
+    {'name': "svc_login", 'type': "bool", 'when_true': " LOGIN ", 'when_false': " NOLOGIN "},
+    {'name': "super_maxsock", 'type': "int", 'max_length': 3, 'default': 3,
+     'min': 0, 'max': Constants.POSTGRES_MAXIMUM_CONNECTION_LIMIT},
+    {'name': "svc_maxsock", 'type': "int", 'max_length': 3, 'default': 2,
+     'min': 0, 'max': Constants.POSTGRES_MAXIMUM_CONNECTION_LIMIT},
+]
+
+
+class HierarchyBatch():
+    """
+    CLASS: Many application hierarchies (database, super role, role and
+           their svc accounts) provisioned side by side.
+
+           EXAMPLE:
+             batch = HierarchyBatch(workers=4)
+             for index, spec in enumerate(specs):
+                 batch.add(index, spec)      # exits on the first bad spec
+             report = batch.run()
+    """
+    SQLSTATE_HINTS = {'42710': 'ROLE_ALREADY_EXIST', '42P04': 'DATABASE_ALREADY_EXIST'}
+
+    def __init__(self, workers=Constants.HIERARCHY_WORKERS):
+        self.workers = workers
+        self.handle = ParamHandle()   # Error reporting
+        self.schema = ParamSchema.compile("hierarchy_batch", HIERARCHY_SPECS)
+        self.items = []               # validated values, in order
+        self.create_database = threading.Lock()
+
+    def add(self, index, spec):
+        """
+        Validate one spec, exiting with the offending field named
+        applications[index].field.
+
+        :param spec: <dict> EXAMPLE: {"application": "billing", "super_password": "x", "svc_password": "y"}
+        """
+        prefix = "applications[{i}].".format(i=index)
+        if not isinstance(spec, dict):
+            self.handle.raise_error(keyname=prefix[:-1], value=spec, expected_msg="an object")
+        values = self.schema.validate(spec_environment(spec, prefix), prefix)
+        if values['application'] in [item['application'] for item in self.items]:
+            self.handle.raise_error(keyname=prefix + "application", value=values['application'],
+                                    expected_msg="a name not already in this batch")
+        self.items.append(values)
+
+    def roles_sql(self, values):
+        """
+        :return <STR>: every role of one application, one transaction
+        """
+        return (
+            "BEGIN;\n"
+            "CREATE ROLE {app}_super_role NOLOGIN;\n"
+            "CREATE ROLE {app}_super_svc {super_login} INHERIT CONNECTION LIMIT {super_maxsock}"
+            " PASSWORD '{super_password}' IN ROLE {app}_super_role;\n"
+            "CREATE ROLE {app}_role NOLOGIN;\n"
+            "CREATE ROLE {app}_svc {svc_login} INHERIT CONNECTION LIMIT {svc_maxsock}"
+            " PASSWORD '{svc_password}' IN ROLE {app}_role;\n"
+            "COMMIT;\n"
+        ).format(app=values['application'],
+                 super_login=values['super_svc_login'].strip(),
+                 super_maxsock=values['super_maxsock'],
+                 super_password=values['super_password'].replace("'", "''"),
+                 svc_login=values['svc_login'].strip(),
+                 svc_maxsock=values['svc_maxsock'],
+                 svc_password=values['svc_password'].replace("'", "''"))
+
+    def database_sql(self, values):
+        return "CREATE DATABASE {app} OWNER {app}_super_role;\n".format(app=values['application'])
+
+    def failure(self, result):
+        """
+        :return <tuple>: (sqlstate, hint, message) of the first real error
+        """
+        for error in result.errors:
+            if error.sqlstate != SqlResult.TRANSACTION_ABORTED:
+                return (error.sqlstate, self.SQLSTATE_HINTS.get(error.sqlstate, 'SQL_ERROR'),
+                        error.message)
+        return (None, (result.error_hints() or ['UNKNOWN'])[0], result.output.strip() or None)
+
+    def item(self, values):
+        """
+        :return <dict>: the report entry of one application, before it ran
+        """
+        return {'application': values['application'], 'status': "ok", 'step': None,
+                'sqlstate': None, 'hint': None, 'error': None, 'roles_seconds': None,
+                'database_wait_seconds': None, 'database_seconds': None, 'elapsed': None}
+
+    def provision(self, values):
+        """
+        Roles first, in parallel with other applications, then the
+        database once no other CREATE DATABASE is running.
+
+        :return <dict>: what happened to this application, with timings
+        """
+        run = CmdRun()
+        start = time()
+        item = self.item(values)
+        result = run.execute(self.roles_sql(values))
+        item['roles_seconds'] = round(time() - start, 3)
+        if result.ok():
+            queued = time()
+            with self.create_database:
+                started = time()
+                item['database_wait_seconds'] = round(started - queued, 3)
+                result = run.execute(self.database_sql(values))
+                item['database_seconds'] = round(time() - started, 3)
+            step = "database"
+        else:
+            step = "roles"
+        if not result.ok():
+            item['status'], item['step'] = "failed", step
+            item['sqlstate'], item['hint'], item['error'] = self.failure(result)
+        item['elapsed'] = round(time() - start, 3)
+        return item
+
+    def run(self):
+        """
+        :return <list>: one dict per application, in the order added
+        """
+        # The workers' CmdRun calls find the slot taken, they must not
+        #  race for one each.
+        ToolKit().admit()
+        pending = Queue()
+        for index in range(len(self.items)):
+            pending.put(index)
+        report = {}
+
+        def worker():
+            while True:
+                try:
+                    index = pending.get_nowait()
+                except Empty:
+                    return
+                try:
+                    report[index] = self.provision(self.items[index])
+                except (SystemExit, Exception) as e:
+                    # An exit() only ends this thread, the application
+                    #  still needs its line in the report.
+                    item = self.item(self.items[index])
+                    item['status'], item['hint'] = "failed", "ABORTED"
+                    item['error'] = ("exited {c}".format(c=e.code) if isinstance(e, SystemExit)
+                                     else str(e) or e.__class__.__name__)
+                    report[index] = item
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.workers, len(self.items)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return [report[index] for index in range(len(self.items))]
@@ -0,0 +1,150 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Shared SSH control-socket pool for every playbook run on this host.
+#
+#   /bin/python /srv/pyjojo/sshpool.py sweep
+#
+#  health checks the pool (cron runs it every minute), without `sweep`
+#  it just quits, this file lives next to the scripts pyjojo exposes.
+#
+#  Ansible multiplexes its ssh connections on its own, but per user
+#  under ~/.ansible/cp and only for 60 seconds, so API requests a few
+#  minutes apart handshake with every host again. Runs started by
+#  ansibled.py, jobs.py and CmdRun.ansible() all export environment()
+#  instead:
+#
+#   one ControlMaster per host, user and port in Constants.SSHPOOL_DIR
+#   masters close themselves after Constants.SSHPOOL_IDLE quiet seconds
+#   pipelining on, modules go over the open session instead of being
+#     copied to the host first (targets must not require a tty for sudo)
+#
+#  sweep() drops masters that stopped answering and, past
+#  Constants.SSHPOOL_MAX_MASTERS, closes the oldest ones.
+
+from __future__ import print_function
+from os import path, listdir, makedirs, unlink, environ
+from os import stat as file_stat
+from sys import argv
+from subprocess import Popen, PIPE
+import stat
+import errno
+
+from common import Constants, ToolKit
+
+
+class SshPool():
+    """
+    CLASS: The control sockets under one directory and the ansible
+           settings pointing ssh at them.
+    """
+
+    def __init__(self, directory=Constants.SSHPOOL_DIR, idle=Constants.SSHPOOL_IDLE,
+                 max_masters=Constants.SSHPOOL_MAX_MASTERS):
+        self.directory = directory
+        self.idle = idle
+        self.max_masters = max_masters
+
+    def ssh_args(self):
+        """
+        :return <STR>: what ansible hands every ssh, scp and sftp call
+        """
+        return ("-C -o ControlMaster=auto -o ControlPersist={idle}s"
+                " -o ServerAliveInterval={alive} -o ServerAliveCountMax=3").format(
+            idle=self.idle, alive=Constants.SSHPOOL_KEEPALIVE)
+
+    def environment(self):
+        """
+        :return <dict>: ANSIBLE_* variables that put a run on the pool
+        """
+        return {'ANSIBLE_SSH_ARGS': self.ssh_args(),
+                'ANSIBLE_SSH_CONTROL_PATH_DIR': self.directory,
+                # %C is a hash of host, user and port, short enough for
+                #  the 108 byte unix socket path limit.
+                'ANSIBLE_SSH_CONTROL_PATH': "%(directory)s/%%C",
+                'ANSIBLE_PIPELINING': str(Constants.SSHPOOL_PIPELINING)}
+
+    def export(self, environment=None):
+        """
+        Put the pool settings into os.environ (or environment) unless
+        the operator already set them, then make sure the directory is
+        there. Must happen before ansible is imported or forked.
+        """
+        environment = environ if environment is None else environment
+        for key, value in self.environment().items():
+            environment.setdefault(key, value)
+        if not path.isdir(self.directory):
+            try:
+                makedirs(self.directory, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def masters(self):
+        """
+        :return <list>: (socket path, created) of every control socket,
+                        oldest first
+        """
+        try:
+            names = listdir(self.directory)
+        except OSError:
+            return []
+        sockets = []
+        for name in names:
+            filename = path.join(self.directory, name)
+            try:
+                info = file_stat(filename)
+            except OSError:
+                continue
+            if stat.S_ISSOCK(info.st_mode):
+                sockets.append((filename, info.st_mtime))
+        return sorted(sockets, key=lambda s: s[1])
+
+    def control(self, socket_path, command):
+        """
+        :param command: <STR> ssh -O command, check or exit
+        :return <BOOL>: the master answered
+        """
+        # The destination is not used, the socket path has no tokens.
+        proc = Popen(["/usr/bin/ssh", "-O", command, "-o", "ControlPath={s}".format(s=socket_path),
+                      "pool"], stdout=PIPE, stderr=PIPE)
+        proc.communicate()
+        return proc.returncode == 0
+
+    def sweep(self):
+        """
+        Health check every master, then trim the pool to max_masters.
+
+        :return <dict>: how many were alive, dead and evicted
+        """
+        alive = []
+        dead = 0
+        for socket_path, created in self.masters():
+            if self.control(socket_path, "check"):
+                alive.append(socket_path)
+                continue
+            # Master gone, a stale socket would make ssh fail instead of
+            #  opening a new one.
+            dead += 1
+            try:
+                unlink(socket_path)
+            except OSError:
+                pass
+        evicted = 0
+        for socket_path in alive[:max(len(alive) - self.max_masters, 0)]:
+            self.control(socket_path, "exit")
+            evicted += 1
+        return {'alive': len(alive) - evicted, 'dead': dead, 'evicted': evicted}
+
+
+if __name__ == "__main__":
+    if argv[1:] != ["sweep"]:
+        # Just quit.
+        exit(0)
+    counts = SshPool().sweep()
+    if counts['dead'] or counts['evicted']:
+        ToolKit().print_stderr(
+            "sshpool: {alive} alive, {dead} dead, {evicted} evicted".format(**counts))
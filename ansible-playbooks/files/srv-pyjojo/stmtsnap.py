@@ -0,0 +1,244 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# pg_stat_statements snapshots, kept in a local sqlite database.
+#
+#   /bin/python /srv/pyjojo/stmtsnap.py snapshot
+#
+#  takes one snapshot (cron runs it every few minutes), without
+#  `snapshot` it just quits, this file lives next to the scripts pyjojo
+#  exposes. psql_statement_stats.py reads the store and reports what
+#  every statement did between two snapshots, so nobody ever has to
+#  call pg_stat_statements_reset() to measure something.
+#
+#  Query texts are kept once per statement, each snapshot only adds
+#  a row of counters for the statements that ran since the last one.
+
+from __future__ import print_function
+from os import path, makedirs
+from sys import argv
+from time import time
+import sqlite3
+import errno
+
+from common import CmdRun, Constants, ToolKit
+
+
+class StatementStore():
+    """
+    CLASS: The snapshot store and the deltas between its snapshots.
+
+           counters only gets a row for a statement when its calls moved
+           since the last snapshot, so the counters of a statement as of
+           snapshot N are its newest row at or before N.
+    """
+    KEY = ("queryid", "userid", "dbid")
+    COUNTERS = ("calls", "total_time", "rows", "shared_blks_hit", "shared_blks_read")
+    ORDERS = ("total_time", "calls", "mean_time", "rows", "shared_blks_read")
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS snapshots ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, taken REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS queries ("
+        " queryid INTEGER, userid INTEGER, dbid INTEGER, datname TEXT, rolname TEXT, query TEXT,"
+        " calls INTEGER, last_seen INTEGER, PRIMARY KEY (queryid, userid, dbid))",
+        "CREATE TABLE IF NOT EXISTS counters ("
+        " queryid INTEGER, userid INTEGER, dbid INTEGER, snapshot INTEGER,"
+        " calls INTEGER, total_time REAL, rows INTEGER, shared_blks_hit INTEGER,"
+        " shared_blks_read INTEGER, PRIMARY KEY (queryid, userid, dbid, snapshot))",
+        "CREATE INDEX IF NOT EXISTS counters_snapshot ON counters (snapshot)",
+    )
+    # Newest counters row of the statement k at or before a snapshot.
+    AS_OF = ("SELECT max(x.snapshot) FROM counters x WHERE x.queryid = k.queryid"
+             " AND x.userid = k.userid AND x.dbid = k.dbid AND x.snapshot <= ?")
+
+    def __init__(self, filename=Constants.STMTSNAP_DB):
+        directory = path.dirname(filename)
+        if not path.isdir(directory):
+            try:
+                makedirs(directory, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+
+    def statements_sql(self, server_version):
+        """
+        total_time became total_exec_time in PostgreSQL 13. Before 9.4
+        there is no queryid, 60 bits of the md5 of the query stand in.
+        From 14 on a statement has a row per toplevel (run by a client
+        or from within a function), those are added up into one.
+
+        :return <STR>: the SELECT a snapshot is made of
+        """
+        total_time = "total_exec_time" if server_version >= 130000 else "total_time"
+        queryid = "s.queryid"
+        if server_version < 90400:
+            queryid = "('x' || substr(md5(s.query), 1, 15))::bit(60)::bigint"
+        sql = ("SELECT {queryid} AS queryid, s.userid, s.dbid, d.datname, r.rolname,"
+                " left(s.query, {n}) AS query, s.calls, s.{total} AS total_time, s.rows,"
+                " s.shared_blks_hit, s.shared_blks_read"
+                " FROM pg_stat_statements s"
+                " LEFT JOIN pg_database d ON d.oid = s.dbid"
+                " LEFT JOIN pg_roles r ON r.oid = s.userid"
+                " WHERE {queryid} IS NOT NULL").format(
+            queryid=queryid, n=Constants.STMTSNAP_QUERY_LENGTH, total=total_time)
+        if server_version < 140000:
+            return sql
+        return ("SELECT queryid, userid, dbid, datname, rolname, min(query) AS query,"
+                " sum(calls)::bigint AS calls, sum(total_time) AS total_time,"
+                " sum(rows)::bigint AS rows, sum(shared_blks_hit)::bigint AS shared_blks_hit,"
+                " sum(shared_blks_read)::bigint AS shared_blks_read"
+                " FROM ({sql}) s GROUP BY queryid, userid, dbid, datname, rolname").format(sql=sql)
+
+    def take(self, run=None):
+        """
+        Read pg_stat_statements and store it as a new snapshot.
+
+        :param run: <CmdRun> to query with
+        :return <tuple>: (snapshot id or None, SqlResult of the query)
+        """
+        run = run or CmdRun()
+        version = run.query("SELECT current_setting('server_version_num')::int AS v")
+        if not version.ok():
+            return None, version
+        result = run.query(self.statements_sql(int(version.first('v'))))
+        if not result.ok():
+            return None, result
+        known = dict(((r[0], r[1], r[2]), r[3]) for r in
+                     self.db.execute("SELECT queryid, userid, dbid, calls FROM queries"))
+        with self.db:
+            snapshot = self.db.execute("INSERT INTO snapshots (taken) VALUES (?)",
+                                       (time(),)).lastrowid
+            fresh, moved = [], []
+            for row in result.rows:
+                key = tuple(row[k] for k in self.KEY)
+                if key not in known:
+                    fresh.append(row)
+                if known.get(key) != row['calls']:
+                    moved.append(row)
+            self.db.executemany(
+                "INSERT INTO queries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(r['queryid'], r['userid'], r['dbid'], r['datname'], r['rolname'], r['query'],
+                  r['calls'], snapshot) for r in fresh])
+            self.db.executemany(
+                "INSERT INTO counters VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(r['queryid'], r['userid'], r['dbid'], snapshot, r['calls'], r['total_time'],
+                  r['rows'], r['shared_blks_hit'], r['shared_blks_read']) for r in moved])
+            self.db.executemany(
+                "UPDATE queries SET calls = ?, last_seen = ?"
+                " WHERE queryid = ? AND userid = ? AND dbid = ?",
+                [(r['calls'], snapshot, r['queryid'], r['userid'], r['dbid']) for r in result.rows])
+        return snapshot, result
+
+    def snapshots(self, limit=100):
+        """
+        :return <list>: newest first, dicts with id, taken and how many
+                        statements moved since the snapshot before
+        """
+        return [dict(r) for r in self.db.execute(
+            "SELECT s.id, s.taken, (SELECT count(*) FROM counters c WHERE c.snapshot = s.id)"
+            " AS statements FROM snapshots s ORDER BY s.id DESC LIMIT ?", (limit,))]
+
+    def get(self, snapshot):
+        row = self.db.execute("SELECT id, taken FROM snapshots WHERE id = ?", (snapshot,)).fetchone()
+        return dict(row) if row else None
+
+    def latest(self, before=None):
+        """
+        :param before: <FLOAT> only snapshots taken at or before this time
+        :return <dict>: the newest such snapshot, None if there is none
+        """
+        row = self.db.execute(
+            "SELECT id, taken FROM snapshots WHERE taken <= ? ORDER BY taken DESC LIMIT 1",
+            (before if before is not None else time(),)).fetchone()
+        return dict(row) if row else None
+
+    def oldest(self):
+        row = self.db.execute("SELECT id, taken FROM snapshots ORDER BY id LIMIT 1").fetchone()
+        return dict(row) if row else None
+
+    def deltas(self, start, end, order="total_time", limit=20, datname=None):
+        """
+        What every statement did between two snapshots, ranked in SQL.
+        Only statements with a counters row in between can have moved.
+        Counters that went backwards were reset (or the statement was
+        evicted and came back) in between; those count from zero.
+
+        :param start: <INT> older snapshot id
+        :param end: <INT> newer snapshot id
+        :param order: <STR> one of ORDERS, largest first
+        :return <list>: dicts with the query, its names and the deltas
+        """
+        if order not in self.ORDERS:
+            raise ValueError("bad order: {o}".format(o=order))
+        delta = ", ".join(
+            "CASE WHEN a.calls IS NULL OR b.calls < a.calls THEN b.{c}"
+            " ELSE b.{c} - a.{c} END AS {c}".format(c=c) for c in self.COUNTERS)
+        sql = ("SELECT * FROM (SELECT k.queryid, q.datname, q.rolname, q.query, {delta}"
+               " FROM (SELECT queryid, userid, dbid, max(snapshot) AS snapshot FROM counters"
+               "  WHERE snapshot > ? AND snapshot <= ? GROUP BY queryid, userid, dbid) k"
+               " JOIN queries q ON q.queryid = k.queryid AND q.userid = k.userid AND q.dbid = k.dbid"
+               " JOIN counters b ON b.queryid = k.queryid AND b.userid = k.userid"
+               "  AND b.dbid = k.dbid AND b.snapshot = k.snapshot"
+               " LEFT JOIN counters a ON a.queryid = k.queryid AND a.userid = k.userid"
+               "  AND a.dbid = k.dbid AND a.snapshot = ({as_of}){where})"
+               " WHERE calls > 0").format(delta=delta, as_of=self.AS_OF,
+                                          where=" WHERE q.datname = ?" if datname else "")
+        args = [start, end, start] + ([datname] if datname else [])
+        if order == "mean_time":
+            sql += " ORDER BY total_time / calls DESC"
+        else:
+            sql += " ORDER BY {o} DESC".format(o=order)
+        sql += " LIMIT ?"
+        rows = []
+        for row in self.db.execute(sql, args + [limit]):
+            row = dict(row)
+            row['mean_time'] = row['total_time'] / row['calls']
+            rows.append(row)
+        return rows
+
+    def prune(self, retention=Constants.STMTSNAP_RETENTION):
+        """
+        Drop snapshots older than retention seconds. The newest row of a
+        statement before the oldest snapshot kept stays: it is what
+        deltas from that snapshot start from.
+        """
+        row = self.db.execute("SELECT min(id) FROM snapshots WHERE taken >= ?",
+                              (time() - retention,)).fetchone()
+        oldest = row[0]
+        if oldest is None:
+            oldest = self.db.execute("SELECT max(id) FROM snapshots").fetchone()[0]
+        if oldest is None:
+            return
+        with self.db:
+            self.db.execute(
+                "DELETE FROM counters WHERE snapshot < ? AND EXISTS (SELECT 1 FROM counters n"
+                " WHERE n.queryid = counters.queryid AND n.userid = counters.userid"
+                " AND n.dbid = counters.dbid AND n.snapshot > counters.snapshot"
+                " AND n.snapshot <= ?)", (oldest, oldest))
+            # Statements pg_stat_statements dropped before the window.
+            self.db.execute("DELETE FROM queries WHERE last_seen < ?", (oldest,))
+            self.db.execute("DELETE FROM counters WHERE NOT EXISTS (SELECT 1 FROM queries q"
+                            " WHERE q.queryid = counters.queryid AND q.userid = counters.userid"
+                            " AND q.dbid = counters.dbid)")
+            self.db.execute("DELETE FROM snapshots WHERE id < ?", (oldest,))
+
+
+if __name__ == "__main__":
+    if argv[1:] != ["snapshot"]:
+        # Just quit.
+        exit(0)
+    store = StatementStore()
+    snapshot, result = store.take()
+    if snapshot is None:
+        toolkit = ToolKit()
+        for error in result.errors:
+            toolkit.print_stderr(error)
+        exit(1)
+    store.prune()
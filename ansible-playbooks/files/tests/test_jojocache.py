@@ -0,0 +1,52 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# ResultCache in a throwaway directory. Runs anywhere common.py imports:
+#
+#   /bin/python -m unittest discover -s ansible-playbooks/files/tests
+
+from os import path, listdir
+from tempfile import mkdtemp
+from shutil import rmtree
+import unittest
+import sys
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..", "srv-pyjojo"))
+from common import SqlResult
+from jojocache import ResultCache
+
+
+class SweepTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = mkdtemp(prefix="pyjojo-test")
+        self.cache = ResultCache(self.workdir, sweep_interval=0)
+
+    def tearDown(self):
+        rmtree(self.workdir)
+
+    def fetch(self, sql_code, ttl):
+        return self.cache.fetch("psql_stat_activity", {}, sql_code, None, ttl, SqlResult)
+
+    def files(self):
+        script_dir = path.join(self.workdir, "psql_stat_activity")
+        return sorted(listdir(self.workdir) + listdir(script_dir))
+
+    def test_expired_swept(self):
+        self.fetch("SELECT 1", -1)
+        live = self.cache.key({}, "SELECT 2", None)
+        self.fetch("SELECT 2", 60)  # Sweeps out SELECT 1
+        self.assertEqual(self.files(), sorted([live + ".json", live + ".lock", "psql_stat_activity",
+                                               "stats.json", "sweep"]))
+
+    def test_not_again_before_interval(self):
+        self.cache.sweep_interval = 60
+        self.fetch("SELECT 1", -1)
+        self.fetch("SELECT 2", -1)
+        self.assertEqual(len([f for f in self.files() if f.endswith(".lock")]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Parameters as pyjojo hands them over: every value pipes.quote()d
+# into the environment. Runs anywhere common.py imports:
+#
+#   /bin/python -m unittest discover -s ansible-playbooks/files/tests
+
+from pipes import quote
+from os import path
+import unittest
+import sys
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..", "srv-pyjojo"))
+from common import ParamSchema, ParamHandle
+
+
+def quoted(**params):
+    """
+    :return <dict>: the environment pyjojo would build for params
+    """
+    return dict((name.upper(), quote(value)) for name, value in params.items())
+
+
+class HostPatternTest(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = ParamSchema([{'name': "limit", 'unquote': True, 'sanitizer': "host_pattern"}])
+
+    def test_patterns_pyjojo_had_to_quote(self):
+        for pattern in ("web*", "nodes:!prod", "db:&prod", "dc1:!db-masters-prod"):
+            self.assertNotEqual(quote(pattern), pattern)
+            self.assertEqual(self.schema.validate(quoted(limit=pattern))['limit'], pattern)
+
+    def test_plain_group(self):
+        self.assertEqual(self.schema.validate(quoted(limit="dbinfra"))['limit'], "dbinfra")
+
+    def test_left_out(self):
+        self.assertEqual(self.schema.validate({'LIMIT': ParamHandle.NIL})['limit'], None)
+
+    def test_rejected(self):
+        for pattern in ("web; reboot", "a'b", "$(id)"):
+            self.assertRaises(SystemExit, self.schema.validate, quoted(limit=pattern))
+
+    def test_two_words(self):
+        self.assertRaises(SystemExit, self.schema.validate, {'LIMIT': "web db"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# ConnectionPool bookkeeping, with connections that never reach
+# PostgreSQL. Runs anywhere common.py imports:
+#
+#   /bin/python -m unittest discover -s ansible-playbooks/files/tests
+
+from os import path
+from json import dumps
+from tempfile import mkdtemp
+from shutil import rmtree
+import threading
+import socket
+import unittest
+import sys
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..", "srv-pyjojo"))
+from common import SqlResult
+from pgpool import ConnectionPool, PooledConnection, PoolClient
+
+
+class FakeConnection():
+    closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+class AcquireTest(unittest.TestCase):
+    """
+    CLASS: Whatever waits on PostgreSQL (self.answer) must not hold the
+           pool's lock meanwhile.
+    """
+    def setUp(self):
+        self.pool = ConnectionPool(max_connections=2, max_per_database=2,
+                                   health_check_idle=60, acquire_timeout=1)
+        self.waiting = threading.Event()
+        self.answer = threading.Event()
+        self.borrowed = []
+
+    def tearDown(self):
+        self.answer.set()
+
+    def slow(self, value):
+        self.waiting.set()
+        self.answer.wait(5)
+        return value
+
+    def borrow(self):
+        thread = threading.Thread(target=lambda: self.borrowed.append(self.pool.acquire("app")))
+        thread.start()
+        self.assertTrue(self.waiting.wait(5))
+        return thread
+
+    def test_connect_unlocked(self):
+        self.pool.connect = lambda database: self.slow(PooledConnection(database, FakeConnection()))
+        thread = self.borrow()
+        stats = self.pool.snapshot()  # Blocks for good when connect() holds the lock
+        self.assertEqual((stats['total'], stats['in_use']), (1, {'app': 1}))
+        self.answer.set()
+        thread.join(5)
+        self.assertEqual(self.pool.snapshot()['created'], 1)
+
+    def test_ping_unlocked(self):
+        pooled = PooledConnection("app", FakeConnection())
+        pooled.last_used -= 120
+        pooled.ping = lambda: self.slow(False)
+        self.pool.idle = {'app': [pooled]}
+        self.pool.total = 1
+        self.pool.connect = lambda database: PooledConnection(database, FakeConnection())
+        thread = self.borrow()
+        self.assertEqual(self.pool.snapshot()['in_use'], {'app': 1})
+        self.answer.set()
+        thread.join(5)
+        stats = self.pool.snapshot()
+        self.assertEqual((stats['failed_health_check'], stats['total'], stats['in_use']),
+                         (1, 1, {'app': 1}))
+        self.assertIsNot(self.borrowed[0], pooled)
+
+
+
+class ClientTest(unittest.TestCase):
+    """
+    CLASS: A stand-in daemon answering one request with self.answer,
+           or not at all when it is None.
+    """
+    def setUp(self):
+        self.workdir = mkdtemp(prefix="pyjojo-test")
+        self.socket_path = path.join(self.workdir, "pgpool.sock")
+        self.client = PoolClient(self.socket_path, timeout=0.2)
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.done.set()
+        rmtree(self.workdir)
+
+    def serve(self, answer):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(1)
+
+        def handle():
+            conn, _ = server.accept()
+            conn.makefile('rb').readline()
+            if answer is not None:
+                conn.sendall(dumps(answer) + "\n")
+            self.done.wait(5)
+            conn.close()
+            server.close()
+        thread = threading.Thread(target=handle)
+        thread.daemon = True
+        thread.start()
+
+    def test_no_daemon(self):
+        self.assertIsNone(self.client.structured("CREATE ROLE app_svc"))
+
+    def test_connect_failed(self):
+        self.serve({'status': 'error', 'error': 'CONNECT_FAILED', 'detail': "no socket"})
+        self.assertIsNone(self.client.structured("CREATE ROLE app_svc"))
+
+    def test_timeout(self):
+        self.serve(None)
+        result = SqlResult.from_dict(self.client.structured("CREATE ROLE app_svc"))
+        self.assertEqual(result.error_hints(), ['POOL_TIMEOUT'])
+
+    def test_execution_failed(self):
+        self.serve({'status': 'error', 'error': 'EXECUTION_FAILED', 'detail': "server closed"})
+        output = self.client.sql("CREATE ROLE app_svc", source="<stdin>")
+        self.assertTrue(output.startswith("psql: FATAL:  EXECUTION_FAILED"), output)
+
+
+if __name__ == "__main__":
+    unittest.main()
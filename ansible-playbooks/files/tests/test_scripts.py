@@ -0,0 +1,431 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# Scripts run through jojod's ScriptRunner, which quotes parameters the
+# way pyjojo does, with CmdRun's SQL and ansible calls recorded instead
+# of run. Runs anywhere common.py imports:
+#
+#   /bin/python -m unittest discover -s ansible-playbooks/files/tests
+
+from json import dumps
+from time import time
+from os import path, makedirs
+from tempfile import mkdtemp
+from shutil import rmtree
+import unittest
+import shlex
+import sys
+
+SCRIPTS = path.join(path.dirname(path.abspath(__file__)), "..", "srv-pyjojo")
+sys.path.insert(0, SCRIPTS)
+from common import Constants, CmdRun, SqlResult, SqlStream, ToolKit, AnsibleResult, Instrument
+from jojod import Script, ScriptRunner
+from jojometrics import MetricStore
+from lagmon import LagClient
+from jobs import JobStore, JobExecutor
+
+
+class ScriptTest(unittest.TestCase):
+    """
+    CLASS: self.run_script() runs a script, self.sent holds the SQL it
+           handed to CmdRun.execute(), query() or stream() (which answer
+           with no rows), self.playbooks the ansible-playbook
+           command lines it ran or queued, in order.
+    """
+    TAGS = "BEGIN\nCOMMIT\n"
+
+    def setUp(self):
+        self.sent = []
+        self.playbooks = []
+        self.workdir = mkdtemp(prefix="pyjojo-test")
+        self.saved = dict((name, getattr(Constants, name)) for name in
+                          ("LOCK_DIR", "METRICS_ENABLED", "ADMISSION_ENABLED"))
+        Constants.LOCK_DIR = self.workdir
+        Constants.METRICS_ENABLED = False
+        Constants.ADMISSION_ENABLED = False
+        self.defaults = []
+        self.patched = dict((name, getattr(CmdRun, name)) for name in
+                            ("execute", "query", "stream", "ansible_run", "ansible_job"))
+
+        def execute(run, sql_code, database=None):
+            self.sent.append(sql_code)
+            result = SqlResult()
+            result.parse_tags(self.TAGS)
+            return result
+        CmdRun.execute = execute
+
+        def query(run, sql_code, database=None):
+            self.sent.append(sql_code)
+            return SqlResult()
+        CmdRun.query = query
+
+        def stream(run, sql_code, database=None, limit=None, columns=None):
+            self.sent.append(sql_code)
+            return SqlStream(["/bin/true"], "", limit)
+        CmdRun.stream = stream
+
+        def ansible_run(run, ansible_opts, sink=None, fallback=True):
+            self.playbooks.append(run.ansible_command(ansible_opts))
+            return self.ansible_result
+        CmdRun.ansible_run = ansible_run
+        self.ansible_result = AnsibleResult()
+
+        def ansible_job(run, ansible_opts):
+            self.playbooks.append(run.ansible_command(ansible_opts))
+            return {'id': "20160301T101500-3f2a9c", 'state': "queued"}
+        CmdRun.ansible_job = ansible_job
+
+    def tearDown(self):
+        for name, method in self.patched.items():
+            setattr(CmdRun, name, method)
+        for function, defaults in self.defaults:
+            function.func_defaults = defaults
+        for name, value in self.saved.items():
+            setattr(Constants, name, value)
+        rmtree(self.workdir)
+
+    def redirect(self, method, *defaults):
+        """
+        Replace the first keyword defaults of method until tearDown, for
+        classes that bind Constants paths at import.
+        """
+        function = method.im_func
+        self.defaults.append((function, function.func_defaults))
+        function.func_defaults = defaults + function.func_defaults[len(defaults):]
+
+    def run_script(self, name, params):
+        """
+        :return <dict>: the JSON body jojod would answer with
+        """
+        runner = ScriptRunner()
+        return runner.response(*runner.execute(Script(path.join(SCRIPTS, name + ".py")), params))
+
+
+class RolesBatchTest(ScriptTest):
+    TAGS = "BEGIN\nCREATE ROLE\nCOMMIT\n"
+
+    def test_documented_example(self):
+        body = self.run_script("psql_create_roles_batch",
+                               {'roles': '[{"role": "app_svc", "password": "x", "login": true}]'})
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertEqual(body['return_values']['roles_ok'], "1")
+        self.assertIn("CREATE ROLE app_svc", self.sent[0])
+
+    def test_json_body_list(self):
+        body = self.run_script("psql_create_roles_batch",
+                               {'roles': [{'role': "app_svc", 'password': "x", 'login': True}]})
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertIn("CREATE ROLE app_svc", self.sent[0])
+
+    def test_quote_in_password(self):
+        body = self.run_script("psql_create_roles_batch",
+                               {'roles': dumps([{'role': "app_svc", 'password': "it's"}])})
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertIn("PASSWORD 'it''s'", self.sent[0])
+
+    def test_not_a_list(self):
+        body = self.run_script("psql_create_roles_batch", {'roles': '{"role": "app_svc"}'})
+        self.assertNotEqual(body['retcode'], 0)
+        self.assertEqual(self.sent, [])
+
+
+
+class HierarchyBatchTest(ScriptTest):
+
+    def test_quoted_list(self):
+        body = self.run_script("psql_create_role_db_hierarchy_batch", {'applications': dumps([
+            {'application': "billing", 'super_password': "x", 'svc_password': "y"},
+            {'application': "ledger", 'super_password': "it's", 'svc_password': "z"}])})
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertEqual(body['return_values']['applications_ok'], "2")
+        self.assertIn("CREATE DATABASE ledger OWNER ledger_super_role;\n", self.sent)
+
+    def test_worker_exit(self):
+        def execute(run, sql_code, database=None):
+            if "ledger" in sql_code:
+                exit(1)
+            return SqlResult()
+        CmdRun.execute = execute
+        body = self.run_script("psql_create_role_db_hierarchy_batch", {'applications': dumps([
+            {'application': "billing", 'super_password': "x", 'svc_password': "y"},
+            {'application': "ledger", 'super_password': "x", 'svc_password': "z"}])})
+        self.assertEqual(body['return_values']['execution_status'], "partial", body)
+        self.assertIn("ABORTED", body['return_values']['error_reason_indicator'])
+
+
+    def test_admitted_before_the_workers_start(self):
+        from jojoadmit import AdmissionController
+        Constants.ADMISSION_ENABLED = True
+        unadmitted = []
+
+        def execute(run, sql_code, database=None):
+            if AdmissionController.ticket is None:
+                unadmitted.append(sql_code)
+            ToolKit().admit()
+            return SqlResult()
+        CmdRun.execute = execute
+        self.redirect(AdmissionController.__init__, self.workdir)
+        self.run_script("psql_create_role_db_hierarchy_batch", {'applications': dumps([
+            {'application': "app{i}".format(i=i), 'super_password': "x", 'svc_password': "y"}
+            for i in range(8)]), 'workers': "8"})
+        stats = AdmissionController().stats()['write']
+        self.assertEqual(unadmitted, [])
+        self.assertEqual((stats['admitted'], stats['running']), (1, 0))
+
+
+
+class DatabaseRefreshTest(ScriptTest):
+    PARAMS = {'src_tier': "staging", 'dest_tier': "dev", 'origin_database': "billing",
+              'dest_database': "billing", 'dest_database_owner': "billing_super_role",
+              'dest_database_template': "billing_template"}
+
+    def test_failed_run(self):
+        self.ansible_result = AnsibleResult(returncode=2)
+        body = self.run_script("ansible_database_refresh", dict(self.PARAMS, async="false"))
+        self.assertEqual(body['retcode'], 1, body)
+        self.assertEqual(body['return_values']['execution_status'], "rollback")
+
+    def test_documented_limit(self):
+        body = self.run_script("ansible_database_refresh",
+                               dict(self.PARAMS, limit="staging:dev:&dbinfra"))
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertIn("--limit=staging:dev:&dbinfra", shlex.split(self.playbooks[0]))
+
+
+
+class SlowQueriesTest(ScriptTest):
+
+    def test_documented_states(self):
+        body = self.run_script("psql_slow_queries", {'state': "active,idle in transaction"})
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertIn("state IN ('active', 'idle in transaction')", self.sent[0])
+
+    def test_unknown_state(self):
+        body = self.run_script("psql_slow_queries", {'state': "idle in wonderland"})
+        self.assertNotEqual(body['retcode'], 0)
+        self.assertEqual(self.sent, [])
+
+
+
+class TerminateSocketsTest(ScriptTest):
+
+    def test_idle_in_transaction(self):
+        body = self.run_script("psql_terminate_sockets", {'state': "idle in transaction",
+                                                          'dry_run': "true"})
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertIn("state IN ('idle in transaction')", self.sent[0])
+
+
+
+class FleetSweepTest(ScriptTest):
+
+    def setUp(self):
+        ScriptTest.setUp(self)
+        from fanout import FanOut
+        makedirs(path.join(self.workdir, "prod"))
+        with open(path.join(self.workdir, "prod", "hosts"), "w") as f:
+            f.write("[dc1]\ndb1\ndb2\n[db-masters-prod]\ndb1\n")
+        self.inventory_dir, Constants.FANOUT_INVENTORY_DIR = Constants.FANOUT_INVENTORY_DIR, self.workdir
+        self.fan_run = FanOut.run
+        FanOut.run = lambda fan, hosts, call: [
+            {'host': host, 'status': "ok", 'elapsed': 0.0, 'error': None, 'reply': {'retcode': 0}}
+            for host in hosts]
+
+    def tearDown(self):
+        from fanout import FanOut
+        FanOut.run = self.fan_run
+        Constants.FANOUT_INVENTORY_DIR = self.inventory_dir
+        ScriptTest.tearDown(self)
+
+    def test_exclusion_pattern(self):
+        body = self.run_script("psql_fleet_sweep", {'script': "psql_slave_delay",
+                                                    'environment': "prod",
+                                                    'hosts': "dc1:!db-masters-prod"})
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertEqual(body['return_values']['hosts'], "1")
+        self.assertIn('"host": "db2"', body['stdout'][0])
+
+    def test_wildcard_pattern(self):
+        body = self.run_script("psql_fleet_sweep", {'script': "psql_slave_delay",
+                                                    'environment': "prod",
+                                                    'hosts': "db*:!db-masters-*"})
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertEqual(body['return_values']['hosts'], "1")
+        self.assertIn('"host": "db2"', body['stdout'][0])
+
+
+class PackageIndexTest(ScriptTest):
+
+    def setUp(self):
+        ScriptTest.setUp(self)
+        from pkgindex import PackageIndex
+        self.redirect(PackageIndex.__init__, path.join(self.workdir, "packages.db"))
+
+    def test_refresh_pattern(self):
+        self.ansible_result = AnsibleResult(structured=True)
+        body = self.run_script("ansible_package_refresh", {'host': "db-*.dev:!db-n02.dev"})
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertIn("--limit=db-*.dev:!db-n02.dev", shlex.split(self.playbooks[0]))
+
+    def test_lookup_tilde_version(self):
+        body = self.run_script("ansible_package_lookup", {'package': "openssl",
+                                                          'version': "1.0.2~rc1"})
+        self.assertEqual(body['retcode'], 0, body)
+
+
+
+class RunPlaybookTest(ScriptTest):
+
+    def argv(self, **params):
+        body = self.run_script("ansible_run_playbook",
+                               dict(params, playbook="/opt/playbooks/site.yml", async="true"))
+        self.assertEqual(body['retcode'], 0, body)
+        return shlex.split(self.playbooks[0])
+
+    def test_value_with_a_space(self):
+        argv = self.argv(private_key="/etc/keys/deploy key")
+        self.assertIn("--private-key=/etc/keys/deploy key", argv)
+
+    def test_extra_vars_pairs(self):
+        argv = self.argv(extra_vars="tier=dev db=billing")
+        self.assertIn("--extra-vars=tier=dev db=billing", argv)
+
+    def test_extra_vars_json(self):
+        self.assertIn('--extra-vars={"tier": "dev"}', self.argv(extra_vars='{"tier": "dev"}'))
+
+    def test_json_body_bool(self):
+        body = self.run_script("ansible_run_playbook", {'playbook': "/opt/playbooks/site.yml",
+                                                        'async': True})
+        self.assertEqual(body['return_values']['job_state'], "queued", body)
+
+    def test_failed_run(self):
+        self.ansible_result = AnsibleResult(returncode=2, structured=True)
+        self.ansible_result.results = [{'play': "site", 'task': "ping", 'host': "db1",
+                                        'status': "unreachable", 'result': {}}]
+        body = self.run_script("ansible_run_playbook", {'playbook': "/opt/playbooks/site.yml"})
+        self.assertEqual(body['retcode'], 1, body)
+        self.assertEqual(body['return_values']['execution_status'], "rollback")
+        self.assertEqual(body['return_values']['failed_hosts'], "['db1']")
+
+    def test_extra_vars_quote(self):
+        body = self.run_script("ansible_run_playbook", {'playbook': "/opt/playbooks/site.yml",
+                                                        'extra_vars': "name=o'neil"})
+        self.assertNotEqual(body['retcode'], 0)
+        self.assertEqual(self.playbooks, [])
+
+
+
+class GetPackageVersionTest(ScriptTest):
+    INJECTION = 'x";echo PWNED;"'
+
+    def setUp(self):
+        ScriptTest.setUp(self)
+        self.redirect(JobStore.__init__, self.workdir)
+        CmdRun.ansible_job = self.patched['ansible_job']  # Queue for real
+
+    def test_async_argv(self):
+        body = self.run_script("ansible_get_package_version",
+                               {'package': "postgresql96-server", 'async': "true"})
+        self.assertEqual(body['retcode'], 0, body)
+        job = JobStore().load(body['return_values']['job_id'])
+        self.assertEqual(job['argv'][0], "/usr/bin/ansible-playbook")
+        self.assertIn('--extra-vars={"package": "postgresql96-server"}', job['argv'])
+
+    def test_shell_in_package(self):
+        body = self.run_script("ansible_get_package_version",
+                               {'package': self.INJECTION, 'async': "true"})
+        self.assertNotEqual(body['retcode'], 0)
+        self.assertEqual(JobStore().jobs(), [])
+
+    def test_no_shell_in_jobs(self):
+        store = JobStore()
+        job = store.submit(["/bin/echo", self.INJECTION], kind="ansible")
+        executor = JobExecutor(store)
+        executor.start(job)
+        executor.running[job['id']][1].wait()
+        with open(store.log_path(job['id'])) as f:
+            self.assertEqual(f.read(), self.INJECTION + "\n")
+
+    def test_command_queued_before(self):
+        store = JobStore()
+        job = store.submit([], kind="ansible")
+        del job['argv']
+        job['command'] = "/bin/echo " + self.INJECTION
+        JobExecutor(store).start(job)
+        self.assertEqual(store.load(job['id'])['state'], "failed")
+
+
+class SlaveDelayTest(ScriptTest):
+    def setUp(self):
+        ScriptTest.setUp(self)
+        self.summary = LagClient.__dict__['summary']
+        self.current = None
+        LagClient.summary = lambda client, window=None: self.current and {'current': self.current}
+
+        def query(run, sql_code, database=None):
+            self.sent.append(sql_code)
+            result = SqlResult()
+            if "server_version_num" in sql_code:
+                result.rows = [{'v': 90624}]
+            return result
+        CmdRun.query = query
+
+    def tearDown(self):
+        LagClient.summary = self.summary
+        ScriptTest.tearDown(self)
+
+    def test_fallback_caught_up(self):
+        self.run_script("psql_slave_delay", {})
+        self.assertIn("WHEN pg_last_xlog_receive_location() = pg_last_xlog_replay_location()"
+                      " THEN interval '0'", self.sent[1])
+
+    def test_days(self):
+        self.current = {'error': None, 'in_recovery': True, 'ts': time(),
+                        'lag_seconds': 2 * 86400 + 3600.5}
+        body = self.run_script("psql_slave_delay", {})
+        self.assertEqual(body['return_values']['slave_delay'], "2 days 01:00:00.500000")
+        self.assertEqual(self.sent, [])
+
+
+class MetricsTest(ScriptTest):
+    """
+    CLASS: Samples a jojod worker hands over after every request.
+    """
+    def setUp(self):
+        ScriptTest.setUp(self)
+        Constants.METRICS_ENABLED = True
+        self.flushed = []
+        self.flush = Instrument.__dict__['flush']
+
+        def flush(cls):
+            samples, cls.samples = cls.samples, []
+            self.flushed.extend(samples)
+        Instrument.flush = classmethod(flush)
+
+    def tearDown(self):
+        Instrument.flush = self.flush
+        ScriptTest.tearDown(self)
+
+    def scripts(self):
+        return [(sample[0], sample[2]) for sample in self.flushed if sample[1] == "script"]
+
+    def test_scrape_pauses_itself_only(self):
+        self.redirect(MetricStore.__init__, self.workdir)
+        body = self.run_script("jojo_metrics", {})
+        self.assertEqual(body['retcode'], 0, body)
+        self.assertEqual(self.scripts(), [])
+        self.run_script("psql_slow_queries", {})
+        self.assertEqual([name for name, _ in self.scripts()], ["psql_slow_queries"])
+
+    def test_script_time_is_per_request(self):
+        Instrument.started = 0  # A worker up since the epoch
+        self.run_script("psql_slow_queries", {})
+        (_, wall), = self.scripts()
+        self.assertLess(wall, 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, Jonathan Kelley
+# License Apache Commons v2
+
+# StatementStore snapshots in a throwaway sqlite file, pg_stat_statements
+# answered by a stand-in for CmdRun. Runs anywhere common.py imports:
+#
+#   /bin/python -m unittest discover -s ansible-playbooks/files/tests
+
+from os import path
+from tempfile import mkdtemp
+from shutil import rmtree
+import unittest
+import sys
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..", "srv-pyjojo"))
+from common import SqlResult
+from stmtsnap import StatementStore
+
+
+class FakeRun():
+    """
+    CLASS: Answers the server_version_num query with version, anything
+           else with rows.
+    """
+    def __init__(self, version, rows):
+        self.version = version
+        self.rows = rows
+        self.sent = []
+
+    def query(self, sql_code, database=None):
+        self.sent.append(sql_code)
+        result = SqlResult()
+        result.rows = [{'v': self.version}] if "server_version_num" in sql_code else self.rows
+        return result
+
+
+class TakeTest(unittest.TestCase):
+    ROW = {'queryid': 42, 'userid': 10, 'dbid': 16384, 'datname': "app", 'rolname': "app_svc",
+           'query': "SELECT 1", 'calls': 3, 'total_time': 1.5, 'rows': 3,
+           'shared_blks_hit': 0, 'shared_blks_read': 0}
+
+    def setUp(self):
+        self.workdir = mkdtemp(prefix="pyjojo-test")
+        self.store = StatementStore(path.join(self.workdir, "statements.db"))
+
+    def tearDown(self):
+        rmtree(self.workdir)
+
+    def test_toplevel_added_up(self):
+        run = FakeRun(140005, [self.ROW])
+        snapshot, result = self.store.take(run)
+        self.assertIsNotNone(snapshot)
+        self.assertIn("GROUP BY queryid, userid, dbid", run.sent[1])
+        self.assertIn("total_exec_time", run.sent[1])
+
+    def test_before_toplevel(self):
+        run = FakeRun(130000, [self.ROW])
+        self.store.take(run)
+        self.assertNotIn("GROUP BY", run.sent[1])
+
+
+if __name__ == "__main__":
+    unittest.main()